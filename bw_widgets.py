@@ -30,7 +30,7 @@ from lib.bw_types import BWMatrix
 from widgets.editor_widgets import catch_exception, catch_exception_with_dialog
 #from pikmingen import PikminObject
 from opengltext import draw_collision
-from lib.vectors import Matrix4x4, Vector3, Line, Plane, Triangle
+from lib.vectors import Matrix4x4, Vector3, Line, Plane, Triangle, frustum_planes
 from lib.model_rendering import TexturedPlane, Model, Grid, GenericObject, Material, Minimap
 from lib.shader import create_default_shader
 from gizmo import Gizmo
@@ -44,6 +44,7 @@ from lib.graphics import Graphics
 from widgets.filter_view import FilterViewMenu
 from widgets.editor_widgets import GizmoWidget
 from lib.bw.texture import OpenGLTexture
+from lib.render.model_renderingv2 import TerrainMeshBuffer
 
 import typing
 if typing.TYPE_CHECKING:
@@ -455,6 +456,7 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
 
         self.modelviewmatrix = None
         self.projectionmatrix = None
+        self.mvp_mat = None
 
         self.arrow = None
         self.minimap = Minimap(Vector3(-1000.0, 0.0, -1000.0), Vector3(1000.0, 0.0, 1000.0), 0,
@@ -497,7 +499,9 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
         self.gizmo_visibility_widget.rotationbutton.pressed.connect(self.toggle_rotation_gizmo)
         self.gizmo_visibility_widget.cubebutton.pressed.connect(self.toggle_cube_visibility)
 
-        self.select_update.connect(lambda: self.do_redraw(force=True))
+        # Objects whose selection changed are found by the renderer, only their highlight is updated
+        self.select_update.connect(lambda: self.do_redraw(forceselected=True))
+        self.select_update.connect(self.update)
 
     def toggle_translation_gizmo(self):
         self.translation_visible = not self.translation_visible
@@ -539,6 +543,8 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
             #with open("lib/bw/C1_OnPatrol_Level.res", "rb") as f:
             self.bwmodelhandler = BWModelHandler.from_archive(resource_archive, callback)
         else:
+            if self.bwmodelhandler.batch is not None:
+                self.bwmodelhandler.batch.free()
             del self.bwmodelhandler
             self.bwmodelhandler = None
             self.bwmodelhandler = BWModelHandler.from_archive(resource_archive, callback)
@@ -551,113 +557,35 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
         if self.bwmodelhandler is None:
             return
 
+        bwterrain = BWTerrainV2(f)
+        print("Terrain read")
+        self.setTerrain(bwterrain, bwterrain.build_render_meshes(), callback)
+
+    def setTerrain(self, bwterrain, render_meshes, callback=None):
+        # render_meshes is the result of bwterrain.build_render_meshes() which can be
+        # prepared outside of the UI thread, only the GL upload happens here
+        if self.bwmodelhandler is None:
+            return
+
         self.overlay_texture.init()
-        self.bwterrain = BWTerrainV2(f)
+        self.bwterrain = bwterrain
         self.makeCurrent()
-        print("Terrain read")
 
         if self.terrainmap is not None:
-            for entry in self.terrainmap:
-                glDeleteLists(entry, 1)
+            for entry in self.terrainmap.values():
+                entry.free()
 
-        print("Lists cleared")
+        print("Buffers cleared")
         for i, material in enumerate(self.bwterrain.materials):
             self.bwmodelhandler.textures.initialize_texture(material.mat1, mipmap=True)
             self.bwmodelhandler.textures.initialize_texture(material.mat2, mipmap=True)
             if callback is not None:
                 callback(len(self.bwterrain.materials), i)
         print("Materials initialized")
-        self.terrainmap = []
-
-        glColor4f(0.0, 0.0, 0.0, 1.0)
-        for meshindex, meshes in self.bwterrain.meshes.items():
-            mesh = glGenLists(1)
-            glNewList(mesh, GL_COMPILE)
-            glBegin(GL_QUADS)
-            for tilemesh in meshes:
-                for quad in tilemesh.quads:
-                    vtx = tilemesh.vertices[quad[0]]
-                    glVertexAttrib4f(2, vtx.color.r, vtx.color.g, vtx.color.b, vtx.color.a)
-                    glVertexAttrib2f(3, vtx.uv1.x, vtx.uv1.y)
-                    glVertexAttrib2f(4, vtx.uv2.x, vtx.uv2.y)
-                    glVertexAttrib2f(5, (vtx.pos[0]+2048)/4096.0, (vtx.pos[2]+2048)/4096.0)
-                    glVertex3f(vtx.pos[0], vtx.pos[2], vtx.pos[1])
-
-                    vtx = tilemesh.vertices[quad[1]]
-                    glVertexAttrib4f(2, vtx.color.r, vtx.color.g, vtx.color.b, vtx.color.a)
-                    glVertexAttrib2f(3, vtx.uv1.x, vtx.uv1.y)
-                    glVertexAttrib2f(4, vtx.uv2.x, vtx.uv2.y)
-                    glVertexAttrib2f(5, (vtx.pos[0] + 2048) / 4096.0, (vtx.pos[2] + 2048) / 4096.0)
-                    glVertex3f(vtx.pos[0], vtx.pos[2], vtx.pos[1])
-
-                    vtx = tilemesh.vertices[quad[2]]
-                    glVertexAttrib4f(2, vtx.color.r, vtx.color.g, vtx.color.b, vtx.color.a)
-                    glVertexAttrib2f(3, vtx.uv1.x, vtx.uv1.y)
-                    glVertexAttrib2f(4, vtx.uv2.x, vtx.uv2.y)
-                    glVertexAttrib2f(5, (vtx.pos[0] + 2048) / 4096.0, (vtx.pos[2] + 2048) / 4096.0)
-                    glVertex3f(vtx.pos[0], vtx.pos[2], vtx.pos[1])
-
-                    vtx = tilemesh.vertices[quad[3]]
-                    glVertexAttrib4f(2, vtx.color.r, vtx.color.g, vtx.color.b, vtx.color.a)
-                    glVertexAttrib2f(3, vtx.uv1.x, vtx.uv1.y)
-                    glVertexAttrib2f(4, vtx.uv2.x, vtx.uv2.y)
-                    glVertexAttrib2f(5, (vtx.pos[0] + 2048) / 4096.0, (vtx.pos[2] + 2048) / 4096.0)
-                    glVertex3f(vtx.pos[0], vtx.pos[2], vtx.pos[1])
-            glEnd()
+        self.terrainmap = {}
 
-            # 11 12
-            # 13 14
-
-            # 21 22
-            # 23 24
-
-            #
-            """for tilemesh in meshes:
-                minaabb, maxaabb = tilemesh.aabb.min, tilemesh.aabb.max
-                corner_11 = minaabb.x, minaabb.z, minaabb.y
-                corner_12 = maxaabb.x, minaabb.z, minaabb.y
-                corner_13 = minaabb.x, maxaabb.z, minaabb.y
-                corner_14 = maxaabb.x, maxaabb.z, minaabb.y
-
-                corner_21 = minaabb.x, minaabb.z, maxaabb.y
-                corner_22 = maxaabb.x, minaabb.z, maxaabb.y
-                corner_23 = minaabb.x, maxaabb.z, maxaabb.y
-                corner_24 = maxaabb.x, maxaabb.z, maxaabb.y
-                glBegin(GL_LINE_LOOP)
-                glVertexAttrib4f(2, 0, 0, 0, 1.0)
-                glVertex3f(*corner_11)
-                glVertex3f(*corner_12)
-                glVertex3f(*corner_14)
-                glVertex3f(*corner_13)
-                glEnd()
-
-                glBegin(GL_LINE_LOOP)
-                glVertex3f(*corner_21)
-                glVertex3f(*corner_22)
-                glVertex3f(*corner_24)
-                glVertex3f(*corner_23)
-                glEnd()
-
-                glBegin(GL_LINES)
-                glVertex3f(*corner_11)
-                glVertex3f(*corner_21)
-
-                glVertex3f(*corner_12)
-                glVertex3f(*corner_22)
-
-                glVertex3f(*corner_13)
-                glVertex3f(*corner_23)
-
-                glVertex3f(*corner_14)
-                glVertex3f(*corner_24)
-                glEnd()
-
-            #glVertex3f()
-
-            #glEnd()"""
-
-            glEndList()
-            self.terrainmap.append(mesh)
+        for meshindex, mesh in render_meshes.items():
+            self.terrainmap[meshindex] = TerrainMeshBuffer(mesh)
         print("Done")
         self.doneCurrent()
 
@@ -672,22 +600,24 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
         glActiveTexture(GL_TEXTURE2)
         glBindTexture(GL_TEXTURE_2D, self.overlay_texture.id)
 
-        for meshindex, displist in zip(self.bwterrain.meshes, self.terrainmap):
+        texvar = glGetUniformLocation(self.shader, "tex")
+        glUniform1i(texvar, 0)
+        texvar2 = glGetUniformLocation(self.shader, "tex2")
+        glUniform1i(texvar2, 1)
+
+        # Chunks outside of the view are skipped
+        planes = frustum_planes(self.mvp_mat) if self.mvp_mat is not None else None
+
+        for meshindex, meshbuffer in self.terrainmap.items():
             material = self.bwterrain.materials[meshindex]
             tex1 = self.bwmodelhandler.textures.get_texture(material.mat1)
             tex2 = self.bwmodelhandler.textures.get_texture(material.mat2)
 
-            texvar = glGetUniformLocation(self.shader, "tex")
-            # print(texvar, self.shader, type(self.shader))
-            glUniform1i(texvar, 0)
-            texvar2 = glGetUniformLocation(self.shader, "tex2")
-            glUniform1i(texvar2, 1)
-
             glActiveTexture(GL_TEXTURE0)
             glBindTexture(GL_TEXTURE_2D, tex1[1])
             glActiveTexture(GL_TEXTURE1)
             glBindTexture(GL_TEXTURE_2D, tex2[1])
-            glCallList(displist)
+            meshbuffer.render(planes)
         glEnable(GL_ALPHA_TEST)
         glDisable(GL_TEXTURE_2D)
         glUseProgram(0)
@@ -915,17 +845,11 @@ class BolMapViewer(QtOpenGLWidgets.QOpenGLWidget):
             self.graphics.set_dirty()
             self._lastrendertime = 0
         elif forceselected or forcespecific:
-            modelnames = set()
+            # Only the instance slots of these objects are updated
             if forceselected:
-                for obj in self.selected:
-                    if obj.modelname is not None:
-                        modelnames.add(obj.modelname)
-
+                self.graphics.set_dirty_objects(self.selected)
             elif forcespecific:
-                for obj in forcespecific:
-                    if obj.modelname is not None:
-                        modelnames.add(obj.modelname)
-            self.graphics.set_dirty_limited(modelnames)
+                self.graphics.set_dirty_objects(forcespecific)
             self._lastrendertime = 0
             #self.update()
 
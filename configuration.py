@@ -25,7 +25,10 @@ def make_default_config():
         "regenerate_pf2": "True",
         "regenerate_waypoints": "False",
         "fps_counter": "False",
-        "dark_mode": "True"
+        "dark_mode": "True",
+        "autosave_interval": "0",
+        "frustum_culling": "True",
+        "render_distance": "0"
     }
 
     with open("editor_config.ini", "w") as f:
@@ -2,7 +2,13 @@ import json
 import typing
 import hashlib
 import os
+import gzip
+import shutil
+import tempfile
+import queue
+import threading
 
+from bisect import bisect_right
 from functools import partial
 from collections.abc import MutableSequence, Iterable
 try:
@@ -283,17 +289,154 @@ class AttributeList(MutableSequence, Iterable):
         return str([x for x in self])
     
         
+def get_read_progress(fileobj):
+    # Returns the size of the file and a function that returns how much of it has been read.
+    # For gzip files this is measured on the compressed file underneath.
+    if isinstance(fileobj, gzip.GzipFile):
+        fileobj = fileobj.fileobj
+
+    try:
+        start = fileobj.tell()
+        size = fileobj.seek(0, 2)
+        fileobj.seek(start)
+    except (AttributeError, OSError):
+        return None, None
+
+    return size, fileobj.tell
+
+
+class PrefetchReader(object):
+    # Reads a file on a background thread so that decompressing a gzip file overlaps with
+    # parsing it. zlib releases the GIL while it decompresses a chunk.
+    def __init__(self, fileobj, get_position=None, chunksize=1024*1024):
+        self.fileobj = fileobj
+        self.get_position = get_position
+        self.chunksize = chunksize
+        self.position = 0
+
+        self.queue = queue.Queue(maxsize=8)
+        self.stopped = False
+        self.buffer = b""
+        self.offset = 0
+        self.done = False
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        try:
+            while not self.stopped:
+                data = self.fileobj.read(self.chunksize)
+                position = self.get_position() if self.get_position is not None else 0
+                self._put((data, position))
+                if not data:
+                    break
+        except Exception as err:
+            self._put((err, 0))
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) - self.offset < size):
+            data, position = self.queue.get()
+            if isinstance(data, Exception):
+                raise data
+            if not data:
+                self.done = True
+                break
+            self.buffer = self.buffer[self.offset:] + data
+            self.offset = 0
+            self.position = position
+
+        if size < 0:
+            size = len(self.buffer) - self.offset
+        result = self.buffer[self.offset:self.offset+size]
+        self.offset += len(result)
+        return result
+
+    def close(self):
+        self.stopped = True
+        self.thread.join()
+
+
+class ObjectTextIndex(object):
+    # Lowercase serialized text of all objects of a level file joined into one buffer
+    # with a table of where each object's text starts, so a search is a single scan.
+    def __init__(self, level):
+        self.level = level
+        self.version = None
+        self.objects = []
+        self.texts = []
+        self.lowertexts = []
+        self.starts = []
+        self.buffer = ""
+
+    def update(self):
+        if self.version == self.level.version:
+            return
+        self.version = self.level.version
+
+        objects = list(self.level.objects.values())
+        texts = []
+        lowertexts = []
+        for obj in objects:
+            text, lowertext = obj.tostring_cached()
+            texts.append(text)
+            lowertexts.append(lowertext)
+
+        changed = (len(objects) != len(self.objects)
+                   or any(a is not b for a, b in zip(objects, self.objects))
+                   or any(a is not b for a, b in zip(lowertexts, self.lowertexts)))
+
+        if changed:
+            self.objects = objects
+            self.texts = texts
+            self.lowertexts = lowertexts
+            self.starts = []
+            start = 0
+            for lowertext in lowertexts:
+                self.starts.append(start)
+                start += len(lowertext) + 1
+            # Objects are separated by a character that can't appear in XML so matches can't span two objects
+            self.buffer = "\0".join(lowertexts)
+
+    def search(self, text):
+        # Returns (object, matched text) for every object that contains the text, ignoring case
+        self.update()
+        textlower = text.lower()
+        results = []
+        if not textlower or "\0" in textlower:
+            return results
+
+        pos = self.buffer.find(textlower)
+        while pos != -1:
+            i = bisect_right(self.starts, pos) - 1
+            offset = pos - self.starts[i]
+            results.append((self.objects[i], self.texts[i][offset:offset+len(text)]))
+
+            if i + 1 < len(self.starts):
+                pos = self.buffer.find(textlower, self.starts[i+1])
+            else:
+                pos = -1
+
+        return results
+
+
 class BattalionLevelFile(object):
     def __init__(self, fileobj=None, callback=None):
-        if fileobj is None:
-            root = etree.Element("Instances")
-            self._tree = etree.ElementTree(root)
-        else:
-            self._tree = etree.parse(fileobj)
-        self._root = self._tree.getroot()
-
         self.objects = {}
         self.objects_with_positions = {}
+        # Increased whenever objects are added, removed or changed so the text index knows when to update
+        self.version = 0
+        self.text_index = ObjectTextIndex(self)
+        # Objects by the id() of their XML node, for writing the nodes in order
+        self._node_objects = {}
 
         self._categories: typing.Dict[str, typing.Dict[str, BattalionObject]] = {}
         for category, attr in [("cGameScriptResource", "scripts")]:
@@ -303,22 +446,61 @@ class BattalionLevelFile(object):
 
         self.bw2 = False
 
-        for i, child in enumerate(self._root):
-            if child.tag == "Object":
-                bwobject = BattalionObject(self, child)
-
-                if not self.bw2:
-                    for node in bwobject._node:
-                        if node.attrib["name"] not in bwfieldnames:
-                            self.bw2 = True
-                            #print("Detected XML as BW2")
-
-                self.add_object(bwobject)
-                if callback is not None: callback(len(self._root), i)
+        if fileobj is None:
+            root = etree.Element("Instances")
+            self._tree = etree.ElementTree(root)
+        else:
+            self._tree = self._parse(fileobj, callback)
+        self._root = self._tree.getroot()
 
         if self.bw2:
             print("Detected XML as BW2")
 
+    def _parse(self, fileobj, callback):
+        # Objects are created as soon as their element has been parsed instead of after the whole file.
+        size, get_position = None, None
+        if callback is not None:
+            size, get_position = get_read_progress(fileobj)
+            if size is None:
+                callback = None
+
+        reader = None
+        if isinstance(fileobj, gzip.GzipFile):
+            reader = PrefetchReader(fileobj, get_position)
+            get_position = lambda: reader.position
+            fileobj = reader
+
+        try:
+            return self._parse_objects(fileobj, callback, size, get_position)
+        finally:
+            if reader is not None:
+                reader.close()
+
+    def _parse_objects(self, fileobj, callback, size, get_position):
+        last_progress = -1
+        parser = etree.iterparse(fileobj, events=("end", ))
+        for event, child in parser:
+            if child.tag != "Object":
+                continue
+
+            bwobject = BattalionObject(self, child)
+
+            if not self.bw2:
+                for node in bwobject._node:
+                    if node.attrib["name"] not in bwfieldnames:
+                        self.bw2 = True
+                        #print("Detected XML as BW2")
+
+            self.add_object(bwobject)
+
+            if callback is not None:
+                position = get_position()
+                if position*100//max(size, 1) != last_progress:
+                    last_progress = position*100//max(size, 1)
+                    callback(size, position)
+
+        return etree.ElementTree(parser.root)
+
     def is_bw1(self):
         return not self.bw2
 
@@ -333,8 +515,18 @@ class BattalionLevelFile(object):
         for obj in objects:
             assert not obj.deleted
 
-        for k, v in self.objects.items():
-            v.delete_references(objects)
+        deleted = set(objects)
+        referrers = set()
+        for obj in objects:
+            referrers.update(obj._referenced_by)
+            obj._referenced_by.clear()
+
+            for ref in obj.references:
+                if isinstance(ref, BattalionObject):
+                    ref._referenced_by.discard(obj)
+
+        for referrer in referrers - deleted:
+            referrer.delete_references(deleted)
 
         for obj in objects:
             if obj.id in self.objects:
@@ -343,19 +535,12 @@ class BattalionLevelFile(object):
                 del self.objects_with_positions[obj.id]
             if obj.type in self._categories and obj.id in self._categories[obj.type]:
                 del self._categories[obj.type][obj.id]
+            if self._node_objects.get(id(obj._node)) is obj:
+                del self._node_objects[id(obj._node)]
 
-        deleted_refs = set(obj.id for obj in objects)
-        newroot = etree.Element("Instances")
-
-        for node in self._root:
-            if node.tag == "Object":
-                if node.attrib["id"] not in deleted_refs:
-                    newroot.append(node)
-            else:
-                newroot.append(node)
-
-        self._tree._setroot(newroot)
-        self._root = self._tree.getroot()
+        self.mark_changed()
+        deleted_nodes = set(obj._node for obj in objects)
+        self._root[:] = [node for node in self._root if node not in deleted_nodes]
 
     def sort_nodes(self):
         nodes = []
@@ -378,6 +563,11 @@ class BattalionLevelFile(object):
         for bwobject in self.objects.values():
             bwobject.updatemodelname()
 
+    def mark_changed(self):
+        # Objects call this when they are changed, the editor also calls it after edits that change
+        # objects in place, like moving them
+        self.version += 1
+
     def add_object_new(self, bwobject):
         self.add_object(bwobject)
         self._root.append(bwobject._node)
@@ -387,6 +577,8 @@ class BattalionLevelFile(object):
             raise ObjectIDAlreadyExists()
 
         self.objects[bwobject.id] = bwobject
+        self._node_objects[id(bwobject._node)] = bwobject
+        self.mark_changed()
         hasposition = hasattr(bwobject, "spawnMatrix") or hasattr(bwobject, "Mat") or hasattr(bwobject, "mMatrix")
         if hasposition:
             self.objects_with_positions[bwobject.id] = bwobject
@@ -398,9 +590,95 @@ class BattalionLevelFile(object):
             self._categories[bwobject.type] = {}
             self._categories[bwobject.type][bwobject.id] = bwobject
 
+    def snapshot(self):
+        # Only looks up cached serializations. Objects that changed since they were last written or
+        # searched are kept in the snapshot and serialized when it is written.
+        root = self._root
+        shell = etree.Element(root.tag, root.attrib)
+        shell.text = root.text
+        shell.tail = root.tail
+        etree.SubElement(shell, "_")
+        head, tail = etree.tostring(shell, encoding="utf-8", short_empty_elements=False).split(b"<_></_>")
+
+        node_objects = self._node_objects
+
+        texts = []
+        for node in root:
+            bwobject = node_objects.get(id(node))
+            if bwobject is not None:
+                text = bwobject.cached_text()
+                texts.append(bwobject if text is None else text)
+            else:
+                texts.append(etree.tostring(node, encoding="unicode", short_empty_elements=False))
+
+        return LevelSnapshot(head, texts, tail)
+
+    def warm_text_cache(self, stop=None):
+        # Serializes every object ahead of time. Runs on a worker thread after a level is loaded so that
+        # the first save or search only has to serialize the objects that were changed in the meantime.
+        # stop is a threading.Event that ends it early.
+        for bwobject in list(self.objects.values()):
+            if stop is not None and stop.is_set():
+                return
+            try:
+                bwobject.tostring_cached()
+            except Exception as err:
+                print("Couldn't serialize object", bwobject.id, "in the background:", err)
+
     def write(self, f):
+        # Gives the same output as writing the whole tree
+        self.snapshot().write(f)
+
+    def save(self, path, padding=None):
+        return self.snapshot().save(path, padding)
+
+
+class LevelSnapshot(object):
+    # Serialized XML of a level file at one point in time so it can be written on another thread
+    # while the level is edited. Objects that weren't cached yet are serialized as they are when
+    # the snapshot is written.
+    def __init__(self, head, texts, tail):
+        self.head = head
+        self.texts = texts
+        self.tail = tail
+
+    def write(self, f, callback=None):
         f.write(b"<?xml version=\"1.0\" encoding=\"utf-8\"?>\n")
-        self._tree.write(f, encoding="utf-8", short_empty_elements=False)
+        f.write(self.head)
+        for i, text in enumerate(self.texts):
+            if not isinstance(text, str):
+                text = text.serialized_cached()
+            f.write(text.encode("utf-8"))
+            if callback is not None and i % 1000 == 0:
+                callback(len(self.texts), i)
+        f.write(self.tail)
+
+    def save(self, path, padding=None, callback=None):
+        # Streams the XML into a temporary file next to path that then replaces it. Uncompressed files
+        # are padded with spaces up to padding. Returns the size of the XML without padding.
+        dirpath = os.path.dirname(os.path.abspath(path))
+        fd, tmppath = tempfile.mkstemp(dir=dirpath, prefix=os.path.basename(path), suffix=".tmp")
+        try:
+            if os.path.exists(path):
+                shutil.copymode(path, tmppath)
+            with open(fd, "wb") as f:
+                if path.endswith(".gz"):
+                    with gzip.GzipFile(filename=os.path.basename(path), mode="wb", fileobj=f) as g:
+                        self.write(g, callback)
+                    size = g.size
+                else:
+                    self.write(f, callback)
+                    size = f.tell()
+                    if padding is not None and size < padding:
+                        f.write(b" "*(padding - size))
+
+            os.replace(tmppath, path)
+        except:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+        return size
 
 
 class BattalionFilePaths(object):
@@ -537,7 +815,72 @@ class BattalionFilePaths(object):
         self.dirty = False
 
 
+PLAIN_FIELD_TYPES = {int, float, str, bool, type(None)}
+
+
+def field_state(value):
+    cls = value.__class__
+    if cls in PLAIN_FIELD_TYPES:
+        return value
+    elif cls is list or cls is PointerList:
+        return tuple([field_state(val) for val in value])
+    elif cls is BWMatrix:
+        return value.mtx.tobytes()
+    elif cls is Vector4:
+        return value.x, value.y, value.z, value.w
+    elif cls is BattalionObject:
+        return value.id
+    else:
+        return value
+
+
+class PointerList(list):
+    # Value of a pointer field with several elements. Objects put into it are added to the reverse
+    # reference index, the same as with a single pointer assigned through BattalionObject.__setattr__.
+    _owner = None
+
+    def __init__(self, owner, values=()):
+        super().__init__(values)
+        self._owner = owner
+        self._add_references(self)
+
+    def _add_references(self, values):
+        if self._owner is not None:
+            for value in values:
+                if isinstance(value, BattalionObject):
+                    value.add_reference(self._owner)
+            self._owner.touch()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            super().__setitem__(index, value)
+            self._add_references(value)
+        else:
+            super().__setitem__(index, value)
+            self._add_references((value, ))
+
+    def append(self, value):
+        super().append(value)
+        self._add_references((value, ))
+
+    def insert(self, index, value):
+        super().insert(index, value)
+        self._add_references((value, ))
+
+    def extend(self, values):
+        values = list(values)
+        super().extend(values)
+        self._add_references(values)
+
+
 class BattalionObject(object):
+    # Names of the Pointer and Resource fields, set from the XML node
+    _pointer_fields = frozenset()
+    # Names of all fields and of the fields whose values can be changed in place (matrices, vectors, lists)
+    _field_names = frozenset()
+    _inplace_fields = ()
+
     def __init__(self, level: BattalionLevelFile, node: etree.Element):
         self._node: etree.Element = node
         self._level = level
@@ -548,6 +891,8 @@ class BattalionObject(object):
         self.lua_name = ""
 
         self._referenced_by = set()
+        self._text_cache = None
+        self._version = 0
 
         self.update_object_from_xml(self._node)
 
@@ -563,6 +908,11 @@ class BattalionObject(object):
         while self.id in level.objects or self.id in preload.objects:
             self._node.attrib["id"] = str(int(self.id)+7)
 
+        # Pointers to this object are written with its id
+        self.touch()
+        for referrer in self._referenced_by:
+            referrer.touch()
+
     def delete(self):
         self._custom_name = "DELETED"
         self.deleted = True
@@ -570,6 +920,25 @@ class BattalionObject(object):
     def add_reference(self, obj):
         self._referenced_by.add(obj)
 
+    def touch(self):
+        # Marks the object as changed so that it is serialized again. Assigning a field does this,
+        # code that changes the node's attributes has to call it.
+        self._version += 1
+        if self._level is not None:
+            self._level.mark_changed()
+
+    def __setattr__(self, name, value):
+        # Assigning a pointer field records this object as a referrer of the objects it points to,
+        # so delete_objects finds every pointer no matter where it was set
+        if name in self._pointer_fields:
+            if isinstance(value, list):
+                value = PointerList(self, value)
+            elif isinstance(value, BattalionObject):
+                value.add_reference(self)
+        object.__setattr__(self, name, value)
+        if name in self._field_names:
+            self.touch()
+
     def set_mtx_override(self, values):
         if values is None:
             self.mtxoverride = None
@@ -577,24 +946,19 @@ class BattalionObject(object):
             self.mtxoverride = array(values, dtype=float32)
 
     def delete_references(self, references):
+        # references is a set of objects, pointers to them are set to None in the object and its XML node
         for attr_node in self._node:
             if attr_node.tag in ("Pointer", "Resource"):
                 fieldname = attr_node.attrib["name"]
-                pointers = [subnode.text for subnode in attr_node]
-                if len(pointers) == 1:
-                    for ref in references:
-                        obj = getattr(self, fieldname)
-                        if obj == ref or (obj is not None and obj.deleted):
-                            setattr(self, fieldname, None)
-                            break
-                elif len(pointers) > 1:
-                    ptrlist = getattr(self, fieldname)
-                    for i in range(len(ptrlist)):
-                        obj = ptrlist[i]
-                        for ref in references:
-                            if obj == ref or (obj is not None and obj.deleted):
-                                ptrlist[i] = None
-        self.update_xml()
+                value = getattr(self, fieldname)
+                if isinstance(value, list):
+                    for i, obj in enumerate(value):
+                        if obj is not None and (obj in references or obj.deleted):
+                            value[i] = None
+                            attr_node[i].text = "0"
+                elif value is not None and (value in references or value.deleted):
+                    setattr(self, fieldname, None)
+                    attr_node[0].text = "0"
 
     def check_correctness(self, node, level, other):
         ownattrs = set(x.attrib["name"] for x in self._node)
@@ -622,24 +986,34 @@ class BattalionObject(object):
                                                                                         attr_node.attrib["name"]))
 
     def update_object_from_xml(self, node):
+        fields = {}
+        pointer_fields = set()
+        inplace_fields = []
         for attr_node in node:
+            attrib = attr_node.attrib
             if attr_node.tag in ("Pointer", "Resource"):
-                elementcount = int(attr_node.attrib["elements"])
+                pointer_fields.add(attrib["name"])
+                elementcount = int(attrib["elements"])
                 if elementcount == 1:
-                    setattr(self, attr_node.attrib["name"], PointerPlaceholder(attr_node[0].text))
+                    fields[attrib["name"]] = PointerPlaceholder(attr_node[0].text)
                 else:
-                    setattr(self, attr_node.attrib["name"], [PointerPlaceholder(subnode.text for subnode in attr_node)])
+                    fields[attrib["name"]] = [PointerPlaceholder(subnode.text for subnode in attr_node)]
             else:
-                elementcount = int(attr_node.attrib["elements"])
+                elementcount = int(attrib["elements"])
+                valuetype = attrib["type"]
                 if elementcount == 1:
-                    setattr(self,
-                            attr_node.attrib["name"],
-                            convert_from(attr_node.attrib["type"], attr_node[0].text))
+                    fields[attrib["name"]] = convert_from(valuetype, attr_node[0].text)
+                    if fields[attrib["name"]].__class__ not in PLAIN_FIELD_TYPES:
+                        inplace_fields.append(attrib["name"])
                 else:
-                    setattr(self,
-                            attr_node.attrib["name"],
-                            [convert_from(attr_node.attrib["type"], subnode.text) for subnode in attr_node])
+                    fields[attrib["name"]] = [convert_from(valuetype, subnode.text) for subnode in attr_node]
+                    inplace_fields.append(attrib["name"])
                 #self._attributes[attr_node.attrib["name"]] = Attribute.from_node(attr_node, self._level)
+        self.__dict__.update(fields)
+        self.__dict__["_pointer_fields"] = frozenset(pointer_fields)
+        self.__dict__["_field_names"] = frozenset(fields)
+        self.__dict__["_inplace_fields"] = tuple(inplace_fields)
+        self.touch()
 
         if hasattr(self, "Mat"):
             #setattr(self, "getmatrix", lambda: self.Mat)
@@ -702,10 +1076,8 @@ class BattalionObject(object):
                                 )
                             else:
                                 obj = other.objects[subnode.text]
-                                obj.add_reference(self)
                         else:
                             obj = level.objects[subnode.text]
-                            obj.add_reference(self)
                         result.append(obj)
 
                 if elementcount == 1:
@@ -896,6 +1268,7 @@ class BattalionObject(object):
             obj._node.attrib["customName"] = xmlnode.attrib["customName"]
         elif "customName" in obj._node.attrib:
             del obj._node.attrib["customName"]
+        obj.touch()
         return obj
 
     def clone_object(self, level_data, preload_data) -> "BattalionObject":
@@ -921,6 +1294,7 @@ class BattalionObject(object):
             self._node.attrib["customName"] = xmlnode.attrib["customName"]
         elif "customName" in self._node.attrib:
             del self._node.attrib["customName"]
+        self.touch()
 
     @property
     def modelname(self):
@@ -958,6 +1332,7 @@ class BattalionObject(object):
             del self._node.attrib["customName"]
         else:
             self._node.attrib["customName"] = customname
+        self.touch()
 
     @property
     def id(self):
@@ -1045,38 +1420,58 @@ class BattalionObject(object):
         else:
             return extradetail
 
-    def calculate_height(self, bwterrain, waterheight):
+    def terrain_height_position(self):
+        # Returns the x and z position calculate_height looks the terrain height up at,
+        # None if the height of the object doesn't depend on the terrain
         currbwmtx = self.getmatrix()
         if currbwmtx is None:
             return None
 
-
-        currmtx = currbwmtx.mtx
-        h = currmtx[13]
-
         if self.type in ("cMapZone", ):
-            return h
+            return None
         #elif self.type == "cObjectiveMarker":
         #    if self.
 
-        originalh = h
-        locktosurface = False
-        sticktofloor = False
-
         if hasattr(self, "mStickToFloor"):
             if not self.mStickToFloor:
-                return h
-            else:
-                sticktofloor = True
+                return None
 
+        currmtx = currbwmtx.mtx
         if hasattr(self, "mLockToSurface"):
             if not self.mLockToSurface:
-                return h
+                return None
             else:
                 currmtx = self.spawnMatrix.mtx
-                locktosurface = True
 
-        height = bwterrain.check_height(currmtx[12], currmtx[14])
+        return currmtx[12], currmtx[14]
+
+    def calculate_height(self, bwterrain, waterheight):
+        position = self.terrain_height_position()
+        if position is None:
+            height = None
+        else:
+            height = bwterrain.check_height(*position)
+
+        return self.calculate_height_from_terrain(height, waterheight)
+
+    def calculate_height_from_terrain(self, height, waterheight):
+        # Same as calculate_height with the terrain height at terrain_height_position
+        # already looked up, height is None if there is no terrain there
+        currbwmtx = self.getmatrix()
+        if currbwmtx is None:
+            return None
+
+        currmtx = currbwmtx.mtx
+        h = currmtx[13]
+
+        if self.terrain_height_position() is None:
+            return h
+
+        originalh = h
+        locktosurface = hasattr(self, "mLockToSurface")
+        sticktofloor = hasattr(self, "mStickToFloor")
+        if locktosurface:
+            currmtx = self.spawnMatrix.mtx
 
         if height is None:
             if waterheight is not None and not sticktofloor:  # StickToFloor: Water height is ignored
@@ -1104,6 +1499,36 @@ class BattalionObject(object):
         self.update_xml()
         return etree.tostring(self._node, encoding="unicode", short_empty_elements=False)
 
+    def inplace_state(self):
+        # Values of the matrices, vectors and lists. They are changed in place from many places
+        # so they are compared, every other change to the object increases its version.
+        return [field_state(self.__dict__[name]) for name in self._inplace_fields]
+
+    def cached_text(self):
+        # Returns the serialized object if it didn't change since it was last serialized, otherwise None
+        cache = self._text_cache
+        if (cache is not None and cache[0] == self._version
+                and (not self._inplace_fields or cache[1] == self.inplace_state())):
+            return cache[2]
+        return None
+
+    def serialized_cached(self):
+        # Returns the serialized object, serializing again only if something changed
+        text = self.cached_text()
+        if text is None:
+            version, state = self._version, self.inplace_state()
+            text = self.tostring()
+            self._text_cache = [version, state, text, None]
+        return text
+
+    def tostring_cached(self):
+        # Returns the serialized object and its lowercase version
+        text = self.serialized_cached()
+        cache = self._text_cache
+        if cache[3] is None:
+            cache[3] = text.lower()
+        return text, cache[3]
+
     def fields(self) -> typing.Iterable[typing.Tuple[str, str, str, int]]:
         for attr_node in self._node:
             yield attr_node.tag, attr_node.attrib["name"], attr_node.attrib["type"], int(attr_node.attrib["elements"])
@@ -3,7 +3,7 @@ from OpenGL.GL import *
 from .model_rendering import BW1Model, BW2Model
 from .bw_archive import BWArchive
 from .texture import TextureArchive
-from lib.render.model_renderingv2 import BWModelV2
+from lib.render.model_renderingv2 import BWModelV2, ModelBatch
 from lib.lua.bwarchivelib import BattalionArchive
 from io import BytesIO
 
@@ -11,8 +11,12 @@ from io import BytesIO
 class BWModelHandler(object):
     def __init__(self):
         self.models = {}
+        # Only made by get_instance_model when models are drawn without the batch
         self.instancemodels = {}
         self.textures: TextureArchive = None
+        self.batch: ModelBatch = None
+        self.batch_dirty = False
+        self._batch_supported = None
 
     @classmethod
     def from_archive(cls, bwarc, callback=None):
@@ -30,11 +34,10 @@ class BWModelHandler(object):
             # data = modeldata.entries[0]
             # data.fileobj.seek(0)
             # f = data.fileobj
-            f = BytesIO(modeldata.data[8:])
+            f = BytesIO(modeldata.data_view()[8:])
             model.from_file(f)
             texmodel = model.make_textured_model(bwmodels.textures)
             bwmodels.models[name] = texmodel  # model
-            bwmodels.instancemodels[name] = BWModelV2.from_textured_bw_model(texmodel)
             if callback is not None: callback(len(models), i)
         return bwmodels
 
@@ -45,6 +48,7 @@ class BWModelHandler(object):
 
     def update_models(self, bwarc, force_update_models=[], force_update_textures=[]):
         self.textures.update_textures(bwarc, force_update_textures)
+        self.batch_dirty = True
 
         for i, modeldata in enumerate(bwarc.models()):
             name = modeldata.name#str(modeldata.res_name, encoding="ascii")
@@ -57,11 +61,36 @@ class BWModelHandler(object):
                 #data = modeldata.entries[0]
                 #data.fileobj.seek(0)
                 #f = data.fileobj
-                f = BytesIO(modeldata.data[8:])
+                f = BytesIO(modeldata.data_view()[8:])
                 model.from_file(f)
                 texmodel = model.make_textured_model(self.textures)
                 self.models[name] = texmodel#model
-                self.instancemodels[name] = BWModelV2.from_textured_bw_model(texmodel)
+                self.instancemodels.pop(name, None)
+
+    def get_instance_model(self, name):
+        if name not in self.models:
+            return None
+        if name not in self.instancemodels:
+            self.instancemodels[name] = BWModelV2.from_textured_bw_model(self.models[name])
+        return self.instancemodels[name]
+
+    def get_batch(self):
+        # All models in one batch, made when it's first needed and again after the models changed.
+        # Returns None if the OpenGL version doesn't support indirect drawing.
+        if self._batch_supported is None:
+            self._batch_supported = ModelBatch.supported()
+            if not self._batch_supported:
+                print("Indirect drawing isn't supported, models are drawn one by one")
+        if not self._batch_supported:
+            return None
+
+        if self.batch is not None and self.batch_dirty:
+            self.batch.free()
+            self.batch = None
+        if self.batch is None:
+            self.batch = ModelBatch.from_models(self.models, self.textures)
+            self.batch_dirty = False
+        return self.batch
 
     def rendermodel(self, name, mtx, bwterrain, offset):
         """pos = bwmatrix.position
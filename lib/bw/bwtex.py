@@ -98,6 +98,14 @@ class Texture(object):
 
         return tex
 
+    @classmethod
+    def from_rgba(cls, name, mips):
+        # mips is a list of (width, height, rgba data) for each mip level
+        tex = cls(name)
+        tex.mipmaps = [Image.frombytes("RGBA", (width, height), rgba) for width, height, rgba in mips]
+
+        return tex
+
     def dump_to_file(self, filepath):
         self.mipmaps[0].save(filepath, "PNG")
 
@@ -328,7 +336,7 @@ class BW2Texture(Texture):
         
         #tex.mipmaps.append(f.read(size))
 
-        imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
+        imagedata = f.read(size)
         
         #assert size == len(imagedata.getbuffer())
         mip = decode_image(
@@ -346,7 +354,7 @@ class BW2Texture(Texture):
                 section = read_id(f)
                 size = read_uint32_le(f)
                 assert section == MIP
-                imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
+                imagedata = f.read(size)
                 mip_tex_x = max(tex.size_x//(2**(i+1)), 1)
                 mip_tex_y = max(tex.size_y//(2**(i+1)), 1)
                 #print(tex.size_x, mip_tex_x, tex.size_y, mip_tex_y)
@@ -564,7 +572,7 @@ class BW1Texture(Texture):
             assert section == MIP
  
         #tex.mipmaps.append(f.read(size))
-        imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
+        imagedata = f.read(size)
         
         #assert size == len(imagedata.getbuffer())
         #print(FORMAT[tex.fmt], hex(size), tex.size_x, tex.size_y)
@@ -583,7 +591,7 @@ class BW1Texture(Texture):
                 section = read_id(f)
                 size = read_uint32_le(f)
                 assert section == MIP
-                imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
+                imagedata = f.read(size)
                 mip_tex_x = max(tex.size_x//(2**(i+1)), 1)
                 mip_tex_y = max(tex.size_y//(2**(i+1)), 1)
                 #print(tex.size_x, mip_tex_x, tex.size_y, mip_tex_y)
@@ -592,4 +600,17 @@ class BW1Texture(Texture):
                             mip_tex_x, mip_tex_y
                             )
                 tex.mipmaps.append(mip)
-        return tex
\ No newline at end of file
+        return tex
+
+
+def decode_texture(name, data, is_bw1):
+    # Runs in a texture decode pool worker. Apart from the bw_editor.py launcher the worker only
+    # imports this module. All mip levels are sent back as raw RGBA so that the GL thread only
+    # has to upload them.
+    f = BytesIO(data)
+    if is_bw1:
+        tex = BW1Texture.from_file(name, f)
+    else:
+        tex = BW2Texture.from_file(name, f)
+
+    return [(mip.width, mip.height, mip.convert("RGBA").tobytes()) for mip in tex.mipmaps]
@@ -314,6 +314,7 @@ class BW2Model(Model):
 
         model.mesh_list.extend(alltextures.values())
         model.set_boundsphere(center_x, center_y, center_z, radius)
+        model.compact()
         return model
 
     def export_obj(self, outputpath, texturearchive):
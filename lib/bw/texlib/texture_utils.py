@@ -4,6 +4,9 @@ from io import BytesIO
 import colorsys
 from enum import Enum
 import operator
+from math import ceil
+
+import numpy
 
 from .fs_helpers import *
 
@@ -604,37 +607,207 @@ def encode_palette(encoded_colors, palette_format, image_format):
 
 
 def decode_image(image_data, palette_data, image_format, palette_format, num_colors, image_width, image_height):
-  colors = decode_palettes(palette_data, palette_format, num_colors, image_format)
+  rgba = decode_image_rgba(
+    image_data, palette_data, image_format, palette_format, num_colors,
+    image_width, image_height
+  )
+  return Image.frombuffer("RGBA", (image_width, image_height), rgba, "raw", "RGBA", 0, 1)
+
+# Bump this whenever the decoded output changes so that cached textures get decoded again.
+TEXTURE_DECODER_VERSION = 2
+
+# Batched counterpart to decode_image/decode_block: decodes a whole mip level with
+# numpy array operations and returns the pixels as a (height, width, 4) uint8 array.
+# The result matches the per-block decoder byte for byte. Palette indexes that point
+# past the end of the palette decode as fully transparent black.
+def decode_image_rgba(image_data, palette_data, image_format, palette_format, num_colors, image_width, image_height):
+  if not isinstance(image_format, ImageFormat):
+    raise Exception("Invalid image format: %s" % image_format)
+  if image_format not in ARRAY_BLOCK_DECODERS:
+    raise Exception("Unknown image format: %s" % image_format.name)
   
   block_width = BLOCK_WIDTHS[image_format]
   block_height = BLOCK_HEIGHTS[image_format]
   block_data_size = BLOCK_DATA_SIZES[image_format]
+  blocks_x = ceil(image_width/block_width)
+  blocks_y = ceil(image_height/block_height)
   
-  image = Image.new("RGBA", (image_width, image_height), (0, 0, 0, 0))
-  pixels = image.load()
-  offset = 0
-  block_x = 0
-  block_y = 0
-  while block_y < image_height:
-    pixel_color_data = decode_block(image_format, image_data, offset, block_data_size, colors)
-    
-    for i, color in enumerate(pixel_color_data):
-      x_in_block = i % block_width
-      y_in_block = i // block_width
-      x = block_x+x_in_block
-      y = block_y+y_in_block
-      if x >= image_width or y >= image_height:
-        continue
-      
-      pixels[x,y] = color
-    
-    offset += block_data_size
-    block_x += block_width
-    if block_x >= image_width:
-      block_x = 0
-      block_y += block_height
+  if isinstance(image_data, (bytes, bytearray, memoryview)):
+    raw = numpy.frombuffer(image_data, dtype=numpy.uint8)
+  else:
+    raw = numpy.frombuffer(read_all_bytes(image_data), dtype=numpy.uint8)
   
-  return image
+  size = blocks_x*blocks_y*block_data_size
+  if len(raw) < size:
+    # Blocks past the end of the data decode as if they were zero-filled
+    raw = numpy.concatenate((raw, numpy.zeros(size-len(raw), dtype=numpy.uint8)))
+  blocks = raw[:size].reshape(blocks_x*blocks_y, block_data_size)
+  
+  if image_format in IMAGE_FORMATS_THAT_USE_PALETTES:
+    colors = decode_palettes_array(palette_data, palette_format, num_colors, MAX_COLORS_FOR_IMAGE_FORMAT[image_format])
+  else:
+    colors = None
+  
+  # Pixels of every block in row-major order within the block
+  pixel_color_data = ARRAY_BLOCK_DECODERS[image_format](blocks, colors)
+  
+  # Untile: (block row, block column, y in block, x in block) -> (y, x)
+  pixels = pixel_color_data.reshape(blocks_y, blocks_x, block_height, block_width, 4)
+  pixels = pixels.transpose(0, 2, 1, 3, 4).reshape(blocks_y*block_height, blocks_x*block_width, 4)
+  
+  return numpy.ascontiguousarray(pixels[:image_height, :image_width])
+
+def read_u16_array(raw):
+  return (raw[..., 0::2].astype(numpy.uint16) << 8) | raw[..., 1::2]
+
+def unpack_nibbles_array(raw):
+  nibbles = numpy.empty(raw.shape[:-1] + (raw.shape[-1]*2,), dtype=numpy.uint8)
+  nibbles[..., 0::2] = raw >> 4
+  nibbles[..., 1::2] = raw & 0xF
+  return nibbles
+
+def make_rgba_array(r, g, b, a):
+  return numpy.stack((r, g, b, a), axis=-1).astype(numpy.uint8)
+
+def convert_rgb565_array_to_colors(rgb565):
+  r = (rgb565 >> 11) & 0x1F
+  g = (rgb565 >> 5) & 0x3F
+  b = (rgb565 >> 0) & 0x1F
+  r = swizzle_5_bit_to_8_bit(r)
+  g = swizzle_6_bit_to_8_bit(g)
+  b = swizzle_5_bit_to_8_bit(b)
+  return make_rgba_array(r, g, b, numpy.full_like(r, 255))
+
+def convert_rgb5a3_array_to_colors(rgb5a3):
+  # See convert_rgb5a3_to_color for the layout of both variants.
+  opaque = (rgb5a3 & 0x8000) != 0
+  r = numpy.where(
+    opaque,
+    swizzle_5_bit_to_8_bit((rgb5a3 >> 10) & 0x1F),
+    swizzle_4_bit_to_8_bit((rgb5a3 >> 8) & 0xF)
+  )
+  g = numpy.where(
+    opaque,
+    swizzle_5_bit_to_8_bit((rgb5a3 >> 5) & 0x1F),
+    swizzle_4_bit_to_8_bit((rgb5a3 >> 4) & 0xF)
+  )
+  b = numpy.where(
+    opaque,
+    swizzle_5_bit_to_8_bit((rgb5a3 >> 0) & 0x1F),
+    swizzle_4_bit_to_8_bit((rgb5a3 >> 0) & 0xF)
+  )
+  a = numpy.where(opaque, 255, swizzle_3_bit_to_8_bit((rgb5a3 >> 12) & 0x7))
+  return make_rgba_array(r, g, b, a)
+
+def convert_ia8_array_to_colors(ia8):
+  i = ia8 & 0xFF
+  a = (ia8 >> 8) & 0xFF
+  return make_rgba_array(i, i, i, a)
+
+def decode_palettes_array(palette_data, palette_format, num_colors, max_colors):
+  # Returns a lookup table with max_colors entries so that every index a block
+  # can hold is valid. Entries past num_colors are transparent black.
+  colors = numpy.zeros((max(max_colors, num_colors), 4), dtype=numpy.uint8)
+  if num_colors == 0:
+    return colors
+  
+  if isinstance(palette_data, (bytes, bytearray, memoryview)):
+    raw = numpy.frombuffer(palette_data, dtype=numpy.uint8)
+  else:
+    raw = numpy.frombuffer(read_all_bytes(palette_data), dtype=numpy.uint8)
+  raw_colors = read_u16_array(raw[:num_colors*2])
+  
+  if palette_format == PaletteFormat.IA8:
+    colors[:num_colors] = convert_ia8_array_to_colors(raw_colors)
+  elif palette_format == PaletteFormat.RGB565:
+    colors[:num_colors] = convert_rgb565_array_to_colors(raw_colors)
+  elif palette_format == PaletteFormat.RGB5A3:
+    colors[:num_colors] = convert_rgb5a3_array_to_colors(raw_colors)
+  
+  return colors
+
+def decode_i4_blocks(blocks, colors):
+  i = swizzle_4_bit_to_8_bit(unpack_nibbles_array(blocks))
+  return make_rgba_array(i, i, i, i)
+
+def decode_i8_blocks(blocks, colors):
+  return make_rgba_array(blocks, blocks, blocks, blocks)
+
+def decode_ia4_blocks(blocks, colors):
+  i = swizzle_4_bit_to_8_bit(blocks & 0xF)
+  a = swizzle_4_bit_to_8_bit(blocks >> 4)
+  return make_rgba_array(i, i, i, a)
+
+def decode_ia8_blocks(blocks, colors):
+  return convert_ia8_array_to_colors(read_u16_array(blocks))
+
+def decode_rgb565_blocks(blocks, colors):
+  return convert_rgb565_array_to_colors(read_u16_array(blocks))
+
+def decode_rgb5a3_blocks(blocks, colors):
+  return convert_rgb5a3_array_to_colors(read_u16_array(blocks))
+
+def decode_rgba32_blocks(blocks, colors):
+  ar = blocks[:, 0:32]
+  gb = blocks[:, 32:64]
+  return make_rgba_array(ar[:, 1::2], gb[:, 0::2], gb[:, 1::2], ar[:, 0::2])
+
+def decode_c4_blocks(blocks, colors):
+  return colors[unpack_nibbles_array(blocks)]
+
+def decode_c8_blocks(blocks, colors):
+  return colors[blocks]
+
+def decode_c14x2_blocks(blocks, colors):
+  return colors[read_u16_array(blocks) & 0x3FFF]
+
+def decode_cmpr_blocks(blocks, colors):
+  # Each 8x8 block holds four 4x4 DXT1 subblocks of 8 bytes each
+  num_blocks = blocks.shape[0]
+  subblocks = blocks.reshape(num_blocks, 4, 8)
+  
+  color_0_rgb565 = read_u16_array(subblocks[:, :, 0:2])[..., 0]
+  color_1_rgb565 = read_u16_array(subblocks[:, :, 2:4])[..., 0]
+  color_0 = convert_rgb565_array_to_colors(color_0_rgb565).astype(numpy.uint16)
+  color_1 = convert_rgb565_array_to_colors(color_1_rgb565).astype(numpy.uint16)
+  
+  # Same interpolation as get_interpolated_cmpr_colors
+  four_colors = (color_0_rgb565 > color_1_rgb565)[..., None]
+  color_2 = numpy.where(four_colors, (2*color_0 + color_1)//3, color_0//2 + color_1//2)
+  color_3 = numpy.where(four_colors, (color_0 + 2*color_1)//3, 0)
+  color_2[..., 3] = 255
+  color_3[..., 3] = numpy.where(four_colors[..., 0], 255, 0)
+  palettes = numpy.stack((color_0, color_1, color_2, color_3), axis=2).astype(numpy.uint8)
+  
+  index_bytes = subblocks[:, :, 4:8]
+  color_indexes = numpy.stack((
+    index_bytes >> 6,
+    (index_bytes >> 4) & 3,
+    (index_bytes >> 2) & 3,
+    index_bytes & 3,
+  ), axis=-1).reshape(num_blocks, 4, 16)
+  
+  pixel_color_data = numpy.take_along_axis(
+    palettes, color_indexes[..., None].astype(numpy.intp), axis=2
+  )
+  
+  # (subblock y, subblock x, y in subblock, x in subblock) -> (y in block, x in block)
+  pixel_color_data = pixel_color_data.reshape(num_blocks, 2, 2, 4, 4, 4).transpose(0, 1, 3, 2, 4, 5)
+  return pixel_color_data.reshape(num_blocks, 64, 4)
+
+ARRAY_BLOCK_DECODERS = {
+  ImageFormat.I4    : decode_i4_blocks,
+  ImageFormat.I8    : decode_i8_blocks,
+  ImageFormat.IA4   : decode_ia4_blocks,
+  ImageFormat.IA8   : decode_ia8_blocks,
+  ImageFormat.RGB565: decode_rgb565_blocks,
+  ImageFormat.RGB5A3: decode_rgb5a3_blocks,
+  ImageFormat.RGBA32: decode_rgba32_blocks,
+  ImageFormat.C4    : decode_c4_blocks,
+  ImageFormat.C8    : decode_c8_blocks,
+  ImageFormat.C14X2 : decode_c14x2_blocks,
+  ImageFormat.CMPR  : decode_cmpr_blocks,
+}
 
 def decode_block(image_format, image_data, offset, block_data_size, colors):
   if image_format == ImageFormat.I4:
@@ -1,12 +1,14 @@
 import os
 import sys
+import time
+import hashlib
 import multiprocessing as mp
 
 from lib.lua.bwarchivelib import BattalionArchive
 from OpenGL.GL import *
 from io import BytesIO
 from array import array
-from struct import Struct
+from struct import Struct, error as StructError
 from PIL import Image
 
 
@@ -15,29 +17,164 @@ from math import ceil, floor
 from timeit import default_timer
 
 from .read_binary import *
-from lib.bw.bwtex import Texture, BW1Texture, BW2Texture
+from lib.bw.bwtex import Texture, BW1Texture, BW2Texture, decode_texture
+from lib.bw.texlib.texture_utils import TEXTURE_DECODER_VERSION
+
+
+TEXTURE_CACHE_SIZE_LIMIT = 1024*1024*1024
+TEXTURE_DECODE_WORKERS = 4
+
+
+_decode_pool = None
+
+
+def get_decode_pool():
+    # One pool of worker processes shared by all texture archives. The workers are spawned rather
+    # than forked because the editor has other threads running while a level loads, and a forked
+    # child can deadlock on locks those threads held. A spawned worker imports the main script
+    # again, which is why bw_editor.py only launches the editor from level_editor.
+    global _decode_pool
+    if _decode_pool is None:
+        workers = max(1, min((os.cpu_count() or 1) - 1, TEXTURE_DECODE_WORKERS))
+        _decode_pool = mp.get_context("spawn").Pool(workers)
+    return _decode_pool
+
+
+def get_texture_cache_key(texture, is_bw1):
+    # The key covers everything that affects the decoded image, so entries
+    # can never go stale: edited texture data or a newer decoder simply
+    # results in a different key.
+    sha1 = hashlib.sha1()
+    sha1.update(b"BW1" if is_bw1 else b"BW2")
+    sha1.update(TEXTURE_DECODER_VERSION.to_bytes(4, "little"))
+    sha1.update(texture.data_view())
+    return sha1.hexdigest()
+
+
+class TextureCache(object):
+    # Decoded textures stored as raw RGBA so that loading them is a plain file read.
+    # Entry layout: magic, mip count, (width, height) per mip, followed by the pixel data of all mips.
+    # When the cache grows past its size limit the least recently used entries are removed,
+    # using the file modification time which is updated on every access.
+    MAGIC = b"BWTC"
+    EXTENSION = ".rgba"
+    header = Struct("<4sI")
+    mipheader = Struct("<II")
+
+    def __init__(self, folder, size_limit=TEXTURE_CACHE_SIZE_LIMIT):
+        self.folder = folder
+        self.size_limit = size_limit
+        if not os.path.exists(self.folder):
+            os.mkdir(self.folder)
+
+        self.entries = {}
+        for entry in os.scandir(self.folder):
+            if not entry.is_file():
+                continue
+
+            if entry.name.endswith(self.EXTENSION):
+                stat = entry.stat()
+                self.entries[entry.name[:-len(self.EXTENSION)]] = [stat.st_size, stat.st_mtime]
+            elif entry.name.endswith(".png"):
+                # Left over from the old cache that was keyed by texture name
+                try:
+                    os.remove(entry.path)
+                except OSError as err:
+                    print("Couldn't remove old cache file", entry.path, err)
+
+        self.evict()
+
+    def path(self, key):
+        return os.path.join(self.folder, key+self.EXTENSION)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def load(self, name, key):
+        if key not in self.entries:
+            return None
 
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            now = time.time()
+            os.utime(path, (now, now))
+        except OSError as err:
+            print("Couldn't read cached texture", name, err)
+            del self.entries[key]
+            return None
 
-def process(queuein, queueout):
-    while True:
-        tex = queuein.get()
+        try:
+            magic, mipcount = self.header.unpack_from(data, 0)
+            if magic != self.MAGIC or mipcount == 0:
+                raise ValueError("bad header")
+
+            offset = self.header.size
+            sizes = []
+            for i in range(mipcount):
+                sizes.append(self.mipheader.unpack_from(data, offset))
+                offset += self.mipheader.size
+
+            tex = Texture(name)
+            for width, height in sizes:
+                tex.mipmaps.append(Image.frombytes("RGBA", (width, height), data[offset:offset+width*height*4]))
+                offset += width*height*4
+        except (StructError, ValueError) as err:
+            # Truncated or otherwise corrupt entry, the texture gets decoded again
+            print("Invalid cached texture", name, err)
+            self.remove(key)
+            return None
+
+        self.entries[key][1] = now
+        return tex
+
+    def store(self, key, tex: Texture):
+        path = self.path(key)
+        temppath = path+".tmp"
+        try:
+            with open(temppath, "wb") as f:
+                f.write(self.header.pack(self.MAGIC, len(tex.mipmaps)))
+                for mip in tex.mipmaps:
+                    f.write(self.mipheader.pack(mip.width, mip.height))
+                for mip in tex.mipmaps:
+                    f.write(mip.convert("RGBA").tobytes())
+                size = f.tell()
+            os.replace(temppath, path)
+        except OSError as err:
+            print("Couldn't write cached texture", tex.name, err)
+            return
+
+        self.entries[key] = [size, os.stat(path).st_mtime]
+        self.evict()
+
+    def remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError as err:
+            print("Couldn't remove cached texture", key, err)
+        del self.entries[key]
+
+    def evict(self):
+        total = sum(size for size, lastuse in self.entries.values())
+        if total <= self.size_limit:
+            return
+
+        for key in sorted(self.entries, key=lambda x: self.entries[x][1]):
+            total -= self.entries[key][0]
+            self.remove(key)
+            if total <= self.size_limit:
+                break
 
 
 class TextureArchive(object):
     def __init__(self, archive: "BattalionArchive"):
         self.cachefolder = os.path.join(os.path.dirname(sys.argv[0]), "texture_cache")
-        if not os.path.exists(self.cachefolder):
-            os.mkdir(self.cachefolder)
-
-        self.cached_textures = {}
-        for filename in os.listdir(self.cachefolder):
-            if filename.endswith(".png"):
-                self.cached_textures[filename.replace(".png", "")] = True
+        self.cache = TextureCache(self.cachefolder)
 
         self.is_bw1 = archive.textures.is_bw1
 
         self.textures = {}
-        self.texture_decoded_data = {}
         for texture in archive.textures.textures:
             texture.data_ready = False
 
@@ -48,11 +185,14 @@ class TextureArchive(object):
         self.placeholder = Texture("PlaceHolder")
         self.placeholder.create_dummy(64, 64)
 
-        self.texture_queue = mp.Queue()
-        self.result_queue = mp.Queue()
-        self.texture_processor = mp.Process(target=process, args=(self.texture_queue, self.result_queue))
+        # Textures that are being decoded in the background, by cache key
+        self.pending_textures = {}
+        self.decode_textures(
+            [texture for texture in archive.textures.textures
+             if texture.cache_key not in self.cache])
 
     def register_texture(self, texture):
+        texture.cache_key = get_texture_cache_key(texture, self.is_bw1)
         self.textures[texture.name.lower()] = texture
         name = bytes(texture.name, encoding="ascii").lower()
         if self.is_bw1:
@@ -61,33 +201,64 @@ class TextureArchive(object):
             name2 = name.ljust(0x20, b"\x00")
         self.textures[name2] = texture
 
+    def decode_textures(self, textures):
+        # Hands the textures to a pool of worker processes so that decoding
+        # runs on all cores while the rest of the level is loading.
+        if len(textures) == 0:
+            return
+
+        try:
+            pool = get_decode_pool()
+        except Exception as err:
+            print("Couldn't start texture decode pool, textures will be decoded on demand:", err)
+            return
+
+        for texture in textures:
+            self.pending_textures[texture.cache_key] = pool.apply_async(
+                decode_texture, (texture.name, bytes(texture.data_view()), self.is_bw1))
+
+    def get_decoded_texture(self, texname):
+        texture = self.textures[texname]
+        result = self.pending_textures.pop(texture.cache_key, None)
+        if result is not None:
+            try:
+                return Texture.from_rgba(texture.name, result.get())
+            except Exception as err:
+                print("Background decode failed for", texname, err)
+
+        f = BytesIO(texture.data_view())
+        f.seek(0)
+
+        if self.is_bw1:
+            return BW1Texture.from_file(texture.name, f)
+        else:
+            return BW2Texture.from_file(texture.name, f)
+
     def clear_cache(self, textures=tuple()):
+        # Cache entries are keyed by texture content so they never need to be deleted,
+        # the textures only have to be reloaded to pick up changed data.
         for texname in textures:
             texname = texname.lower()
             print("Clearing", texname)
-            if texname in self.cached_textures:
-                os.remove(os.path.join(self.cachefolder, texname+".png"))
-                del self.cached_textures[texname]
-                if texname in self._cached:
-                    tex, ID = self._cached[texname]
-                    tex.loaded = False
+            if texname in self._cached:
+                tex, ID = self._cached[texname]
+                tex.loaded = False
             else:
                 print(texname, "not found")
 
     def update_textures(self, archive: "BattalionArchive", force_update=[]):
         force_update_lower = [x.lower() for x in force_update]
+        updated = []
         for texture in archive.textures.textures:
             lower = texture.name.lower()
             if lower not in self.textures or lower in force_update_lower:
                 texture.data_ready = False
 
-                self.textures[texture.name.lower()] = texture
-                name = bytes(texture.name, encoding="ascii").lower()
-                if self.is_bw1:
-                    name2 = name.ljust(0x10, b"\x00")
-                else:
-                    name2 = name.ljust(0x20, b"\x00")
-                self.textures[name2] = texture
+                self.register_texture(texture)
+                if texture.cache_key not in self.cache:
+                    updated.append(texture)
+
+        self.decode_textures(updated)
 
     def reset(self):
         for name, val in self._cached.items():
@@ -136,28 +307,7 @@ class TextureArchive(object):
             tex.generate_dummy(32, 32)
             tex.loaded = True
         else:
-            print("Loading", texname)
-            if texname in self.cached_textures:
-                print("from cache")
-                tex = Texture.from_png(texname, os.path.join(self.cachefolder, texname+".png"))
-            else:
-                print("from resource")
-                f = BytesIO(self.textures[texname].data)
-                f.seek(0)
-
-                if self.is_bw1:
-                    tex = BW1Texture.from_file(self.textures[texname].name, f, ignoremips=True)
-                else:
-                    tex = BW2Texture.from_file(self.textures[texname].name, f, ignoremips=True)
-
-                tex.dump_to_file(os.path.join(self.cachefolder, texname+".png"))
-                self.cached_textures[texname] = True
-
-            # Hack for mission 5.2: The cave uses a mostly transparent texture that has a rock texture
-            # hidden in the transparent parts. Force the alpha to be fully opaque to render it correctly.
-            if texname == "c1sncave" or texname == "c1snstalactite":
-                texdata = tex.texture
-                texdata.putalpha(255)
+            tex = self.load_image(texname)
             self._cached[texname] = (tex, ID)
             tex.loaded = True
 
@@ -169,6 +319,8 @@ class TextureArchive(object):
             if mipmap:
                 glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
                 glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_BASE_LEVEL, 0)
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, 1000)
             else:
                 glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_BASE_LEVEL, 0)
                 glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, 0)
@@ -180,7 +332,13 @@ class TextureArchive(object):
             size_x, size_y = image.width, image.height
             rgba = image.tobytes()
             glTexImage2D(GL_TEXTURE_2D, 0, 4, size_x, size_y, 0, GL_RGBA, GL_UNSIGNED_BYTE, rgba)# b"\x00"*tex.size_x*tex.size_y*4)#tex.rgba)
-            if mipmap:
+            if mipmap and len(tex.mipmaps) > 1:
+                # The texture's own mip levels, the chain can stop before 1x1
+                for level, mip in enumerate(tex.mipmaps[1:], start=1):
+                    glTexImage2D(GL_TEXTURE_2D, level, 4, mip.width, mip.height, 0, GL_RGBA, GL_UNSIGNED_BYTE,
+                                 mip.convert("RGBA").tobytes())
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, len(tex.mipmaps)-1)
+            elif mipmap:
                 glGenerateMipmap(GL_TEXTURE_2D)
             #glTexImage2D(GL_TEXTURE_2D, 0, 4, tex.size_x, tex.size_y, 0, GL_RGBA, GL_UNSIGNED_BYTE, b"\x7F"*tex.size_x*tex.size_y*4)
             #testsize = 32
@@ -194,6 +352,31 @@ class TextureArchive(object):
             print("loading tex wasn't successful", texname)
             return None
 
+    def load_image(self, texname):
+        # Decoded texture without an OpenGL texture, for when the images are uploaded some other way
+        if texname in self._cached and self._cached[texname][0].loaded:
+            return self._cached[texname][0]
+
+        print("Loading", texname)
+        cache_key = self.textures[texname].cache_key
+        tex = None
+        if cache_key not in self.pending_textures:
+            tex = self.cache.load(texname, cache_key)
+
+        if tex is not None:
+            print("from cache")
+        else:
+            print("from resource")
+            tex = self.get_decoded_texture(texname)
+            self.cache.store(cache_key, tex)
+
+        # Hack for mission 5.2: The cave uses a mostly transparent texture that has a rock texture
+        # hidden in the transparent parts. Force the alpha to be fully opaque to render it correctly.
+        if texname == "c1sncave" or texname == "c1snstalactite":
+            for texdata in tex.mipmaps:
+                texdata.putalpha(255)
+        return tex
+
     def get_texture(self, texname):
         if texname in self._cached:
             #tex, id = self._cached[texname]
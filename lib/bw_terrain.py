@@ -1,8 +1,9 @@
 import timeit
 from dataclasses import dataclass
 from struct import pack, unpack, unpack_from, Struct
-from lib.vectors import Triangle, Vector3, Quad, Line, PlanarQuad
+from lib.vectors import Triangle, Vector3, Quad, Line, PlanarQuad, aabbs_in_frustum
 from OpenGL import *
+import numpy
 from numpy import array, ndarray, zeros
 from math import inf
 
@@ -143,11 +144,12 @@ class AABB(object):
 
 
 class TileModel(object):
-    def __init__(self, tile, materials, offsetx, offsety):
+    def __init__(self, tile, materials, offsetx, offsety, chunk_index=None):
         self.vertices = []
         self.quads = []
         self.material = materials[tile.material_index]
         self.quads_collision = []
+        self.chunk_index = chunk_index
 
         br = tile.surface_coordinates[0]
         bl = tile.surface_coordinates[1]
@@ -234,6 +236,69 @@ class TileModel(object):
             return False
 
 
+# Vertex layout of the terrain render meshes: position (x, z, height), color rgba, uv1, uv2, overlay uv
+TERRAIN_VERTEX_SIZE = 13
+
+# Every tile is a 4x4 vertex grid drawn as 3x3 quads, two triangles each
+TILE_TRIANGLE_INDICES = array([
+    index
+    for y in range(3) for x in range(3)
+    for index in (4*y + x, 4*y + x+1, 4*(y+1) + x+1,
+                  4*y + x, 4*(y+1) + x+1, 4*(y+1) + x)
+], dtype=numpy.uint32)
+
+
+class TerrainMesh(object):
+    # All tiles of one material packed into a vertex and an index array.
+    # Tiles are ordered by chunk so every chunk owns one contiguous index range.
+    def __init__(self, material_index, vertices, indices, chunk_ids, chunk_starts, chunk_counts, chunk_min, chunk_max):
+        self.material_index = material_index
+        self.vertices: ndarray = vertices
+        self.indices: ndarray = indices
+        self.chunk_ids: ndarray = chunk_ids
+        self.chunk_starts: ndarray = chunk_starts
+        self.chunk_counts: ndarray = chunk_counts
+        self.chunk_min: ndarray = chunk_min
+        self.chunk_max: ndarray = chunk_max
+
+    @classmethod
+    def from_tile_vertices(cls, material_index, vertices, tile_chunks):
+        # vertices: (tiles*16, TERRAIN_VERTEX_SIZE) with tiles sorted by chunk,
+        # tile_chunks: chunk index of every tile
+        tilecount = len(tile_chunks)
+        indices = (TILE_TRIANGLE_INDICES[None, :]
+                   + (numpy.arange(tilecount, dtype=numpy.uint32)*16)[:, None]).ravel()
+
+        chunk_first_tile = numpy.flatnonzero(numpy.diff(tile_chunks, prepend=-1))
+        chunk_ids = tile_chunks[chunk_first_tile]
+        tiles_per_chunk = numpy.diff(numpy.append(chunk_first_tile, tilecount))
+        chunk_starts = chunk_first_tile*len(TILE_TRIANGLE_INDICES)
+        chunk_counts = tiles_per_chunk*len(TILE_TRIANGLE_INDICES)
+
+        positions = vertices[:, 0:3]
+        vertex_starts = chunk_first_tile*16
+        chunk_min = numpy.minimum.reduceat(positions, vertex_starts, axis=0)
+        chunk_max = numpy.maximum.reduceat(positions, vertex_starts, axis=0)
+
+        return cls(material_index, vertices, indices, chunk_ids, chunk_starts, chunk_counts, chunk_min, chunk_max)
+
+    def visible_ranges(self, planes=None):
+        # Merges the index ranges of all chunks inside the frustum into as few
+        # (start, count) draw ranges as possible.
+        if planes is None:
+            return [(0, len(self.indices))]
+
+        visible = aabbs_in_frustum(planes, self.chunk_min, self.chunk_max)
+        ranges = []
+        for start, count in zip(self.chunk_starts[visible], self.chunk_counts[visible]):
+            if ranges and ranges[-1][0] + ranges[-1][1] == start:
+                ranges[-1][1] += count
+            else:
+                ranges.append([start, count])
+
+        return ranges
+
+
 @dataclass
 class Tile:
     heights: list[int]                  # 16 ushorts
@@ -407,15 +472,193 @@ class Timer():
         self.last = timeit.default_timer()
 
 
+# Structured views over the terrain sections, see Tile and MapChunkReference for the fields
+TILE_DTYPE = numpy.dtype([
+    ("heights", ">u2", (16,)),
+    ("vertex_colors", "u1", (16, 4)),
+    ("surface_coordinates", ">u2", (4, 2)),
+    ("detail_coordinates", ">u2", (16, 2)),
+    ("material_index", ">u4")
+])
+assert TILE_DTYPE.itemsize == Tile.size
+
+MAP_CHUNK_DTYPE = numpy.dtype([
+    ("a", "u1"),
+    ("b", "u1"),
+    ("chunkindex", ">u2")
+])
+assert MAP_CHUNK_DTYPE.itemsize == MapChunkReference.size
+
+# Tiles of a chunk are visited column by column, the same order the tile models used to be built in
+TILE_ORDER_X = numpy.repeat(numpy.arange(4), 4)
+TILE_ORDER_Y = numpy.tile(numpy.arange(4), 4)
+
+# Terrain vertices are spaced 16/3 units apart on a grid of 64*12 cells per side
+TERRAIN_CELL_SIZE = 16/3
+TERRAIN_CELLS = 64*12
+TERRAIN_ORIGIN = -2048
+
+
+class TerrainHeightfield(object):
+    # Ray casting against the terrain as a heightfield. Every cell of the vertex grid is treated
+    # as a bilinear patch over its four corner heights. Rays are walked through the cells they
+    # cross in order and only cells whose height range the ray passes through are solved exactly.
+    # All rays of a batch are processed together with array operations.
+    BATCH_SIZE = 1024
+
+    def __init__(self, pointdata: ndarray):
+        cells = numpy.arange(TERRAIN_CELLS)
+        # Grid points are stored per tile with 4 points per 3 cells
+        points = cells + cells//3
+
+        # Corner heights of every cell, indexed [x, z]
+        self.h00 = pointdata[points[:, None], points[None, :]]
+        self.h10 = pointdata[points[:, None]+1, points[None, :]]
+        self.h01 = pointdata[points[:, None], points[None, :]+1]
+        self.h11 = pointdata[points[:, None]+1, points[None, :]+1]
+        self.used = self.h00 != -1
+
+        corners = numpy.stack((self.h00, self.h10, self.h01, self.h11))
+        self.min_height = corners.min(axis=0)
+        self.max_height = corners.max(axis=0)
+
+        if self.used.any():
+            self.bounds_min = array([TERRAIN_ORIGIN, self.min_height[self.used].min() - 1.0, TERRAIN_ORIGIN])
+            self.bounds_max = array([TERRAIN_ORIGIN + TERRAIN_CELLS*TERRAIN_CELL_SIZE,
+                                     self.max_height[self.used].max() + 1.0,
+                                     TERRAIN_ORIGIN + TERRAIN_CELLS*TERRAIN_CELL_SIZE])
+        else:
+            self.bounds_min = self.bounds_max = None
+
+    def collide_rays(self, origins, directions, max_distance=inf) -> ndarray:
+        # origins and directions are (n, 3) arrays of x, height, z with normalized directions.
+        # Returns the distance of the closest hit for every ray, inf where the ray misses.
+        origins = numpy.asarray(origins, dtype=numpy.float64).reshape(-1, 3)
+        directions = numpy.asarray(directions, dtype=numpy.float64).reshape(-1, 3)
+        distances = numpy.full(len(origins), inf)
+
+        if self.bounds_min is None:
+            return distances
+
+        for start in range(0, len(origins), self.BATCH_SIZE):
+            end = start + self.BATCH_SIZE
+            distances[start:end] = self._collide_batch(origins[start:end], directions[start:end], max_distance)
+
+        return distances
+
+    def _collide_batch(self, origins, directions, max_distance):
+        count = len(origins)
+        distances = numpy.full(count, inf)
+
+        # Clip the rays to the bounding box of the terrain
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            inverse = 1.0/directions
+            t0 = (self.bounds_min - origins)*inverse
+            t1 = (self.bounds_max - origins)*inverse
+        tnear = numpy.maximum(numpy.fmax.reduce(numpy.fmin(t0, t1), axis=1), 0.0)
+        tfar = numpy.minimum(numpy.fmin.reduce(numpy.fmax(t0, t1), axis=1), max_distance)
+        rays = numpy.flatnonzero(tnear <= tfar)
+        if len(rays) == 0:
+            return distances
+
+        # Ray parameters at which the ray crosses a grid line, per axis
+        grid_origins = (origins[rays][:, [0, 2]] - TERRAIN_ORIGIN)/TERRAIN_CELL_SIZE
+        grid_directions = directions[rays][:, [0, 2]]/TERRAIN_CELL_SIZE
+        ray_ids = [rays, rays]
+        ray_t = [tnear[rays], tfar[rays]]
+
+        for axis in range(2):
+            moving = grid_directions[:, axis] != 0
+            entry = grid_origins[:, axis] + grid_directions[:, axis]*tnear[rays]
+            exit = grid_origins[:, axis] + grid_directions[:, axis]*tfar[rays]
+            first = numpy.floor(numpy.minimum(entry, exit)) + 1
+            last = numpy.ceil(numpy.maximum(entry, exit)) - 1
+            crossings = numpy.where(moving, numpy.maximum(last - first + 1, 0), 0).astype(numpy.int64)
+
+            total = crossings.sum()
+            if total == 0:
+                continue
+            crossing_rays = numpy.repeat(numpy.arange(len(rays)), crossings)
+            steps = numpy.arange(total) - numpy.repeat(numpy.cumsum(crossings) - crossings, crossings)
+            lines = first[crossing_rays] + steps
+
+            ray_ids.append(rays[crossing_rays])
+            ray_t.append((lines - grid_origins[crossing_rays, axis])/grid_directions[crossing_rays, axis])
+
+        ray_ids = numpy.concatenate(ray_ids)
+        ray_t = numpy.concatenate(ray_t)
+        order = numpy.lexsort((ray_t, ray_ids))
+        ray_ids = ray_ids[order]
+        ray_t = ray_t[order]
+
+        # Every pair of consecutive crossings of the same ray is the part of the ray inside one cell
+        same_ray = ray_ids[1:] == ray_ids[:-1]
+        seg_rays = ray_ids[:-1][same_ray]
+        seg_start = ray_t[:-1][same_ray]
+        seg_end = ray_t[1:][same_ray]
+
+        origin = origins[seg_rays]
+        direction = directions[seg_rays]
+        middle = origin + direction*((seg_start + seg_end)/2.0)[:, None]
+        cellx = numpy.clip(numpy.floor((middle[:, 0] - TERRAIN_ORIGIN)/TERRAIN_CELL_SIZE), 0, TERRAIN_CELLS-1).astype(numpy.int64)
+        cellz = numpy.clip(numpy.floor((middle[:, 2] - TERRAIN_ORIGIN)/TERRAIN_CELL_SIZE), 0, TERRAIN_CELLS-1).astype(numpy.int64)
+
+        # Skip cells the ray passes above or below
+        height_start = origin[:, 1] + direction[:, 1]*seg_start
+        height_end = origin[:, 1] + direction[:, 1]*seg_end
+        candidates = (self.used[cellx, cellz]
+                      & (numpy.minimum(height_start, height_end) <= self.max_height[cellx, cellz])
+                      & (numpy.maximum(height_start, height_end) >= self.min_height[cellx, cellz]))
+
+        seg_rays = seg_rays[candidates]
+        seg_start = seg_start[candidates]
+        seg_end = seg_end[candidates]
+        cellx = cellx[candidates]
+        cellz = cellz[candidates]
+        origin = origins[seg_rays] + directions[seg_rays]*seg_start[:, None]
+        direction = directions[seg_rays]
+
+        # Solve height(u, v) = y along the segment, with u and v the position inside the cell
+        u = (origin[:, 0] - TERRAIN_ORIGIN)/TERRAIN_CELL_SIZE - cellx
+        v = (origin[:, 2] - TERRAIN_ORIGIN)/TERRAIN_CELL_SIZE - cellz
+        du = direction[:, 0]/TERRAIN_CELL_SIZE
+        dv = direction[:, 2]/TERRAIN_CELL_SIZE
+
+        h00 = self.h00[cellx, cellz]
+        b = self.h10[cellx, cellz] - h00
+        c = self.h01[cellx, cellz] - h00
+        e = self.h11[cellx, cellz] - h00 - b - c
+
+        qa = -e*du*dv
+        qb = direction[:, 1] - b*du - c*dv - e*(u*dv + v*du)
+        qc = origin[:, 1] - h00 - b*u - c*v - e*u*v
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            linear = numpy.abs(qa) < 1e-12
+            discriminant = qb*qb - 4*qa*qc
+            q = -0.5*(qb + numpy.copysign(numpy.sqrt(numpy.maximum(discriminant, 0.0)), qb))
+            root1 = numpy.where(linear, -qc/qb, q/qa)
+            root2 = numpy.where(linear, numpy.nan, qc/q)
+            real = linear | (discriminant >= 0)
+
+        length = seg_end - seg_start + 1e-6
+        root1 = numpy.where(real & (root1 >= -1e-6) & (root1 <= length), root1, inf)
+        root2 = numpy.where(real & (root2 >= -1e-6) & (root2 <= length), root2, inf)
+        hits = numpy.maximum(numpy.minimum(root1, root2), 0.0) + seg_start
+
+        numpy.minimum.at(distances, seg_rays, hits)
+        return distances
+
+
+
 class BWTerrainV2(BWSectionedFile):
     def __init__(self, f):
         super().__init__(f)
         timer = Timer()
         timer.time("Start")
-        #width, height, unk1, unk2 = unpack("IIII", self.sections[b"RRET"])
         self.terrain_data = TerrainData.from_section(self.sections[b"RRET"])
-        self.chunks = initiate_from_section(Chunk, self.sections[b"KNHC"])
-        self.map = initiate_from_section(MapChunkReference, self.sections[b"PAMC"])
+        self.chunks = numpy.frombuffer(self.sections[b"KNHC"], dtype=TILE_DTYPE).reshape(-1, 16)
+        self.map = numpy.frombuffer(self.sections[b"PAMC"], dtype=MAP_CHUNK_DTYPE).reshape(64, 64)
         self.materials = initiate_from_section(MapMaterial, self.sections[b"LTAM"])
         timer.time("Data parsed")
         assert self.terrain_data.chunks_x == self.terrain_data.chunks_y == 64
@@ -423,52 +666,107 @@ class BWTerrainV2(BWSectionedFile):
         points_x = self.terrain_data.chunks_y * 16 + 1
         points_y = self.terrain_data.chunks_y * 16 + 1
 
-        self.pointdata = zeros(shape=[points_x, points_y]) #[[None for y in range(self.terrain_data.chunks_y * 16 + 1)] for x in range(self.terrain_data.chunks_y * 16 + 1)]
+        self.pointdata = zeros(shape=[points_x, points_y])
         self.pointdata[True] = -1
-        self.grids = []
-        chunk_group = []
-
-        self.meshes: dict[TileModel] = {}
-
-        timer.time("Data initialized")
-
-        for chunkx in range(64):
-            chunk_xx = chunkx*16
-
-            for chunky in range(64):
-                chunk_yy = chunky*16
 
-                mapchunk = self.map[chunky*64 + chunkx]
-                if mapchunk.b == 1:
-                    chunk = self.chunks[mapchunk.chunkindex]
-
-                    #chunk_tiles = []
-
-                    for tilex in range(4):
-                        tile_xx = chunk_xx + tilex*4
-
-                        for tiley in range(4):
-                            tile_yy = chunk_yy + tiley*4
-                            tile = chunk.tiles[tiley*4+tilex]
-
-                            if tile.material_index not in self.meshes:
-                                self.meshes[tile.material_index] = []
-
-                            for x in range(4):
-                                for y in range(4):
-                                    index = y*4 + x
-                                    #self.pointdata[chunkx*16 + tilex*4 + x][chunky*16+tiley*4+y] = tile.heights[index]/16.0
-                                    self.pointdata[tile_xx+x, tile_yy+y] = tile.heights[index]# / 16.0
-
-                            tilemodel = TileModel(tile,
-                                                  self.materials,
-                                                  tile_xx - tilex - chunkx*4,
-                                                  tile_yy - tiley - chunky*4)
-                            self.meshes[tile.material_index].append(tilemodel)
-                            #chunk_tiles.append(tilemodel)
-                            chunk_group.append(tilemodel)
+        # Every tile of every used chunk, chunks ordered by x first and then y
+        chunkx, chunky = numpy.nonzero(self.map["b"].T == 1)
+        chunk_indices = self.map["chunkindex"][chunky, chunkx]
+
+        self.tile_chunkx = numpy.repeat(chunkx, 16)
+        self.tile_chunky = numpy.repeat(chunky, 16)
+        self.tile_x = numpy.tile(TILE_ORDER_X, len(chunkx))
+        self.tile_y = numpy.tile(TILE_ORDER_Y, len(chunkx))
+        # Index of the tile record in the KNHC section
+        self.tile_records = (numpy.repeat(chunk_indices.astype(numpy.int64), 16)*16
+                             + self.tile_y*4 + self.tile_x)
+        self.tiles = self.chunks.reshape(-1)[self.tile_records]
+
+        # Heights are stored per tile as a 4x4 grid, indexed [y][x]
+        heights = self.tiles["heights"].reshape(-1, 4, 4)/16.0
+        tile_xx = self.tile_chunkx*16 + self.tile_x*4
+        tile_yy = self.tile_chunky*16 + self.tile_y*4
+        grid = numpy.arange(4)
+        self.pointdata[tile_xx[:, None, None] + grid[None, None, :],
+                       tile_yy[:, None, None] + grid[None, :, None]] = heights
+
+        # Vertex positions are on a grid where neighbouring tiles share their edge
+        self.tile_offsetx = self.tile_chunkx*12 + self.tile_x*3
+        self.tile_offsety = self.tile_chunky*12 + self.tile_y*3
+        self.tile_heights = heights
+        self.tile_aabb_min = numpy.stack((
+            self.tile_position(self.tile_offsetx),
+            heights.min(axis=(1, 2)),
+            self.tile_position(self.tile_offsety)), axis=1)
+        self.tile_aabb_max = numpy.stack((
+            self.tile_position(self.tile_offsetx + 3),
+            heights.max(axis=(1, 2)),
+            self.tile_position(self.tile_offsety + 3)), axis=1)
+
+        self.heightfield = TerrainHeightfield(self.pointdata)
+        # Tile models are only needed for comparing against the heightfield and created on first use
+        self.chunk_group = None
         timer.time("Chunks created")
-        self.chunk_group = AABBGroup(chunk_group)
+
+    @staticmethod
+    def tile_position(gridpos):
+        return gridpos*4*(4/3)-2048
+
+    def build_tile_vertices(self, tiles: ndarray):
+        # Vertex data of the selected tiles in the layout of TERRAIN_VERTEX_SIZE, 16 vertices per tile
+        count = len(tiles)
+        records = self.tiles[tiles]
+        grid = numpy.arange(4)
+
+        posx = numpy.broadcast_to(
+            self.tile_position(grid[None, None, :] + self.tile_offsetx[tiles, None, None]), (count, 4, 4))
+        posz = numpy.broadcast_to(
+            self.tile_position(grid[None, :, None] + self.tile_offsety[tiles, None, None]), (count, 4, 4))
+
+        fx = grid[None, None, :]/3.0
+        fy = grid[None, :, None]/3.0
+        surface = records["surface_coordinates"]/4096.0
+        br, bl, tr, tl = (surface[:, i, None, None, :] for i in range(4))
+        uv1 = (fy[..., None]*(fx[..., None]*tl + (1-fx[..., None])*tr)
+               + (1-fy[..., None])*(fx[..., None]*bl + (1-fx[..., None])*br))
+
+        vertices = numpy.empty((count, 16, TERRAIN_VERTEX_SIZE), dtype=numpy.float32)
+        vertices[:, :, 0] = posx.reshape(count, 16)
+        vertices[:, :, 1] = posz.reshape(count, 16)
+        vertices[:, :, 2] = self.tile_heights[tiles].reshape(count, 16)
+        vertices[:, :, 3:7] = records["vertex_colors"]/255.0
+        vertices[:, :, 7:9] = uv1.reshape(count, 16, 2)
+        vertices[:, :, 9:11] = records["detail_coordinates"]/4096.0
+        vertices[:, :, 11] = (posx.reshape(count, 16) + 2048)/4096.0
+        vertices[:, :, 12] = (posz.reshape(count, 16) + 2048)/4096.0
+
+        return vertices.reshape(count*16, TERRAIN_VERTEX_SIZE)
+
+    def build_render_meshes(self) -> dict[int, TerrainMesh]:
+        render_meshes = {}
+        material_indices = self.tiles["material_index"]
+        tile_chunks = self.tile_chunky*64 + self.tile_chunkx
+
+        for material_index in numpy.unique(material_indices):
+            tiles = numpy.flatnonzero(material_indices == material_index)
+            vertices = self.build_tile_vertices(tiles)
+            render_meshes[int(material_index)] = TerrainMesh.from_tile_vertices(
+                int(material_index), vertices, tile_chunks[tiles])
+
+        return render_meshes
+
+    def build_tile_models(self):
+        timer = Timer()
+        tilemodels = []
+        for i in range(len(self.tiles)):
+            tile = Tile.from_array(self.sections[b"KNHC"], int(self.tile_records[i]))
+            tilemodels.append(TileModel(tile,
+                                        self.materials,
+                                        int(self.tile_offsetx[i]),
+                                        int(self.tile_offsety[i]),
+                                        int(self.tile_chunky[i]*64 + self.tile_chunkx[i])))
+        timer.time("Tile models created")
+        self.chunk_group = AABBGroup(tilemodels)
         self.chunk_group.subdivide(5)
         timer.time("AABBs generated")
 
@@ -521,23 +819,113 @@ class BWTerrainV2(BWSectionedFile):
             fin = p1_avg*(1-y_fac) + p2_avg*y_fac
             return fin
 
-    def ray_collide(self, line: Line):
-        timer = Timer()
-        timer.time("Ray collide start")
-        point, dist = None, inf
-        result = self.chunk_group.ray_collide(line)
-        if result is not False:
-            p, d = result
-            dist = d
-            point = p
+    def _check_heights(self, mapx: ndarray, mapy: ndarray) -> ndarray:
+        # Array version of _check_height, positions without terrain are nan
+        valid = (0 <= mapx) & (mapx < 768) & (0 <= mapy) & (mapy < 768)
+        mapx = numpy.where(valid, mapx, 0).astype(numpy.int64)
+        mapy = numpy.where(valid, mapy, 0).astype(numpy.int64)
+        heights = self.pointdata[mapx + mapx//3, mapy + mapy//3]
+        heights[~valid | (heights == -1)] = numpy.nan
+        return heights
+
+    def check_heights(self, xs, ys) -> ndarray:
+        # Array version of check_height, positions without terrain are nan
+        with numpy.errstate(invalid="ignore"):
+            mapx = numpy.trunc((numpy.asarray(xs, dtype=numpy.float64) + 2048)*0.1875)
+            mapy = numpy.trunc((numpy.asarray(ys, dtype=numpy.float64) + 2048)*0.1875)
+            return self._check_heights(mapx, mapy)
+
+    def check_heights_interpolated(self, xs, ys) -> ndarray:
+        # Array version of check_height_interpolate, positions without terrain are nan
+        with numpy.errstate(invalid="ignore"):
+            base_x = (numpy.asarray(xs, dtype=numpy.float64) + 2048)*0.1875
+            prev_x = numpy.trunc(base_x)
+            x_fac = (base_x - prev_x) % 1
+
+            base_y = (numpy.asarray(ys, dtype=numpy.float64) + 2048)*0.1875
+            prev_y = numpy.trunc(base_y)
+            y_fac = (base_y - prev_y) % 1
+
+            p1_1 = self._check_heights(prev_x, prev_y)
+            p2_1 = self._check_heights(prev_x + 1, prev_y)
+            p1_2 = self._check_heights(prev_x, prev_y + 1)
+            p2_2 = self._check_heights(prev_x + 1, prev_y + 1)
 
+            p1_avg = p1_1*(1-x_fac) + p2_1*x_fac
+            p2_avg = p1_2*(1-y_fac) + p2_2*y_fac
+            fin = p1_avg*(1-y_fac) + p2_avg*y_fac
 
-        timer.time(f"Ray collide end with result {str(point)}")
+        return numpy.where(numpy.isnan(fin), p1_1, fin)
 
-        if point is not None:
-            return point, dist
-        else:
-            return False
+    def ray_collide(self, line: Line):
+        result = self.ray_collide_many([line])
+        return result[0]
+
+    def ray_collide_many(self, lines: list[Line]):
+        # Returns (point, distance) or False for every line
+        origins = [(line.origin.x, line.origin.y, line.origin.z) for line in lines]
+        directions = [(line.direction.x, line.direction.y, line.direction.z) for line in lines]
+        distances = self.heightfield.collide_rays(origins, directions)
+
+        results = []
+        for line, dist in zip(lines, distances):
+            if dist == inf:
+                results.append(False)
+            else:
+                results.append((line.origin + line.direction*float(dist), float(dist)))
+
+        return results
+
+    def ray_collide_quadtree(self, line: Line):
+        if self.chunk_group is None:
+            self.build_tile_models()
+
+        return self.chunk_group.ray_collide(line)
+
+
+def benchmark_ray_collide(bwterrain: BWTerrainV2, count=200, seed=0):
+    # Casts random rays from above the map down onto the terrain with the heightfield
+    # and with the tile quadtree and compares the time taken and where they hit.
+    rng = numpy.random.default_rng(seed)
+    origins = numpy.column_stack((rng.uniform(-2048, 2048, count),
+                                  rng.uniform(1000, 3000, count),
+                                  rng.uniform(-2048, 2048, count)))
+    directions = numpy.column_stack((rng.uniform(-0.5, 0.5, count),
+                                     -numpy.ones(count),
+                                     rng.uniform(-0.5, 0.5, count)))
+    lines = [Line(Vector3(*origin), Vector3(*direction)) for origin, direction in zip(origins, directions)]
+
+    if bwterrain.chunk_group is None:
+        bwterrain.build_tile_models()
+
+    start = timeit.default_timer()
+    heightfield_results = bwterrain.ray_collide_many(lines)
+    heightfield_time = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    heightfield_single_results = [bwterrain.ray_collide(line) for line in lines]
+    heightfield_single_time = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    quadtree_results = [bwterrain.ray_collide_quadtree(line) for line in lines]
+    quadtree_time = timeit.default_timer() - start
+
+    both_hit = 0
+    max_difference = 0.0
+    mismatched = 0
+    for batch, single, quadtree in zip(heightfield_results, heightfield_single_results, quadtree_results):
+        assert (batch is False) == (single is False)
+        if (batch is False) != (quadtree is False):
+            mismatched += 1
+        elif batch is not False:
+            both_hit += 1
+            max_difference = max(max_difference, abs(batch[1] - quadtree[1]))
+
+    print(f"{count} rays, {both_hit} hits, {mismatched} rays hit by only one method")
+    print(f"Heightfield (batch): {heightfield_time}s")
+    print(f"Heightfield (single rays): {heightfield_single_time}s")
+    print(f"Quadtree: {quadtree_time}s")
+    print(f"Largest difference in hit distance: {max_difference}")
 
 
 class BWTerrain(BWSectionedFile):
@@ -619,13 +1007,13 @@ class BWTerrain(BWSectionedFile):
 
 
 if __name__ == "__main__":
-    with open("MP4.out", "rb") as f:
+    import sys
+    path = sys.argv[1] if len(sys.argv) > 1 else "MP4.out"
+    with open(path, "rb") as f:
         bwterrain = BWTerrainV2(f)
 
     #print(bwterrain.chunks)
     #print(bwterrain.map)
     print(bwterrain.materials)
 
-    for chunk in bwterrain.chunks:
-        for tile in chunk.tiles:
-            print(tile.surface_coordinates)
\ No newline at end of file
+    benchmark_ray_collide(bwterrain)
\ No newline at end of file
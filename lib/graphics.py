@@ -1,10 +1,10 @@
 import json
 import numpy
-from math import sin, cos, pi
+from math import sin, cos, pi, isnan
 from OpenGL.GL import *
 from OpenGL.GLU import *
 from lib.vectors import Vector3
-from lib.render.model_renderingv2 import LineDrawing
+from lib.render.model_renderingv2 import LineDrawing, InstanceArray, InstanceCuller
 from typing import TYPE_CHECKING
 from lib.bw_types import BWMatrix
 from plugins.plugin_scenery_render import SceneryHandler, SceneryComponent
@@ -43,50 +43,60 @@ ZONECOLORS = {
 
 
 class Scene(object):
+    # Retained scene, every object keeps its slots in the instance arrays between frames
+    # so a changed object only needs its own slots to be updated.
     def __init__(self):
-        self.objects = {}
         self.model = {}
+        self.instances = {}
 
         self.modelinstances = {}
-        self.renderedmodels = []
-        self.wireframeboxes = []
-        self.wireframecylinders = []
+        self.billboards = InstanceArray()
+        self.wireframeboxes = {}
+        self.wireframecylinders = {}
 
         self.lines = LineDrawing()
         self.not_startpoint = {}
+        self.waypoints = {}
 
-        self.is_empty = {}
+        # Object -> (object type the cube is drawn for, model name or None, has billboard)
+        self.placements = {}
 
-    def add_matrix(self, modelname, mtx):
+    def add_matrix(self, modelname, key, mtx):
         if modelname not in self.modelinstances:
-            self.renderedmodels.append(modelname)
-            self.modelinstances[modelname] = [mtx]
-        else:
-            self.modelinstances[modelname].append(mtx)
+            self.modelinstances[modelname] = InstanceArray()
+        self.modelinstances[modelname].set(key, mtx)
 
     def fullreset(self):
-        self.renderedmodels = []
-        self.wireframeboxes = []
-        self.wireframecylinders = []
+        for instances in self.instances.values():
+            instances.clear()
+        for instances in self.modelinstances.values():
+            instances.clear()
+        self.billboards.clear()
+        self.wireframeboxes = {}
+        self.wireframecylinders = {}
         self.lines.reset_lines()
-        for type in self.is_empty:
-            self.is_empty[type] = True
-
-    def reset(self):
-        for key in list(self.objects.keys()):
-            del self.objects[key]
-            self.objects[key] = ([], [])
-        del self.modelinstances
-        self.modelinstances = {}
         self.not_startpoint = {}
+        self.waypoints = {}
+        self.placements = {}
+
+    def remove_object(self, obj):
+        placement = self.placements.pop(obj, None)
+        if placement is None:
+            return
+
+        objtype, modelname, billboard = placement
+        self.instances[objtype].remove(obj)
+        if modelname is not None:
+            self.modelinstances[modelname].remove(obj)
+        if billboard:
+            self.billboards.remove(obj)
+        self.wireframeboxes.pop(obj, None)
+        self.wireframecylinders.pop(obj, None)
+        self.waypoints.pop(obj, None)
 
     def set_model(self, type, model):
-        self.objects[type] = None
         self.model[type] = model
-        self.is_empty[type] = True
-
-    def set_not_empty(self, type):
-        self.is_empty[type] = False
+        self.instances[type] = InstanceArray()
 
 
 class Graphics(object):
@@ -100,6 +110,8 @@ class Graphics(object):
         self.models_scene = []
 
         self._dirty = True
+        self._dirty_objects = set()
+        self._last_selected = set()
 
         self.render_everything_once = True
 
@@ -107,26 +119,16 @@ class Graphics(object):
         self.scenery_simple = False
 
     def set_dirty(self):
-        self.rw.models.cubev2.mtxdirty = True
-        self.rw.models.camera.mtxdirty = True
-        self.rw.models.billboard.mtxdirty = True
-        for model in self.rw.bwmodelhandler.instancemodels.values():
-            model.mtxdirty = True
-
+        # The whole scene is rebuilt on the next render
         self._dirty = True
 
-    def set_dirty_limited(self, modelnames):
-        self.rw.models.cubev2.mtxdirty = True
-        self.rw.models.camera.mtxdirty = True
-        self.rw.models.billboard.mtxdirty = True
-        for modelname in modelnames:
-            model = self.rw.bwmodelhandler.instancemodels[modelname]
-            model.mtxdirty = True
-
-        self._dirty = True
+    def set_dirty_objects(self, objects):
+        # Only these objects are updated on the next render
+        self._dirty_objects.update(objects)
 
     def reset_dirty(self):
         self._dirty = False
+        self._dirty_objects = set()
 
     def is_dirty(self):
         return self._dirty
@@ -173,25 +175,17 @@ class Graphics(object):
         rw = self.rw
         vismenu = self.rw.visibility_menu
 
-        extradataarrays = {}
-        for key in self.scene.objects:
-            extradataarrays[key] = []
-
         if len(objlist) > 0xFFFF:
             raise RuntimeError("More than 64k objects, cannot select.")
 
-        for i, obj in enumerate(objlist):
-            if vismenu.object_visible(obj.type, obj):
-                colorid = (0x10000100 + (i << 12))
-                if obj.type not in extradataarrays:
-                    extradataarrays["generic"].append(colorid)
-                else:
-                    extradataarrays[obj.type].append(colorid)
+        # Color ids have to be in the order of the instance slots
+        indices = {obj: i for i, obj in enumerate(objlist)}
         for key, model in self.scene.model.items():
             if key == "generic" or vismenu.object_visible(key, None):
-                extradataarray = extradataarrays[key]
-                if len(extradataarray) > 0:
-                    extradata = numpy.array(extradataarray, dtype=numpy.uint32)
+                instances = self.scene.instances[key]
+                if len(instances) > 0:
+                    extradata = numpy.array([0x10000100 + (indices.get(obj, 0xFFFF) << 12) for obj in instances.keys],
+                                            dtype=numpy.uint32)
                     model.bind_colorid(extradata)
                     model.instancedrender()
                     model.unbind()
@@ -210,20 +204,144 @@ class Graphics(object):
         else:
             return False
 
+    def set_scenery(self, scenery_simple, selected_scenery):
+        # Generates the components of the scenery clusters that are shown, clusters that didn't
+        # change keep their components
+        rw = self.rw
+        vismenu = rw.visibility_menu
+        if not scenery_simple and vismenu.object_3d_visible("cSceneryCluster"):
+            self.scenery.set_scenery(rw.level_file,
+                                     vismenu.object_visible,
+                                     rw.level_file.is_bw2(),
+                                     rw.bwterrain)
+        elif selected_scenery:
+            self.scenery.set_scenery(selected_scenery,
+                                     vismenu.object_visible,
+                                     rw.level_file.is_bw2(),
+                                     rw.bwterrain)
+        else:
+            self.scenery.components = []
+
+    def add_scenery_components(self):
+        for component in self.scenery.components:
+            if component.modeltype is not None:
+                self.scene.add_matrix(component.modeltype, component, component.rendermtx)
+
+    def update_scenery_components(self, old_components):
+        # Replaces the instances of components that are gone with the newly generated ones
+        new = set(self.scenery.components)
+        for component in old_components:
+            if component not in new and component.modeltype is not None:
+                self.scene.modelinstances[component.modeltype].remove(component)
+
+        old = set(old_components)
+        for component in self.scenery.components:
+            if component not in old and component.modeltype is not None:
+                self.scene.add_matrix(component.modeltype, component, component.rendermtx)
+
+    def check_object_heights(self, objects, bwterrain):
+        # Terrain height at the terrain_height_position of every object,
+        # None where the object doesn't need it or there is no terrain
+        positions = [obj.terrain_height_position() for obj in objects]
+        queried = [position for position in positions if position is not None]
+        heights = bwterrain.check_heights([position[0] for position in queried],
+                                          [position[1] for position in queried])
+
+        result = []
+        heights = iter(heights.tolist())
+        for position in positions:
+            if position is None:
+                result.append(None)
+            else:
+                height = next(heights)
+                result.append(None if isnan(height) else height)
+        return result
+
+    def place_object(self, obj, terrain_height, selected, scenery_simple, selected_scenery):
+        # Puts the object into its instance slots, replacing where it was before
+        rw = self.rw
+        scene = self.scene
+        visible3d = rw.visibility_menu.object_3d_visible
+        scene.remove_object(obj)
+
+        objtype = obj.type if obj.type in scene.model else "generic"
+
+        if rw.dolphin.do_visualize() and obj.mtxoverride is not None:
+            currmtx = obj.mtxoverride.copy()
+        else:
+            currmtx = obj.getmatrix().mtx.copy()
+            height = obj.calculate_height_from_terrain(terrain_height, rw.waterheight)
+            if height is not None:
+                currmtx[13] = height
+
+            obj.height = currmtx[13]
+        if obj.type == "cTroop":
+            BWMatrix.static_rotate_y(currmtx, pi)
+
+        flag = 0
+        if obj in selected:
+            flag |= 1
+
+        r, g, b, a = object_colors[obj.type]
+        scene.instances[objtype].set(obj, currmtx, (flag, int(r * 255), int(g * 255), int(b * 255)))
+
+        if obj.type in ("cMapZone", "cCoastZone", "cDamageZone", "cNogoHintZone"):
+            if rw.dolphin.do_visualize() and obj.mtxoverride is not None:
+                mtx = obj.mtxoverride
+            else:
+                mtx = obj.getmatrix().mtx
+            if obj in selected:
+                color = object_colors["SelectionColor"]
+            else:
+                if obj.mZoneType in ZONECOLORS:
+                    color = ZONECOLORS[obj.mZoneType]
+                else:
+                    color = (0.0, 0.0, 1.0, 1.0)
+            radius = obj.mRadius
+            size = obj.mSize
+
+            if radius > 0:
+                scene.wireframecylinders[obj] = (mtx, color, (radius, radius, radius, 1))
+            if size.x > 0 and size.y >= 0 and size.z > 0:
+                scene.wireframeboxes[obj] = (mtx, color, (size.x/2.0, size.y/2.0, size.z/2.0, 1))
+
+        if obj.type == "cWaypoint":
+            scene.waypoints[obj] = True
+
+        modelname = None
+        if obj._modelname is not None and visible3d(obj.type):
+            if (obj.type != "cSceneryCluster"
+                    or scenery_simple and obj not in selected_scenery):
+                modelname = obj._modelname
+                scene.add_matrix(modelname, obj, currmtx)
+
+        iconoffset = obj.iconoffset
+        if iconoffset is not None:
+            x, y = iconoffset
+            scene.billboards.set(obj, currmtx, (flag, int(x), int(y), int(b * 255)))
+
+        scene.placements[obj] = (objtype, modelname, iconoffset is not None)
+
+    def update_waypoint_lines(self):
+        self.scene.lines.reset_lines()
+        self.scene.not_startpoint = {}
+        for obj in self.scene.waypoints:
+            if obj.NextWP is not None:
+                self.scene.not_startpoint[obj.NextWP] = True
+            if obj.mOptionalNextWP1 is not None:
+                self.scene.not_startpoint[obj.mOptionalNextWP1] = True
+            if obj.mOptionalNextWP2 is not None:
+                self.scene.not_startpoint[obj.mOptionalNextWP2] = True
+
+        for obj in self.scene.waypoints:
+            self.render_waypoint(self.rw, obj)
+
     def render_scene(self):
         rw = self.rw
 
-        selected = rw.selected
-        positions = rw.selected_positions
+        selected = set(rw.selected)
 
         glEnable(GL_CULL_FACE)
-        # mtx = numpy.concatenate([obj.getmatrix().mtx for obj in self.level_file.objects_with_positions.values()])
-        self.scene.reset()
-        default_matrices, default_extradata = self.scene.objects["generic"]
-
-        # self.models.cubev2.mtxdirty = True
-        globalmtx = None
-        globalextradata = None
 
         globalsetting = 0
         if self.rw.is_topdown():
@@ -234,197 +352,104 @@ class Graphics(object):
         if self.render_everything_once:
             vismenu.visibility_override = True
 
+        scenery_simple = vismenu.show_full_scenery() is False
+        selected_scenery = []
+        if scenery_simple and visible3d("cSceneryCluster"):
+            selected_scenery = [obj for obj in rw.selected if obj.type == "cSceneryCluster"]
 
+        # Objects whose selection changed need their highlight updated
+        dirty_objects = self._dirty_objects | (selected ^ self._last_selected)
+        self._last_selected = selected
 
-        empty = False
         #self.set_dirty()
         if self.is_dirty():
             self.scene.fullreset()
-            globalmtx = []
-            globalextradata = []
 
             self.models_scene = []
 
+            self.set_scenery(scenery_simple, selected_scenery)
+            self.add_scenery_components()
 
-            bwterrain = self.rw.bwterrain
-            waterheight = self.rw.waterheight
-            empty = True
-            waypoints = []
-            scenery_simple = vismenu.show_full_scenery() is False
-            selected_scenery = []
-            if not scenery_simple and visible3d("cSceneryCluster"):
-                self.scenery.set_scenery(rw.level_file,
-                                         vismenu.object_visible,
-                                         rw.level_file.is_bw2())
-
-                for component in self.scenery.components:
-                    if component.modeltype is not None:
-                        currmtx = component.mtx.mtx.copy()
-                        height = bwterrain.check_height(currmtx[12], currmtx[14])
-                        if height is not None:
-                            currmtx[13] = height
-                        self.scene.add_matrix(component.modeltype, currmtx)
-            elif scenery_simple and visible3d("cSceneryCluster"):
-
-                for obj in selected:
-                    if obj.type == "cSceneryCluster":
-                        selected_scenery.append(obj)
-                if selected_scenery:
-                    self.scenery.set_scenery(selected_scenery,
-                                             vismenu.object_visible,
-                                             rw.level_file.is_bw2())
-
-                    for component in self.scenery.components:
-                        if component.modeltype is not None:
-                            currmtx = component.mtx.mtx.copy()
-                            height = bwterrain.check_height(currmtx[12], currmtx[14])
-                            if height is not None:
-                                currmtx[13] = height
-                            self.scene.add_matrix(component.modeltype, currmtx)
-
-
-            for obj in rw.level_file.objects_with_positions.values():
-                if not visible(obj.type, obj):
-                    continue
-                empty = False
+            visible_objects = [obj for obj in rw.level_file.objects_with_positions.values()
+                               if visible(obj.type, obj)]
+            terrain_heights = self.check_object_heights(visible_objects, rw.bwterrain)
 
-                if obj.type in self.scene.objects:
-                    mtx, extradata = self.scene.objects[obj.type]
-                    self.scene.set_not_empty(obj.type)
-                else:
-                    mtx, extradata = default_matrices, default_extradata
-                    self.scene.set_not_empty("generic")
+            for obj, terrain_height in zip(visible_objects, terrain_heights):
+                self.place_object(obj, terrain_height, selected, scenery_simple, selected_scenery)
 
-                if rw.dolphin.do_visualize() and obj.mtxoverride is not None:
-                    currmtx = obj.mtxoverride.copy()
-                else:
-                    currmtx = obj.getmatrix().mtx.copy()
-                    height = obj.calculate_height(bwterrain, self.rw.waterheight)
-                    if height is not None:
-                        currmtx[13] = height
-
-                    obj.height = currmtx[13]
-                if obj.type == "cTroop":
-                    BWMatrix.static_rotate_y(currmtx, pi)
-                mtx.append(currmtx)
-
-                if obj.type in ("cMapZone", "cCoastZone", "cDamageZone", "cNogoHintZone"):
-                    if rw.dolphin.do_visualize() and obj.mtxoverride is not None:
-                        mtx = obj.mtxoverride
-                    else:
-                        mtx = obj.getmatrix().mtx
-                    if obj in selected:
-                        color = object_colors["SelectionColor"]
-                    else:
-                        if obj.mZoneType in ZONECOLORS:
-                            color = ZONECOLORS[obj.mZoneType]
-                        else:
-                            color = (0.0, 0.0, 1.0, 1.0)
-                    radius = obj.mRadius
-                    size = obj.mSize
-
-                    if radius > 0:
-                        self.scene.wireframecylinders.append((mtx, color, (radius, radius, radius, 1)))
-                    if size.x > 0 and size.y >= 0 and size.z > 0:
-                        self.scene.wireframeboxes.append((mtx, color, (size.x/2.0, size.y/2.0, size.z/2.0, 1)))
-
-                if obj.type == "cWaypoint":
-                    if obj.NextWP is not None:
-                        self.scene.not_startpoint[obj.NextWP] = True
-                    if obj.mOptionalNextWP1 is not None:
-                        self.scene.not_startpoint[obj.mOptionalNextWP1] = True
-                    if obj.mOptionalNextWP2 is not None:
-                        self.scene.not_startpoint[obj.mOptionalNextWP2] = True
-
-                    waypoints.append(obj)
-
-
-                iconoffset = obj.iconoffset
-
-                modelname = obj._modelname
-                if modelname is not None and visible3d(obj.type):
-                    if (obj.type != "cSceneryCluster"
-                            or scenery_simple and obj not in selected_scenery):
-                        self.scene.add_matrix(modelname, currmtx)
-
-                flag = 0
-                if obj in selected:
-                    flag |= 1
-                extradata.append(flag)
-
-                r, g, b, a = object_colors[obj.type]
-                extradata.append(int(r * 255))
-                extradata.append(int(g * 255))
-                extradata.append(int(b * 255))
-
-                if iconoffset is not None:
-                    globalmtx.append(currmtx)
-                    flag = 0
-                    if obj in selected:
-                        flag |= 1
-
-                    globalextradata.append(flag)
-                    x,y = iconoffset
-                    globalextradata.append(int(x))
-                    globalextradata.append(int(y))
-                    globalextradata.append(int(b * 255))
-            for obj in waypoints:
-                self.render_waypoint(rw, obj)
+            self.update_waypoint_lines()
             self.reset_dirty()
+        elif dirty_objects:
+            objects_with_positions = rw.level_file.objects_with_positions
+            visible_objects = []
+            update_waypoints = False
+
+            # Only the edited clusters are generated again
+            if any(obj.type in ("cSceneryCluster", "sSceneryClusterBase") for obj in dirty_objects):
+                old_components = self.scenery.components
+                self.set_scenery(scenery_simple, selected_scenery)
+                self.update_scenery_components(old_components)
+
+            for obj in dirty_objects:
+                if obj in self.scene.waypoints or obj.type == "cWaypoint":
+                    update_waypoints = True
+
+                if objects_with_positions.get(obj.id) is obj and visible(obj.type, obj):
+                    visible_objects.append(obj)
+                else:
+                    self.scene.remove_object(obj)
 
-        # self.models.cubev2.mtxdirty = True
+            terrain_heights = self.check_object_heights(visible_objects, self.rw.bwterrain)
+            for obj, terrain_height in zip(visible_objects, terrain_heights):
+                self.place_object(obj, terrain_height, selected, scenery_simple, selected_scenery)
 
+            if update_waypoints:
+                self.update_waypoint_lines()
+            self.reset_dirty()
 
         glActiveTexture(GL_TEXTURE0)
         glEnable(GL_TEXTURE_2D)
 
         cam_x, cam_z = rw.cam_x, rw.cam_z
 
+        # Instances outside of the view or further away than the render distance are not drawn
+        culler = None
+        editorconfig = rw.editorconfig
+        if (editorconfig is not None and rw.mvp_mat is not None and not self.render_everything_once
+                and editorconfig.getboolean("frustum_culling", fallback=True)):
+            distance = 0 if rw.is_topdown() else editorconfig.getfloat("render_distance", fallback=0)
+            culler = InstanceCuller(rw.mvp_mat, (rw.campos.x, rw.campos.y, rw.campos.z), distance)
+
         if self.render_everything_once and rw.bwmodelhandler:
             for mtx, x, z, modelname in self.models_scene:
                 rw.bwmodelhandler.rendermodel(modelname, mtx, rw.bwterrain, 0)
 
-        for meshname in self.scene.renderedmodels:
-            if meshname in self.scene.modelinstances:
-                mtxlist = self.scene.modelinstances[meshname]
-                if not mtxlist:
-                    mtx, extradata = None, None
-                else:
-                    mtx = numpy.concatenate(mtxlist)
-            else:
-                mtx, extradata = None, None
+        batch = self.rw.bwmodelhandler.get_batch() if self.rw.bwmodelhandler else None
+        if batch is not None:
+            batch.render(self.scene.modelinstances, culler)
+        else:
+            for meshname, instances in self.scene.modelinstances.items():
+                if len(instances) == 0:
+                    continue
 
-            #if len(mtx) > 0:
-            if self.rw.bwmodelhandler and meshname in self.rw.bwmodelhandler.instancemodels:
-                model = self.rw.bwmodelhandler.instancemodels[meshname]
-                model.bind(mtx, numpy.array([], dtype=numpy.uint8))
-                model.instancedrender(self.rw.bwmodelhandler.textures)
-                model.unbind()
+                model = self.rw.bwmodelhandler.get_instance_model(meshname) if self.rw.bwmodelhandler else None
+                if model is not None:
+                    model.bind_instances(instances, culler)
+                    model.instancedrender(self.rw.bwmodelhandler.textures)
+                    model.unbind()
 
         if self.rw.is_topdown():
             glClear(GL_DEPTH_BUFFER_BIT)
 
-
-
-        drawn = 0
         for objtype, model in self.scene.model.items():
             if not visible(objtype, obj=None) or not rw.cubes_visible:
                 continue
-            if self.scene.is_empty[objtype]:
-                continue
-
-            mtx, extradata = self.scene.objects[objtype]
 
-            if empty:
-                mtx = numpy.array([], dtype=numpy.uint8)
-                extradata = numpy.array([], dtype=numpy.uint8)
-            elif not mtx:
-                mtx, extradata = None, None
-            else:
-                mtx = numpy.concatenate(mtx)
-                extradata = numpy.array(extradata, dtype=numpy.uint8)
+            instances = self.scene.instances[objtype]
+            if len(instances) == 0:
+                continue
 
-            model.bind(mtx, extradata)
+            model.bind_instances(instances, culler)
             coloruniform = model.program.getuniformlocation("selectioncolor")
             glUniform4f(coloruniform, *object_colors["SelectionColor"])
             model.instancedrender()
@@ -439,14 +464,7 @@ class Graphics(object):
         glActiveTexture(GL_TEXTURE1)
         rw.models.billboard.outlinetex.bind()
 
-        if globalmtx is None:
-            rw.models.billboard.bind(None, None)
-        elif len(globalmtx) == 0:
-            rw.models.billboard.bind(numpy.array(globalmtx, dtype=numpy.uint8),
-                                     numpy.array(globalextradata, dtype=numpy.uint8))
-        else:
-            rw.models.billboard.bind(numpy.concatenate(globalmtx),
-                                     numpy.array(globalextradata, dtype=numpy.uint8))
+        rw.models.billboard.bind_instances(self.scene.billboards)
         texuniform = rw.models.billboard.program.getuniformlocation("tex")
         outlinetexuniform = rw.models.billboard.program.getuniformlocation("outlinetex")
         coloruniform = rw.models.billboard.program.getuniformlocation("selectioncolor")
@@ -492,7 +510,7 @@ class Graphics(object):
                 sizeuniform = rw.models.wireframe_cube.program.getuniformlocation("size")
                 coloruniform = rw.models.wireframe_cube.program.getuniformlocation("color")
 
-                for mtx, color, size in self.scene.wireframeboxes:
+                for mtx, color, size in self.scene.wireframeboxes.values():
                     glUniformMatrix4fv(mtxuniform, 1, False, mtx)
                     glUniform4f(sizeuniform, size[0], size[1], size[2], size[3])
                     glUniform4f(coloruniform, color[0], color[1], color[2], color[3])
@@ -504,7 +522,7 @@ class Graphics(object):
                 sizeuniform = rw.models.wireframe_cylinder.program.getuniformlocation("size")
                 coloruniform = rw.models.wireframe_cylinder.program.getuniformlocation("color")
 
-                for mtx, color, size in self.scene.wireframecylinders:
+                for mtx, color, size in self.scene.wireframecylinders.values():
                     glUniformMatrix4fv(mtxuniform, 1, False, mtx)
                     glUniform4f(sizeuniform, size[0], size[1], size[2], size[3])
                     glUniform4f(coloruniform, color[0], color[1], color[2], color[3])
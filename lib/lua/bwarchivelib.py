@@ -1,5 +1,9 @@
 import os
+import copy
 import gzip
+import mmap
+import shutil
+import tempfile
 from struct import unpack, pack
 
 
@@ -18,12 +22,151 @@ def unpack_uint32(data, offset):
 
 def write_uint32(fileobj, val):
     fileobj.write(pack("I", val))
+
+
+class ResourceIndex(object):
+    # Resources by key, with a list per key so the first added resource wins like in a linear scan
+    def __init__(self):
+        self._entries = {}
+
+    def add(self, key, resource):
+        if key in self._entries:
+            self._entries[key].append(resource)
+        else:
+            self._entries[key] = [resource]
+
+    def remove(self, key, resource):
+        entries = self._entries.get(key)
+        if entries is not None:
+            for i, entry in enumerate(entries):
+                if entry is resource:
+                    entries.pop(i)
+                    break
+            if not entries:
+                del self._entries[key]
+
+    def get_all(self, key):
+        return self._entries.get(key, ())
+
+    def get(self, key):
+        entries = self._entries.get(key)
+        return entries[0] if entries else None
     
     
+class ArchiveBufferReader(object):
+    # File-like reader over an archive held in one buffer. Reads of section data are returned
+    # as memoryview slices of the buffer instead of copies, small reads of header fields as bytes.
+    MAX_COPIED_READ = 0x100
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        self.pos = 0
+
+    def read(self, size=-1):
+        start = self.pos
+        if size < 0:
+            end = len(self.buffer)
+        else:
+            end = min(start + size, len(self.buffer))
+        self.pos = end
+
+        if end - start <= self.MAX_COPIED_READ:
+            return bytes(self.buffer[start:end])
+        else:
+            return self.buffer[start:end]
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += len(self.buffer)
+        self.pos = pos
+        return self.pos
+
+
+def read_gzip_into_buffer(path):
+    # The gzip trailer has the uncompressed size, decompressing straight into a buffer
+    # of that size avoids holding the data twice while the chunks are joined.
+    with open(path, "rb") as f:
+        f.seek(-4, os.SEEK_END)
+        size = unpack("<I", f.read(4))[0]
+
+    buffer = bytearray(size)
+    with gzip.open(path, "rb") as f:
+        view = memoryview(buffer)
+        pos = 0
+        while pos < size:
+            read = f.readinto(view[pos:pos+0x100000])
+            if read == 0:
+                break
+            pos += read
+        view.release()
+        rest = f.read()  # The trailer size is modulo 4 GB
+
+    if pos < size:
+        del buffer[pos:]
+    elif rest:
+        buffer += rest
+    return buffer
+
+
+def open_archive_buffer(path):
+    # Uncompressed archives are memory-mapped, compressed ones are decompressed once.
+    # Returns the buffer and the mmap that needs to be closed, if any.
+    if path.endswith(".gz"):
+        return read_gzip_into_buffer(path), None
+
+    with open(path, "rb") as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):  # Empty files can't be mapped
+            return f.read(), None
+    return mapped, mapped
+
+
 class Section(object):
     def __init__(self, secname, data):
         self.secname = secname
-        self.data = data 
+        self.data = data
+
+    # Data that is a memoryview into an archive buffer is only copied into bytes
+    # when it is accessed, writing the section uses the view directly.
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = bytes(self._view)
+            self._view = None
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        if isinstance(data, memoryview):
+            self._data = None
+            self._view = data
+        else:
+            self._data = data
+            self._view = None
+
+    def data_view(self):
+        if self._data is None:
+            return self._view
+        return self._data
+
+    def detach(self):
+        # Copies the data out of the archive buffer
+        if self._data is None:
+            self._data = bytes(self._view)
+            self._view = None
+
+    def snapshot(self):
+        # Copy of the section that keeps referencing the same data
+        section = copy.copy(self)
+        if isinstance(section._data, bytearray):
+            section._data = bytes(section._data)
+        return section
     
     @classmethod
     def from_file(cls, f):
@@ -34,8 +177,12 @@ class Section(object):
     
     def write(self, f):
         f.write(self.secname)
-        write_uint32(f, len(self.data))
-        f.write(self.data)
+        write_uint32(f, len(self.data_view()))
+        f.write(self.data_view())
+
+    # Number of bytes write() produces
+    def packed_size(self):
+        return 8 + len(self.data_view())
 
 
 class TextureArchive(Section):
@@ -45,6 +192,10 @@ class TextureArchive(Section):
         self.textures = textures
         self.is_bw1 = is_bw1
 
+        self._texture_index = ResourceIndex()
+        for tex in textures:
+            self._texture_index.add(tex.name.lower(), tex)
+
     @classmethod
     def from_file(cls, f):
         secname = f.read(4)
@@ -74,9 +225,11 @@ class TextureArchive(Section):
         return cls(secname, level_name, textures, is_bw1)
 
     def write(self, f):
+        # Sizes are calculated beforehand so the archive can be written to streams that can't seek
+        subarchive_size = 4 + sum(tex.packed_size() for tex in self.textures)
+
         f.write(self.secname)
-        archive_size = f.tell()
-        write_uint32(f, 0xFFAABBCC)  # Placeholder
+        write_uint32(f, 4 + len(self.level_name) + 8 + subarchive_size)
         write_uint32(f, len(self.level_name))
         f.write(self.level_name)
 
@@ -85,24 +238,32 @@ class TextureArchive(Section):
         else:
             f.write(b"FTBG")
 
-        subarchive_size = f.tell()
-        write_uint32(f, 0xFFAABBCC)
+        write_uint32(f, subarchive_size)
         write_uint32(f, len(self.textures))
         for tex in self.textures:
             tex.write(f)
 
-        end = f.tell()
-        f.seek(archive_size)
-        write_uint32(f, end-(archive_size+4))
-        f.seek(subarchive_size)
-        write_uint32(f, end-(subarchive_size+4))
-        f.seek(end)
+    def packed_size(self):
+        return 8 + 4 + len(self.level_name) + 8 + 4 + sum(tex.packed_size() for tex in self.textures)
+
+    def snapshot(self):
+        section = super().snapshot()
+        section.textures = [tex.snapshot() for tex in self.textures]
+        section._texture_index = ResourceIndex()
+        for tex in section.textures:
+            section._texture_index.add(tex.name.lower(), tex)
+        return section
 
     def get_texture(self, texname):
-        for tex in self.textures:
-            if tex.name.lower() == texname.lower():
-                return tex
-        return None
+        return self._texture_index.get(texname.lower())
+
+    def add_texture(self, texture):
+        self.textures.append(texture)
+        self._texture_index.add(texture.name.lower(), texture)
+
+    def remove_texture(self, texture):
+        self.textures.remove(texture)
+        self._texture_index.remove(texture.name.lower(), texture)
 
 
 class TextureBW1(Section):
@@ -135,12 +296,12 @@ class TextureBW1(Section):
 
         with open(os.path.join(dirpath, fname), "wb") as f:
             f.write(encoded_name)
-            f.write(self.data)
+            f.write(self.data_view())
 
     def dump_to_file(self, f):
         encoded_name = bytes(self.name, "ascii").ljust(0x10, b"\x00")
         f.write(encoded_name)
-        f.write(self.data)
+        f.write(self.data_view())
 
     @classmethod
     def from_filepath(cls, filepath):
@@ -155,9 +316,12 @@ class TextureBW1(Section):
         f.write(self.secname)
         encoded_name = bytes(self.name, "ascii").ljust(0x10, b"\x00")
         assert len(encoded_name) <= 0x10
-        write_uint32(f, 0x10+len(self.data))
+        write_uint32(f, 0x10+len(self.data_view()))
         f.write(encoded_name)
-        f.write(self.data)
+        f.write(self.data_view())
+
+    def packed_size(self):
+        return 8 + len(bytes(self.name, "ascii").ljust(0x10, b"\x00")) + len(self.data_view())
 
 
 class TextureBW2(Section):
@@ -190,12 +354,12 @@ class TextureBW2(Section):
 
         with open(os.path.join(dirpath, fname), "wb") as f:
             f.write(encoded_name)
-            f.write(self.data)
+            f.write(self.data_view())
 
     def dump_to_file(self, f):
         encoded_name = bytes(self.name, "ascii").ljust(0x20, b"\x00")
         f.write(encoded_name)
-        f.write(self.data)
+        f.write(self.data_view())
 
     @classmethod
     def from_filepath(cls, filepath):
@@ -210,9 +374,12 @@ class TextureBW2(Section):
         f.write(self.secname)
         encoded_name = bytes(self.name, "ascii").ljust(0x20, b"\x00")
         assert len(encoded_name) <= 0x20
-        write_uint32(f, 0x20+len(self.data))
+        write_uint32(f, 0x20+len(self.data_view()))
         f.write(encoded_name)
-        f.write(self.data)
+        f.write(self.data_view())
+
+    def packed_size(self):
+        return 8 + len(bytes(self.name, "ascii").ljust(0x20, b"\x00")) + len(self.data_view())
 
 
 class SoundArchive(Section):
@@ -249,8 +416,7 @@ class SoundArchive(Section):
 
     def write(self, f):
         f.write(b"DNOS")
-        archive_size = f.tell()
-        write_uint32(f, 0xFFAABBCC)  # Placeholder
+        write_uint32(f, self.packed_size() - 8)
         write_uint32(f, len(self.level_name))
         f.write(self.level_name)
         f.write(b"HFSB")
@@ -263,10 +429,14 @@ class SoundArchive(Section):
         if self._padding > 0:
             f.write(b"\x00"*self._padding)
 
-        end = f.tell()
-        f.seek(archive_size)
-        write_uint32(f, end-(archive_size+4))
-        f.seek(end)
+    def packed_size(self):
+        return (8 + 4 + len(self.level_name) + 12 + sum(sound.packed_size() for sound in self.sounds)
+                + max(self._padding, 0))
+
+    def snapshot(self):
+        section = super().snapshot()
+        section.sounds = [sound.snapshot() for sound in self.sounds]
+        return section
 
 
 class Sound(Section):
@@ -293,7 +463,7 @@ class Sound(Section):
     def dump_to_directory(self, dirpath):
         fname = self.name+".adp"
         with open(os.path.join(dirpath, fname), "wb") as f:
-            f.write(self.data)
+            f.write(self.data_view())
 
     @classmethod
     def from_filepath(cls, filepath):
@@ -310,8 +480,11 @@ class Sound(Section):
         assert len(encoded_name) <= 0x20
         f.write(encoded_name)
         f.write(b"DPSD")
-        write_uint32(f, len(self.data))
-        f.write(self.data)
+        write_uint32(f, len(self.data_view()))
+        f.write(self.data_view())
+
+    def packed_size(self):
+        return 8 + len(bytes(self.name, encoding="ascii").ljust(0x20, b"\x00")) + 8 + len(self.data_view())
 
 
 class Model(Section):
@@ -335,7 +508,7 @@ class Model(Section):
     def dump_to_directory(self, dirpath):
         fname = self.name+".modl"
         with open(os.path.join(dirpath, fname), "wb") as f:
-            f.write(self.data[8:])
+            f.write(self.data_view()[8:])
 
     @classmethod
     def from_filepath(cls, filepath):
@@ -350,10 +523,13 @@ class Model(Section):
     def write(self, f):
         f.write(b"LDOM")
         encoded_name = bytes(self.name, "ascii")
-        write_uint32(f, 4+len(encoded_name)+len(self.data))
+        write_uint32(f, 4+len(encoded_name)+len(self.data_view()))
         write_uint32(f, len(encoded_name))
         f.write(encoded_name)
-        f.write(self.data)
+        f.write(self.data_view())
+
+    def packed_size(self):
+        return 12 + len(bytes(self.name, "ascii")) + len(self.data_view())
 
 
 class Animation(Section):
@@ -376,7 +552,7 @@ class Animation(Section):
     def dump_to_directory(self, dirpath):
         fname = self.name+".anim"
         with open(os.path.join(dirpath, fname), "wb") as f:
-            f.write(self.data)
+            f.write(self.data_view())
 
     @classmethod
     def from_filepath(cls, filepath):
@@ -389,10 +565,13 @@ class Animation(Section):
     def write(self, f):
         f.write(b"MINA")
         encoded_name = bytes(self.name, "ascii")
-        write_uint32(f, 4+len(encoded_name)+len(self.data))
+        write_uint32(f, 4+len(encoded_name)+len(self.data_view()))
         write_uint32(f, len(encoded_name))
         f.write(encoded_name)
-        f.write(self.data)
+        f.write(self.data_view())
+
+    def packed_size(self):
+        return 12 + len(bytes(self.name, "ascii")) + len(self.data_view())
 
 
 class Effect(Section):
@@ -415,7 +594,7 @@ class Effect(Section):
     def dump_to_directory(self, dirpath):
         fname = self.name+".txt"
         with open(os.path.join(dirpath, fname), "wb") as f:
-            f.write(self.data)
+            f.write(self.data_view())
 
     @classmethod
     def from_filepath(cls, filepath):
@@ -428,10 +607,13 @@ class Effect(Section):
     def write(self, f):
         f.write(b"FEQT")
         encoded_name = bytes(self.name, "ascii")
-        write_uint32(f, 4+len(encoded_name)+len(self.data))
+        write_uint32(f, 4+len(encoded_name)+len(self.data_view()))
         write_uint32(f, len(encoded_name))
         f.write(encoded_name)
-        f.write(self.data)
+        f.write(self.data_view())
+
+    def packed_size(self):
+        return 12 + len(bytes(self.name, "ascii")) + len(self.data_view())
 
 
 class LuaScript(Section):
@@ -455,7 +637,7 @@ class LuaScript(Section):
     
     def dump_to_directory(self, dirpath):
         with open(os.path.join(dirpath, self.create_file_name()), "wb") as f:
-            f.write(self.data)
+            f.write(self.data_view())
     
     @classmethod
     def from_filepath(cls, path):
@@ -470,21 +652,45 @@ class LuaScript(Section):
     def write(self, f):
         f.write(self.secname)
         encoded_name = bytes(self.name, "ascii")
-        write_uint32(f, len(self.data)+4+len(encoded_name))
+        write_uint32(f, len(self.data_view())+4+len(encoded_name))
         write_uint32(f, len(encoded_name))
         f.write(encoded_name)
-        f.write(self.data)
+        f.write(self.data_view())
+
+    def packed_size(self):
+        return 12 + len(bytes(self.name, "ascii")) + len(self.data_view())
         
     
 ORDERLIST = [b"RXET", b"DNOS", b"LDOM", b"MINA", b"PRCS", b"FEQT"]
 ORDER = {v: i for i,v in enumerate(ORDERLIST)}
 
 
+def resource_key(resource):
+    return resource.secname, resource.name.lower()
+
+
 class BattalionArchive(object):
     def __init__(self):
         self.sections = []
         self.textures = None
         self.sounds = None
+
+        # Memory-mapped file the section data points into when loaded with from_path
+        self._mmap = None
+
+        # Case-insensitive (section type, name) index of all named resources,
+        # kept up to date by the add and delete methods.
+        self._index = ResourceIndex()
+
+    def _index_section(self, section):
+        if section is self.textures:
+            for tex in section.textures:
+                self._index.add(resource_key(tex), tex)
+        elif section is self.sounds:
+            for sound in section.sounds:
+                self._index.add(resource_key(sound), sound)
+        elif hasattr(section, "name"):
+            self._index.add(resource_key(section), section)
     
     @classmethod
     def from_file(cls, f):
@@ -513,37 +719,121 @@ class BattalionArchive(object):
                 else:
                     section = Section.from_file(f)
                 arc.sections.append(section)
+                arc._index_section(section)
             else:
                 break 
                 
         return arc
-    
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        # Sections keep views into the buffer, their data isn't copied until it is accessed
+        return cls.from_file(ArchiveBufferReader(buffer))
+
+    @classmethod
+    def from_path(cls, path):
+        buffer, mapped = open_archive_buffer(path)
+        arc = cls.from_buffer(buffer)
+        arc._mmap = mapped
+        return arc
+
+    def iter_all_sections(self):
+        for section in self.sections:
+            yield section
+            if section is self.textures:
+                yield from section.textures
+            elif section is self.sounds:
+                yield from section.sounds
+
+    def detach(self):
+        # Copies all section data out of the memory-mapped file and closes it. Needed before the
+        # file can be replaced on systems that don't allow replacing a mapped file.
+        if self._mmap is None:
+            return
+
+        for section in self.iter_all_sections():
+            section.detach()
+
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass  # Still referenced somewhere else, closed once that is garbage collected
+        self._mmap = None
+
+    def snapshot(self):
+        # Copy of the archive that can be written on another thread while this archive is edited.
+        # Section data isn't copied, it's only ever replaced and not changed in place.
+        if os.name == "nt":
+            # Windows doesn't allow replacing a file that is still mapped, so the copy can't point into it
+            self.detach()
+
+        arc = BattalionArchive()
+        for section in self.sections:
+            copied = section.snapshot()
+            if section is self.textures:
+                arc.textures = copied
+            elif section is self.sounds:
+                arc.sounds = copied
+            arc.sections.append(copied)
+            arc._index_section(copied)
+        return arc
+
     def write(self, f):
+        # The file the archive was loaded from must not be opened for writing while
+        # sections still point into it, use save() for that.
         self.sort_sections()
         for section in self.sections:
             section.write(f)
 
+    def packed_size(self):
+        return sum(section.packed_size() for section in self.sections)
+
+    def save(self, path):
+        # Streams the archive into a temporary file next to path that then replaces it, so sections
+        # that point into the memory-mapped old file can be written directly from there.
+        dirpath = os.path.dirname(os.path.abspath(path))
+        fd, tmppath = tempfile.mkstemp(dir=dirpath, prefix=os.path.basename(path), suffix=".tmp")
+        try:
+            if os.path.exists(path):
+                shutil.copymode(path, tmppath)
+            with open(fd, "wb") as f:
+                if path.endswith(".gz"):
+                    with gzip.GzipFile(filename=os.path.basename(path), mode="wb", fileobj=f) as g:
+                        self.write(g)
+                else:
+                    self.write(f)
+
+            try:
+                os.replace(tmppath, path)
+            except PermissionError:
+                # Windows doesn't allow replacing a file that is still mapped
+                self.detach()
+                os.replace(tmppath, path)
+        except:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
     def add_script(self, script: LuaScript):
-        for sec in self.sections:
-            if sec.secname == b"PRCS" and sec.name == script.name:
-                sec.data = script.data 
-                break 
+        sec = self.get_script(script.name)
+        if sec is not None:
+            sec.data = script.data
         else:
+            # Sections are sorted by type when written, sorting doesn't change the order of sections of one type
             self.sections.append(script)
-            self.sections.sort(key=lambda x: ORDER[x.secname])
+            self._index.add(resource_key(script), script)
     
     def delete_script(self, script_name):
-        for i in range(len(self.sections)):
-            sec = self.sections[i]
-            if sec.secname == b"PRCS" and sec.name == script_name:
-                self.sections.pop(i)
-                break
+        sec = self.get_script(script_name)
+        if sec is not None:
+            self.sections.remove(sec)
+            self._index.remove(resource_key(sec), sec)
 
     def get_script(self, script_name):
-        for i in range(len(self.sections)):
-            sec = self.sections[i]
-            if sec.secname == b"PRCS" and sec.name == script_name:
-                return self.sections[i]
+        # Script names are compared case-sensitively
+        for sec in self._index.get_all((b"PRCS", script_name.lower())):
+            if sec.name == script_name:
+                return sec
         return None
     
     def iter_sections(self, secname):
@@ -563,60 +853,41 @@ class BattalionArchive(object):
     def effects(self):
         yield from self.iter_sections(b"FEQT")
 
-    def _get_resource_list(self, restype):
-        resource_list = None
-        if restype in (b"DXTG", b"TXET"):
-            resource_list = self.textures.textures
-        elif restype in (b"HFSB", b"HPSD"):
-            resource_list = self.sounds.sounds
-        elif restype == b"MINA":
-            resource_list = self.animations()
-        elif restype == b"LDOM":
-            resource_list = self.models()
-        elif restype == b"FEQT":
-            resource_list = self.effects()
-
-        return resource_list
-
     def resource_exists(self, restype, resname):
-        resource_list = self._get_resource_list(restype)
-
-        for res in resource_list:
-            if res.secname == restype and res.name.lower() == resname.lower():
-                return True
-        return False
+        return self._index.get((restype, resname.lower())) is not None
 
     def get_resource(self, restype, resname):
-        resource_list = self._get_resource_list(restype)
-        for res in resource_list:
-            if res.secname == restype and res.name.lower() == resname.lower():
-                return res
-
-        return None
+        return self._index.get((restype, resname.lower()))
 
     def add_resource(self, resource):
         if isinstance(resource, TextureBW1):
             assert self.textures.is_bw1
-            self.textures.textures.append(resource)
+            self.textures.add_texture(resource)
         elif isinstance(resource, TextureBW2):
             assert not self.textures.is_bw1
-            self.textures.textures.append(resource)
+            self.textures.add_texture(resource)
         elif isinstance(resource, Sound):
             self.sounds.sounds.append(resource)
         elif isinstance(resource, (Model, Animation, Effect)):
             self.sections.append(resource)
+        else:
+            return
+        self._index.add(resource_key(resource), resource)
 
     def delete_resource(self, resource):
         if isinstance(resource, TextureBW1):
             assert self.textures.is_bw1
-            self.textures.textures.remove(resource)
+            self.textures.remove_texture(resource)
         elif isinstance(resource, TextureBW2):
             assert not self.textures.is_bw1
-            self.textures.textures.remove(resource)
+            self.textures.remove_texture(resource)
         elif isinstance(resource, Sound):
             self.sounds.sounds.remove(resource)
         elif isinstance(resource, (Model, Animation, Effect)):
             self.sections.remove(resource)
+        else:
+            return
+        self._index.remove(resource_key(resource), resource)
 
     def sort_sections(self):
         self.sections.sort(key=lambda x: ORDER[x.secname])
@@ -3,15 +3,17 @@ import os
 import io
 import platform
 import shutil
+import tempfile
 import json
 import sys
 import traceback
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import lib.lua.bwarchivelib as bwarchivelib
 from widgets.editor_widgets import open_yesno_box
-import gzip
 import re
+from bisect import bisect_right
 from hashlib import sha1
 
 currpath = __file__
@@ -39,6 +41,12 @@ def calc_script_hash(path):
         return sha1(data).digest()
 
 
+# Decompiled scripts by SHA-1 of the compiled script, shared between all levels
+DECOMP_CACHE_FOLDER = os.path.join(os.path.dirname(sys.argv[0]), "lua_decomp_cache")
+# Each decompilation is a separate java process so this mostly bounds the amount of running JVMs
+DECOMP_WORKERS = min(os.cpu_count() or 1, 8)
+COMPILE_WORKERS = min(os.cpu_count() or 1, 8)
+
 DECOMP_FIXES = {}
 script_fixes = os.listdir(DECOMP_FIX_FOLDER)
 for filename in script_fixes:
@@ -91,6 +99,27 @@ def decompile_unluac(path, out):
         raise RuntimeError("A decompiler error happened!\n{0}\nDo you have the correct version of Java installed? (Java 23/JDK 23, not Java 8!)".format(str(result)))
 
 
+def decompile_unluac_cached(path, out):
+    # Decompiles path to out unless the same compiled script has been decompiled before
+    cached_file = os.path.join(DECOMP_CACHE_FOLDER, calc_script_hash(path).hex()+".lua")
+    if os.path.exists(cached_file):
+        shutil.copyfile(cached_file, out)
+        return
+
+    decompile_unluac(path, out)
+
+    # Scripts are decompiled on several threads, so every writer gets its own temporary file
+    os.makedirs(DECOMP_CACHE_FOLDER, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(suffix=".tmp", dir=DECOMP_CACHE_FOLDER)
+    try:
+        with open(fd, "wb") as f, open(out, "rb") as src:
+            shutil.copyfileobj(src, f)
+        os.replace(tmp_file, cached_file)
+    except:
+        os.remove(tmp_file)
+        raise
+
+
 def compile_lua(path, out):
     err = io.StringIO()
     result = subprocess.run([LUAC_PATH, "-o", out, path], capture_output=True)
@@ -177,6 +206,115 @@ class EntityInitialization(object):
             del self.reflection_ids[id]
 
         
+class IndexedScript(object):
+    def __init__(self, path, stat):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.mtime = stat.st_mtime_ns
+        self.size = stat.st_size
+
+        with open(path, "r") as f:
+            self.text = f.read()
+        # Split on "\n" only, the same lines that iterating over the file gives.
+        # splitlines would also split on characters like \x0c and \u2028.
+        self.lines = [line + "\n" for line in self.text.split("\n")]
+        self.lines[-1] = self.lines[-1][:-1]
+        if not self.lines[-1]:
+            self.lines.pop()
+
+        # Offset of the start of every line in text
+        self.line_starts = [0]
+        for line in self.lines:
+            self.line_starts.append(self.line_starts[-1] + len(line))
+
+        self._lower = None
+
+    def is_outdated(self, stat):
+        return self.mtime != stat.st_mtime_ns or self.size != stat.st_size
+
+    @property
+    def lower(self):
+        # Lowercased text or None if lowercasing changes the length of some characters
+        # which would break the line offsets
+        if self._lower is None:
+            self._lower = self.text.lower()
+        if len(self._lower) != len(self.text):
+            return None
+        return self._lower
+
+    def matching_lines(self, find):
+        # find(start) returns the offset of the next match at or after start or -1
+        pos = find(0)
+        while pos != -1:
+            lineindex = bisect_right(self.line_starts, pos) - 1
+            if lineindex >= len(self.lines):
+                break
+            yield lineindex
+            pos = find(self.line_starts[lineindex+1])
+
+    def search(self, text, case_sensitive=True):
+        if case_sensitive:
+            content = self.text
+        else:
+            content = self.lower
+            text = text.lower()
+            if content is None:
+                for i, line in enumerate(self.lines):
+                    if text in line.lower():
+                        yield i+1, line
+                return
+
+        for lineindex in self.matching_lines(lambda start: content.find(text, start)):
+            yield lineindex+1, self.lines[lineindex]
+
+    def search_regex(self, pattern: re.Pattern):
+        def find(start):
+            match = pattern.search(self.text, start)
+            return -1 if match is None else match.start()
+
+        for lineindex in self.matching_lines(find):
+            yield lineindex+1, self.lines[lineindex]
+
+
+class LuaScriptIndex(object):
+    # Keeps the contents of all scripts in the workbench in memory for searching.
+    # Scripts are re-read when their modification time or size changes.
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.scripts: dict[str, IndexedScript] = {}
+
+    def update(self):
+        scripts = {}
+        for entry in os.scandir(self.workdir):
+            if not entry.name.endswith(".lua") or entry.name.lower() == "__lua_context__.lua":
+                continue
+
+            stat = entry.stat()
+            script = self.scripts.get(entry.path)
+            if script is None or script.is_outdated(stat):
+                script = IndexedScript(entry.path, stat)
+            scripts[entry.path] = script
+
+        self.scripts = scripts
+
+    def search(self, text, case_sensitive=True, regex=False):
+        # Returns (script file name, line number, line) for every line that contains the text
+        self.update()
+        results = []
+
+        if regex:
+            pattern = re.compile(text, re.MULTILINE | (0 if case_sensitive else re.IGNORECASE))
+            for script in self.scripts.values():
+                for lineno, line in script.search_regex(pattern):
+                    results.append((script.name, lineno, line))
+        else:
+            for script in self.scripts.values():
+                for lineno, line in script.search(text, case_sensitive):
+                    results.append((script.name, lineno, line))
+
+        return results
+
+
 class LuaWorkbench(object):
     def __init__(self, workdir):
         self.workdir = None
@@ -190,6 +328,13 @@ class LuaWorkbench(object):
         self.last_file_change = {}
         self.load_filechanges()
 
+        # Hashes of the script sources that the original and the last compiled .luap files belong to
+        self.decompiled_hashes = {}
+        self.compiled_hashes = {}
+        self.load_script_hashes()
+        # Compiled sections of this session by script name, with the hash of their source
+        self.compiled_sections = {}
+
         java_version()
 
     def save_filechanges(self):
@@ -211,9 +356,31 @@ class LuaWorkbench(object):
             traceback.print_exc()
             print("File changes file corrupted, skipping...")
 
+    def save_script_hashes(self):
+        hashpath = os.path.join(self.workdir, "script_hashes.json")
+        with open(hashpath, "w") as f:
+            json.dump({"decompiled": self.decompiled_hashes,
+                       "compiled": self.compiled_hashes}, f, indent=4)
+
+    def load_script_hashes(self):
+        hashpath = os.path.join(self.workdir, "script_hashes.json")
+        try:
+            with open(hashpath, "r") as f:
+                hashes = json.load(f)
+            self.decompiled_hashes = hashes["decompiled"]
+            self.compiled_hashes = hashes["compiled"]
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            traceback.print_exc()
+            print("Script hashes file corrupted, skipping...")
+
     def reset(self):
         self.entityinit.reset()
         self.last_file_change = {}
+        self.decompiled_hashes = {}
+        self.compiled_hashes = {}
+        self.compiled_sections = {}
 
     def setup_workdir(self):
         try:
@@ -290,6 +457,40 @@ class LuaWorkbench(object):
     def is_initialized(self):
         return os.path.exists(os.path.join(self.workdir, "EntityInitialise.lua"))
 
+    def decompile_scripts(self, script_names, progress_update=None):
+        # Decompiles the dumped scripts in parallel, returns the paths of the decompiled files
+        decompiled_files = []
+
+        with ThreadPoolExecutor(max_workers=DECOMP_WORKERS) as executor:
+            jobs = {}
+            for script_name in script_names:
+                compiled_file = os.path.join(self.tmp, script_name + ".luap")
+                decompiled_file = os.path.join(self.workdir, script_name + ".lua")
+                job = executor.submit(decompile_unluac_cached, compiled_file, decompiled_file)
+                jobs[job] = (script_name, decompiled_file)
+
+            try:
+                for i, job in enumerate(as_completed(jobs)):
+                    job.result()
+                    script_name, decompiled_file = jobs[job]
+                    print("decompiled", script_name)
+                    self.record_file_change(script_name)
+                    self.decompiled_hashes[script_name] = calc_script_hash(decompiled_file).hex()
+                    self.compiled_hashes.pop(script_name, None)
+                    self.compiled_sections.pop(script_name, None)
+                    decompiled_files.append(decompiled_file)
+
+                    if progress_update is not None:
+                        progress_update(i/len(script_names))
+            except:
+                for job in jobs:
+                    job.cancel()
+                raise
+            finally:
+                self.save_script_hashes()
+
+        return decompiled_files
+
     def unpack_scripts_archive(self, res, progress_update=None):
         script_names = []
 
@@ -300,19 +501,11 @@ class LuaWorkbench(object):
             script.dump_to_directory(self.tmp)
             script_names.append(script.name)
 
-        for i, script_name in enumerate(script_names):
-            print("decompiling", script_name)
-            compiled_file = os.path.join(self.tmp, script_name + ".luap")
-            decompiled_file = os.path.join(self.workdir, script_name + ".lua")
-            decompile_unluac(compiled_file, decompiled_file)
-            self.record_file_change(script_name)
+        for decompiled_file in self.decompile_scripts(script_names, progress_update):
             hash = calc_script_hash(decompiled_file)
             if hash in DECOMP_FIXES:
                 files_to_be_fixed.append((decompiled_file, DECOMP_FIXES[hash]))
 
-            if progress_update is not None:
-                progress_update(i/len(script_names))
-
         self.save_filechanges()
         self.clear_tmp_out()
 
@@ -335,22 +528,12 @@ class LuaWorkbench(object):
                 script.dump_to_directory(self.tmp)
                 script_names.append(script.name)
 
-        for script_name in script_names:
-            print("decompiling", script_name)
-            compiled_file = os.path.join(self.tmp, script_name + ".luap")
-            decompiled_file = os.path.join(self.workdir, script_name + ".lua")
-            decompile_unluac(compiled_file, decompiled_file)
-            self.record_file_change(script_name)
+        self.decompile_scripts(script_names)
 
         self.save_filechanges()
 
     def unpack_scripts(self, respath, progress_update=None):
-        if respath.endswith(".gz"):
-            with gzip.open(respath, "rb") as f:
-                res = bwarchivelib.BattalionArchive.from_file(f)
-        else:
-            with open(respath, "rb") as f:
-                res = bwarchivelib.BattalionArchive.from_file(f)
+        res = bwarchivelib.BattalionArchive.from_path(respath)
 
         self.unpack_scripts_archive(res, progress_update)
     
@@ -368,35 +551,92 @@ class LuaWorkbench(object):
             if fname.endswith(".luap"):
                 os.remove(os.path.join(self.tmp_out, fname))
 
+    def get_compiled_section(self, script_name, source_hash):
+        # Returns the compiled section of the script if it is up to date with the source, otherwise None
+        if script_name in self.compiled_sections:
+            section_hash, section = self.compiled_sections[script_name]
+            if section_hash == source_hash:
+                return section
+
+        compiled_file = os.path.join(self.tmp_out, script_name+".luap")
+        orig_file = os.path.join(self.tmp, script_name+".luap")
+
+        if script_name in self.compiled_hashes or script_name in self.decompiled_hashes:
+            if self.compiled_hashes.get(script_name) == source_hash and os.path.exists(compiled_file):
+                path = compiled_file
+            elif self.decompiled_hashes.get(script_name) == source_hash and os.path.exists(orig_file):
+                print("File unchanged, using", orig_file)
+                path = orig_file
+            else:
+                return None
+        else:
+            # Workbench unpacked before script hashes were recorded
+            if self.did_file_change(script_name):
+                return None
+            elif os.path.exists(compiled_file):
+                path = compiled_file
+            elif os.path.exists(orig_file):
+                print("File unchanged, using", orig_file)
+                path = orig_file
+            else:
+                return None
+
+        section = bwarchivelib.LuaScript.from_filepath(path)
+        self.compiled_sections[script_name] = (source_hash, section)
+        return section
+
+    def compile_scripts(self, script_names):
+        # Compiles the scripts in parallel, returns the compiled sections by script name
+        sections = {}
+
+        with ThreadPoolExecutor(max_workers=COMPILE_WORKERS) as executor:
+            jobs = {}
+            for script_name in script_names:
+                compiled_file = os.path.join(self.tmp_out, script_name+".luap")
+                decompiled_file = os.path.join(self.workdir, script_name+".lua")
+                source_hash = calc_script_hash(decompiled_file).hex()
+                job = executor.submit(compile_lua, decompiled_file, compiled_file)
+                jobs[job] = (script_name, compiled_file, source_hash)
+
+            try:
+                for job in as_completed(jobs):
+                    job.result()
+                    script_name, compiled_file, source_hash = jobs[job]
+                    print("compiled", script_name)
+                    section = bwarchivelib.LuaScript.from_filepath(compiled_file)
+                    self.compiled_sections[script_name] = (source_hash, section)
+                    self.compiled_hashes[script_name] = source_hash
+                    self.record_file_change(script_name)
+                    sections[script_name] = section
+            except:
+                for job in jobs:
+                    job.cancel()
+                raise
+            finally:
+                self.save_filechanges()
+                self.save_script_hashes()
+
+        return sections
+
     def repack_scripts(self, res, scripts=[], delete_rest=True, force=False):
-        script_sections = []
-        for script_name in scripts+["EntityInitialise"]:
-            print("compiling", script_name)
-            compiled_file = os.path.join(self.tmp_out, script_name+".luap")
+        script_names = scripts+["EntityInitialise"]
+        script_sections = {}
+        to_be_compiled = []
+
+        for script_name in script_names:
             decompiled_file = os.path.join(self.workdir, script_name+".lua")
-            if force:
-                compile_lua(decompiled_file, compiled_file)
-                self.record_file_change(script_name)
-                print("Force recompiled", script_name)
+            source_hash = calc_script_hash(decompiled_file).hex()
+
+            section = None if force else self.get_compiled_section(script_name, source_hash)
+            if section is None:
+                to_be_compiled.append(script_name)
             else:
-                if (not os.path.exists(compiled_file)
-                        or self.did_file_change(script_name)
-                        or script_name == "EntityInitialise"):
-
-                    if not os.path.exists(compiled_file) and not self.did_file_change(script_name):
-                        orig_file = os.path.join(self.tmp, script_name+".luap")
-                        print("File unchanged, copying", orig_file, "to", compiled_file)
-                        shutil.copy(orig_file, compiled_file)
-                    else:
-                        compile_lua(decompiled_file, compiled_file)
-                    self.record_file_change(script_name)
-                else:
-                    print(script_name, "hasn't changed, compile skipped")
-            
-            script_section = bwarchivelib.LuaScript.from_filepath(compiled_file)
-            script_sections.append(script_section)
+                print(script_name, "hasn't changed, compile skipped")
+                script_sections[script_name] = section
 
-        self.save_filechanges()
+        script_sections.update(self.compile_scripts(to_be_compiled))
+        if force:
+            print("Force recompiled", ", ".join(to_be_compiled))
 
         if delete_rest:
             scripts = [x for x in res.scripts()]
@@ -404,7 +644,8 @@ class LuaWorkbench(object):
                 print("deleting", script.name)
                 res.delete_script(script.name)
             
-        for script in script_sections:
+        for script_name in script_names:
+            script = script_sections[script_name]
             print("adding", script.name)
             res.add_script(script)
 
@@ -426,8 +667,12 @@ class LuaWorkbench(object):
                 result.append(fname.replace(".lua", ""))
         return result
 
+    def search_scripts(self, text, case_sensitive=True, regex=False):
+        return self.script_index.search(text, case_sensitive, regex)
+
     def set_workdir(self, workdir):
         self.workdir = workdir
+        self.script_index = LuaScriptIndex(workdir)
 
 
 if __name__ == "__main__":  
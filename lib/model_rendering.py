@@ -4,6 +4,7 @@ from OpenGL.GL import *
 from .vectors import Vector3, Triangle
 from struct import unpack
 import os
+import numpy
 from OpenGL.GL import *
 
 from PyQt6 import QtGui
@@ -154,8 +155,10 @@ class TexturedMesh(object):
 
 class TexturedBWMesh(object):
     def __init__(self, texname):
+        # (position, uv) of every vertex while the mesh is made, TexturedBWModel.compact turns it into
+        # the vertices array
         self.trilist = []
-
+        self.vertices = None
 
         self.texname = texname
         self._displist = None
@@ -168,11 +171,11 @@ class TexturedBWMesh(object):
         glNewList(displist, GL_COMPILE)
         glBegin(GL_TRIANGLES)
 
-        assert len(self.trilist) % 3 == 0
-        for vtxpos, uv in self.trilist:
-            if self.texname is not None and uv is not None:
-                glTexCoord2f(*uv)
-            glVertex3f(*vtxpos)
+        assert len(self.vertices) % 3 == 0
+        for x, y, z, u, v in self.vertices.tolist():
+            if self.texname is not None:
+                glTexCoord2f(u, v)
+            glVertex3f(x, y, z)
 
         glEnd()
         glEndList()
@@ -477,11 +480,28 @@ class TexturedBWModel(TexturedModel):
 
         self.boundsphere = (0, 0, 0)
         self.boundsphereradius = 0
+        # Position and UV of the vertices of all meshes, mesh by mesh
+        self.vertices = None
 
     def render(self, texarchive, selected=False):
         for mesh in self.mesh_list:
             mesh.render(texarchive, selected)
 
+    def compact(self):
+        # Moves the vertices of all meshes into one float32 array and gives every mesh a view of its part.
+        # The tuples in the trilists take several times more memory.
+        count = sum(len(mesh.trilist) for mesh in self.mesh_list)
+        self.vertices = numpy.empty((count, 5), dtype=numpy.float32)
+        offset = 0
+        for mesh in self.mesh_list:
+            trilist = mesh.trilist
+            if len(trilist) > 0:
+                self.vertices[offset:offset+len(trilist), 0:3] = [vtxpos for vtxpos, uv in trilist]
+                self.vertices[offset:offset+len(trilist), 3:5] = [uv for vtxpos, uv in trilist]
+            mesh.vertices = self.vertices[offset:offset+len(trilist)]
+            mesh.trilist = None
+            offset += len(mesh.vertices)
+
     def set_boundsphere(self, x, y, z, r):
         self.boundsphere = (x,y,z)
         self.boundsphereradius = r
@@ -5,7 +5,7 @@ import inspect
 
 
 from OpenGL.GL import *
-from lib.vectors import Vector3
+from lib.vectors import Vector3, frustum_planes, spheres_in_frustum
 from lib.shader import create_shader, ShaderCompilationError
 from struct import unpack
 import os
@@ -277,6 +277,10 @@ class VertexBuffer(object):
         assert self.initialized()
         glBufferData(GL_ARRAY_BUFFER, data, GL_DYNAMIC_DRAW)
 
+    def load_subdata(self, offset, data):
+        assert self.initialized()
+        glBufferSubData(GL_ARRAY_BUFFER, offset, data.nbytes, data)
+
     def initialized(self):
         return self._buffer is not None
 
@@ -318,6 +322,14 @@ class VertexUVBuffer(VertexBuffer):
         self.add_attribute(uv_attr_index,       2, GL_FLOAT, GL_FALSE, 5 * 4, 3 * 4)
 
 
+class VertexUVLayerBuffer(VertexBuffer):
+    def __init__(self, vtx_attr_index, uv_attr_index, layer_attr_index):
+        super().__init__()
+        self.add_attribute(vtx_attr_index,      3, GL_FLOAT, GL_FALSE, 6 * 4, 0 * 4)
+        self.add_attribute(uv_attr_index,       2, GL_FLOAT, GL_FALSE, 6 * 4, 3 * 4)
+        self.add_attribute(layer_attr_index,    1, GL_FLOAT, GL_FALSE, 6 * 4, 5 * 4)
+
+
 class MatrixBuffer(VertexBuffer):
     def __init__(self, mtx_attr_index):
         super().__init__()
@@ -333,6 +345,186 @@ class ExtraBuffer(VertexBuffer):
         self.add_attribute(extra_attr_index,  4,  GL_UNSIGNED_BYTE, normalize, 4, 0, divisor=1)
 
 
+class TerrainVertexBuffer(VertexBuffer):
+    def __init__(self, vtx_attr_index, color_attr_index, uv1_attr_index, uv2_attr_index, overlay_attr_index):
+        super().__init__()
+        self.add_attribute(vtx_attr_index,      3, GL_FLOAT, GL_FALSE, 13 * 4, 0 * 4)
+        self.add_attribute(color_attr_index,    4, GL_FLOAT, GL_FALSE, 13 * 4, 3 * 4)
+        self.add_attribute(uv1_attr_index,      2, GL_FLOAT, GL_FALSE, 13 * 4, 7 * 4)
+        self.add_attribute(uv2_attr_index,      2, GL_FLOAT, GL_FALSE, 13 * 4, 9 * 4)
+        self.add_attribute(overlay_attr_index,  2, GL_FLOAT, GL_FALSE, 13 * 4, 11 * 4)
+
+
+class TerrainMeshBuffer(object):
+    # GPU side of a terrain TerrainMesh: one vertex buffer and one index buffer in a VAO.
+    # Attribute locations match the default shader from lib.shader.
+    def __init__(self, mesh):
+        self.mesh = mesh
+        self.vao = glGenVertexArrays(1)
+        glBindVertexArray(self.vao)
+
+        self.vbo = TerrainVertexBuffer(0, 2, 3, 4, 5)
+        self.vbo.init()
+        glBufferData(GL_ARRAY_BUFFER, mesh.vertices, GL_STATIC_DRAW)
+
+        self.ibo = glGenBuffers(1)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibo)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, mesh.indices, GL_STATIC_DRAW)
+
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+
+    def render(self, planes=None):
+        glBindVertexArray(self.vao)
+        for start, count in self.mesh.visible_ranges(planes):
+            glDrawElements(GL_TRIANGLES, int(count), GL_UNSIGNED_INT, ctypes.c_void_p(int(start)*4))
+        glBindVertexArray(0)
+
+    def free(self):
+        glDeleteBuffers(2, [self.vbo._buffer, self.ibo])
+        glDeleteVertexArrays(1, [self.vao])
+        self.vbo._buffer = None
+        self.ibo = None
+        self.vao = None
+
+
+class InstanceArray(object):
+    # Instance matrices and extra data in preallocated arrays. Every instance keeps its slot until
+    # it is removed, so changing an instance only requires uploading its own slot again.
+    def __init__(self, capacity=16):
+        self.matrices = numpy.zeros((capacity, 16), dtype=numpy.float32)
+        self.extradata = numpy.zeros((capacity, 4), dtype=numpy.uint8)
+        self.keys = []
+        self.slots = {}
+        # Increased on every change so results computed from the instances can be reused
+        self.version = 0
+
+        self._changed_start = None
+        self._changed_end = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    @property
+    def capacity(self):
+        return len(self.matrices)
+
+    def _mark_changed(self, slot):
+        if self._changed_start is None or slot < self._changed_start:
+            self._changed_start = slot
+        if slot >= self._changed_end:
+            self._changed_end = slot + 1
+
+    def _grow(self):
+        # Buffers made from the old arrays have to be uploaded again as a whole, they notice the capacity change
+        capacity = self.capacity*2
+        matrices = numpy.zeros((capacity, 16), dtype=numpy.float32)
+        matrices[:len(self.matrices)] = self.matrices
+        extradata = numpy.zeros((capacity, 4), dtype=numpy.uint8)
+        extradata[:len(self.extradata)] = self.extradata
+        self.matrices = matrices
+        self.extradata = extradata
+
+    def set(self, key, mtx, extradata=None):
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = len(self.keys)
+            if slot == self.capacity:
+                self._grow()
+            self.keys.append(key)
+            self.slots[key] = slot
+
+        self.matrices[slot] = mtx
+        if extradata is not None:
+            self.extradata[slot] = extradata
+        self._mark_changed(slot)
+        self.version += 1
+
+    def remove(self, key):
+        # The last instance is moved into the freed slot so the instances stay contiguous
+        slot = self.slots.pop(key)
+        last = len(self.keys) - 1
+        lastkey = self.keys.pop()
+        if slot != last:
+            self.keys[slot] = lastkey
+            self.slots[lastkey] = slot
+            self.matrices[slot] = self.matrices[last]
+            self.extradata[slot] = self.extradata[last]
+            self._mark_changed(slot)
+        self.version += 1
+
+    def clear(self):
+        self.keys = []
+        self.slots = {}
+        self.version += 1
+
+    def pop_changes(self):
+        # Returns the range of slots that changed since the last call or None
+        if self._changed_start is None:
+            return None
+        changed = (self._changed_start, min(self._changed_end, self.capacity))
+        self._changed_start = None
+        self._changed_end = 0
+        return changed
+
+
+# Swaps y and z like the mtx in the instance shaders
+SWAP_YZ = numpy.array([[1.0, 0.0, 0.0, 0.0],
+                       [0.0, 0.0, 1.0, 0.0],
+                       [0.0, 1.0, 0.0, 0.0],
+                       [0.0, 0.0, 0.0, 1.0]])
+
+
+def bounding_sphere(positions):
+    # Center and radius of a sphere around all vertex positions given as an (n, 3) array
+    positions = numpy.asarray(positions, dtype=numpy.float64)
+    if len(positions) == 0:
+        return None
+    center = (positions.min(axis=0) + positions.max(axis=0)) / 2.0
+    radius = numpy.sqrt(((positions - center)**2).sum(axis=1).max())
+    return center, float(radius)
+
+
+class InstanceCuller(object):
+    # Tests the bounding spheres of instances against the view frustum and, if a distance is given,
+    # against their distance to the camera. The instance matrices are in level coordinates, so
+    # the frustum planes are made from the same matrix the instance shaders use.
+    def __init__(self, mvp, campos=None, distance=0.0):
+        self.planes = frustum_planes(numpy.dot(mvp, SWAP_YZ))
+        if campos is not None and distance > 0:
+            self.campos = numpy.array(campos, dtype=numpy.float64)
+        else:
+            self.campos = None
+        self.distance = distance
+        self.key = (self.planes.tobytes(),
+                    None if self.campos is None else self.campos.tobytes(),
+                    distance)
+
+    def visible(self, instances: InstanceArray, center, radius):
+        # Returns a bool array marking which instances of the array can be seen
+        return self.visible_matrices(instances.matrices[:len(instances)], numpy.asarray(center), radius)
+
+    def visible_matrices(self, matrices, centers, radii):
+        # Like visible for an (n, 16) array of matrices, with either one sphere for all matrices
+        # or an (n, 3) array of centers and an (n,) array of radii
+        matrices = matrices.reshape(-1, 4, 4)
+        # The matrices are column major, row i of each reshaped matrix is its i-th column
+        centers = (matrices[:, 3, :3] + centers[..., 0:1]*matrices[:, 0, :3]
+                   + centers[..., 1:2]*matrices[:, 1, :3] + centers[..., 2:3]*matrices[:, 2, :3])
+        # Scaled instances need a bigger sphere
+        radii = radii*numpy.sqrt((matrices[:, :3, :3]**2).sum(axis=2).max(axis=1))
+
+        visible = spheres_in_frustum(self.planes, centers, radii)
+        if self.campos is not None:
+            limit = self.distance + radii
+            visible &= ((centers - self.campos)**2).sum(axis=1) <= limit*limit
+        return visible
+
+
 class ModelV2(object):
     def __init__(self, uvcoords=False):
         self.mesh_list = []
@@ -425,17 +617,29 @@ void main (void)
         self.mtxdirty = True
         self.extrabuffer = ExtraBuffer(self.vertexshader.get_location("val"), normalize=GL_FALSE)
         self.coloridbuffer = ExtraBuffer(self.vertexshader.get_location("val"), normalize=GL_FALSE)
+        self.culledmtxbuffer = MatrixBuffer(self.vertexshader.get_location("instanceMatrix"))
+        self.culledextrabuffer = ExtraBuffer(self.vertexshader.get_location("val"), normalize=GL_FALSE)
+        self.vao_culled = None
+        self.boundsphere = None
         self._count = None
+        self._instances = None
+        self._instances_capacity = None
+        self._cull_key = None
+        self._culled_count = None
+
+    def upload_geometry(self):
+        # The vertices never change, they are uploaded once and the array is freed afterwards
+        if not self.vbo.initialized():
+            self.vbo.init()
+            self.vbo.load_data(numpy.asarray(self._triangles, dtype=numpy.float32))
+            self._triangles = None
 
     def build_mesh(self, array, extradata):
-        assert len(self._triangles) % 3 * 3 == 0
         if self.vao is None:
             self.vao = glGenVertexArrays(1)
         glBindVertexArray(self.vao)
 
-        self.vbo.init()
-        self.vbo.load_data(numpy.array(self._triangles, dtype=numpy.float32))
-
+        self.upload_geometry()
         self.rebuild_instance_array(array, extradata)
 
     def rebuild_instance_array(self, array, extradata):
@@ -464,6 +668,73 @@ void main (void)
 
         glBindVertexArray(self.vao)
 
+    def instance_buffers(self, instances: InstanceArray):
+        return ((self.mtxbuffer, instances.matrices), (self.extrabuffer, instances.extradata))
+
+    def culled_buffers(self, instances: InstanceArray):
+        return ((self.culledmtxbuffer, instances.matrices), (self.culledextrabuffer, instances.extradata))
+
+    def upload_instances(self, instances: InstanceArray):
+        # The buffers have the size of the arrays' capacity, so changed slots are updated in place
+        changed = instances.pop_changes()
+        if (self._instances is not instances or self._instances_capacity != instances.capacity
+                or not self.mtxbuffer.initialized()):
+            for buffer, array in self.instance_buffers(instances):
+                buffer.init()
+                buffer.load_data(array)
+            self._instances = instances
+            self._instances_capacity = instances.capacity
+        elif changed is not None:
+            start, end = changed
+            for buffer, array in self.instance_buffers(instances):
+                buffer.bind()
+                buffer.load_subdata(start*array.itemsize*array.shape[1], array[start:end])
+
+    def bind_instances(self, instances: InstanceArray, culler: InstanceCuller = None):
+        # Like bind, but the instances come from an InstanceArray and only changed ones are uploaded
+        if not self.program.compiled():
+            self.program.compile()
+
+        if self.vao is None:
+            self.vao = glGenVertexArrays(1)
+            glBindVertexArray(self.vao)
+            self.upload_geometry()
+
+        glBindVertexArray(self.vao)
+        self.upload_instances(instances)
+        self._count = len(instances)
+
+        if culler is not None and self.boundsphere is not None and self._count > 0:
+            self.bind_culled(instances, culler)
+
+        self.program.bind()
+
+    def bind_culled(self, instances: InstanceArray, culler: InstanceCuller):
+        # The visible instances are copied into a second set of buffers and drawn from there.
+        # Nothing is done again until the camera or the instances change.
+        key = (id(instances), instances.version, culler.key)
+        if key != self._cull_key:
+            visible = culler.visible(instances, *self.boundsphere)
+            if visible.all():
+                self._culled_count = None
+            else:
+                if self.vao_culled is None:
+                    self.vao_culled = glGenVertexArrays(1)
+                    glBindVertexArray(self.vao_culled)
+                    self.vbo.bind()
+                    self.vbo.attr_init()
+
+                glBindVertexArray(self.vao_culled)
+                for buffer, array in self.culled_buffers(instances):
+                    buffer.init()
+                    buffer.load_data(array[:len(instances)][visible])
+                self._culled_count = int(visible.sum())
+            self._cull_key = key
+
+        if self._culled_count is not None:
+            glBindVertexArray(self.vao_culled)
+            self._count = self._culled_count
+
     def bind_single(self):
         self.bind(None, None, render_one=True)
 
@@ -480,6 +751,7 @@ void main (void)
             self.mtxbuffer.attr_init()
 
         glBindVertexArray(self.vao_colorid)
+        self._count = len(extradata)
 
         #self.vbo.init()
         #self.vbo.load_data(numpy.array(self._triangles, dtype=numpy.float32))
@@ -607,7 +879,8 @@ void main (void)
                     #curr_mesh.triangles.append(((v1[0] - 1, None), (v3[0] - 1, None), (v2[0] - 1, None)))
         #model.add_mesh(curr_mesh)
         model.mesh_list.append((offset, count))
-        model._triangles = triangles
+        model._triangles = numpy.array(triangles, dtype=numpy.float32)
+        model.boundsphere = bounding_sphere(model._triangles.reshape(-1, 8 if uvcoords else 6)[:, :3])
         return model
         # elif cmd == "vn":
         #    nx, ny, nz = map(float, args[1:4])
@@ -763,24 +1036,29 @@ class BWModelV2(ModelV2):
         self.mtxbuffer = MatrixBuffer(self.vertexshader.get_location("instanceMatrix"))
         self.mtxdirty = True
         #self.extrabuffer = ExtraBuffer(self.vertexshader.get_location("val"), normalize=GL_FALSE)
+        self.culledmtxbuffer = MatrixBuffer(self.vertexshader.get_location("instanceMatrix"))
+        self.vao_culled = None
+        self.boundsphere = None
         self._count = None
+        self._instances = None
+        self._instances_capacity = None
+        self._cull_key = None
+        self._culled_count = None
 
     @classmethod
     def from_textured_bw_model(cls, bwmodel):
         model = cls()
+        # The vertices of the meshes are already behind each other in one array of position and UV
         offset = 0
         for bwmesh in bwmodel.mesh_list:
-            if len(bwmesh.trilist) == 0:
-                continue
-
-            model.mesh_list.append((offset, len(bwmesh.trilist)))
-            offset += len(bwmesh.trilist)
-
-            model.texnames.append(bwmesh.texname)
-            for vtxpos, vtxuv in bwmesh.trilist:
-                model._triangles.extend(vtxpos)
-                model._triangles.extend(vtxuv)
-
+            count = len(bwmesh.vertices)
+            if count > 0:
+                model.mesh_list.append((offset, count))
+                model.texnames.append(bwmesh.texname)
+            offset += count
+
+        model._triangles = bwmodel.vertices
+        model.boundsphere = bounding_sphere(bwmodel.vertices[:, 0:3])
         return model
 
     def rebuild_instance_array(self, array, extradata):
@@ -793,6 +1071,12 @@ class BWModelV2(ModelV2):
 
             self.mtxdirty = False
 
+    def instance_buffers(self, instances: InstanceArray):
+        return ((self.mtxbuffer, instances.matrices), )
+
+    def culled_buffers(self, instances: InstanceArray):
+        return ((self.culledmtxbuffer, instances.matrices), )
+
     def render(self, texarchive, mtx):
         glUniformMatrix4fv(self.mtxloc, 1, False, mtx)
         #glUniformMatrix4fv(self.mtxloc, 1, False, mtx)
@@ -828,6 +1112,260 @@ class BWModelV2(ModelV2):
                 glDrawArraysInstanced(GL_TRIANGLES, offset, vertexcount, self._count)
 
 
+class ModelBatch(object):
+    # All models of a level in one vertex buffer, with their textures in one texture array per texture
+    # size. Every mesh is one indirect draw command, so the models are drawn with a single
+    # glMultiDrawArraysIndirect call per texture array no matter how many models there are.
+    # Layers every OpenGL 4.3 implementation supports in a texture array
+    MAX_LAYERS = 2048
+
+    def __init__(self):
+        self.model_index = {}
+        self.centers = None
+        self.radii = None
+        # Per mesh, sorted by texture array
+        self.mesh_models = None
+        self.mesh_firsts = None
+        self.mesh_counts = None
+        self.mesh_arrays = None
+
+        self.texture_arrays = []
+        self._vertices = None
+        self._textures = None
+
+        self.vertexshader = Shader.create("""
+        #version 330 compatibility
+        layout(location = 0) in vec3 vert;
+        layout(location = 2) in mat4 instanceMatrix;
+        layout(location = 7) in vec2 uv;
+        layout(location = 8) in float layer;
+
+        out vec3 texCoord;
+
+        mat4 mtx = mat4(1.0, 0.0, 0.0, 0.0,
+                        0.0, 0.0, 1.0, 0.0,
+                        0.0, 1.0, 0.0, 0.0,
+                        0.0, 0.0, 0.0, 1.0);
+
+        void main(void)
+        {
+            texCoord = vec3(uv, layer);
+            gl_Position = gl_ModelViewProjectionMatrix*mtx*instanceMatrix*vec4(vert, 1.0);
+        }
+        """)
+
+        self.fragshader = Shader.create("""
+        #version 330
+        in vec3 texCoord;
+        out vec4 finalColor;
+
+        uniform sampler2DArray tex;
+
+        void main (void)
+        {
+            finalColor = texture(tex, texCoord);
+        }
+        """)
+        self.program = Program(self.vertexshader, self.fragshader)
+        self.vbo = VertexUVLayerBuffer(*self.vertexshader.get_locations("vert", "uv", "layer"))
+        self.mtxbuffer = MatrixBuffer(self.vertexshader.get_location("instanceMatrix"))
+        self.commandbuffer = None
+        self.vao = None
+
+        self.draws = []
+        self._instances_key = None
+
+    @staticmethod
+    def supported():
+        if not bool(glMultiDrawArraysIndirect):
+            return False
+        version = (glGetIntegerv(GL_MAJOR_VERSION), glGetIntegerv(GL_MINOR_VERSION))
+        return version >= (4, 3)
+
+    @classmethod
+    def from_models(cls, models, texarchive):
+        # models are the TexturedBWModels by name. Textures are read from the decoded images
+        # so no OpenGL texture is made for every single texture.
+        batch = cls()
+
+        # Texture arrays are made per texture size, textures that can't be loaded are white
+        white = numpy.full((1, 1, 4), 255, dtype=numpy.uint8)
+        layers = {}
+        sizes = {}
+        texture_arrays = []
+
+        def get_layer(texname):
+            if texname is None:
+                texname = ""
+            texname = texname.lower()
+            if texname not in layers:
+                image = None
+                tex = texarchive.load_image(texname) if texname in texarchive.textures else None
+                if tex is not None and len(tex.mipmaps) > 0:
+                    image = tex.texture
+                    if image.mode != "RGBA":
+                        image = image.convert("RGBA")
+                size = (1, 1) if image is None else (image.width, image.height)
+                if size not in sizes or len(texture_arrays[sizes[size]][1]) == cls.MAX_LAYERS:
+                    sizes[size] = len(texture_arrays)
+                    texture_arrays.append((size, []))
+                array = sizes[size]
+                images = texture_arrays[array][1]
+                layers[texname] = (array, len(images))
+                images.append(white.tobytes() if image is None else image.tobytes())
+            return layers[texname]
+
+        vertexcount = sum(len(model.vertices) for model in models.values())
+        vertices = numpy.empty((vertexcount, 6), dtype=numpy.float32)
+        batch.centers = numpy.zeros((len(models), 3))
+        batch.radii = numpy.zeros(len(models))
+        mesh_models = []
+        mesh_firsts = []
+        mesh_counts = []
+        mesh_arrays = []
+
+        offset = 0
+        for i, (name, model) in enumerate(models.items()):
+            batch.model_index[name] = i
+            for mesh in model.mesh_list:
+                count = len(mesh.vertices)
+                if count == 0:
+                    continue
+                array, layer = get_layer(mesh.texname)
+                vertices[offset:offset+count, 0:5] = mesh.vertices
+                vertices[offset:offset+count, 5] = layer
+                mesh_models.append(i)
+                mesh_firsts.append(offset)
+                mesh_counts.append(count)
+                mesh_arrays.append(array)
+                offset += count
+
+            sphere = bounding_sphere(model.vertices[:, 0:3])
+            if sphere is not None:
+                batch.centers[i], batch.radii[i] = sphere
+
+        order = numpy.argsort(numpy.array(mesh_arrays, dtype=numpy.int64), kind="stable")
+        batch.mesh_models = numpy.array(mesh_models, dtype=numpy.int64)[order]
+        batch.mesh_firsts = numpy.array(mesh_firsts, dtype=numpy.uint32)[order]
+        batch.mesh_counts = numpy.array(mesh_counts, dtype=numpy.uint32)[order]
+        batch.mesh_arrays = numpy.array(mesh_arrays, dtype=numpy.int64)[order]
+
+        batch._vertices = vertices
+        batch._textures = texture_arrays
+        return batch
+
+    def upload(self):
+        # Geometry and textures are uploaded once and the arrays are freed afterwards
+        self.vao = glGenVertexArrays(1)
+        glBindVertexArray(self.vao)
+        self.vbo.init()
+        self.vbo.load_data(self._vertices)
+        self.mtxbuffer.init()
+        self.commandbuffer = glGenBuffers(1)
+        self._vertices = None
+
+        for (width, height), images in self._textures:
+            ID = glGenTextures(1)
+            glBindTexture(GL_TEXTURE_2D_ARRAY, ID)
+            glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+            glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_BASE_LEVEL, 0)
+            glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAX_LEVEL, 0)
+            glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+            glTexImage3D(GL_TEXTURE_2D_ARRAY, 0, GL_RGBA8, width, height, len(images), 0,
+                         GL_RGBA, GL_UNSIGNED_BYTE, None)
+            for layer, rgba in enumerate(images):
+                glTexSubImage3D(GL_TEXTURE_2D_ARRAY, 0, 0, 0, layer, width, height, 1,
+                                GL_RGBA, GL_UNSIGNED_BYTE, rgba)
+            self.texture_arrays.append(ID)
+        glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+        self._textures = None
+
+    def free(self):
+        if self.vao is not None:
+            self.vbo.free()
+            self.mtxbuffer.free()
+            glDeleteBuffers(1, [self.commandbuffer])
+            glDeleteTextures(self.texture_arrays)
+            glDeleteVertexArrays(1, [self.vao])
+            self.vao = None
+            self.commandbuffer = None
+            self.texture_arrays = []
+
+    def update_instances(self, modelinstances, culler=None):
+        # The instances of all models are put behind each other in model order so every model's
+        # instances can be addressed with a base instance. Nothing is done again until the
+        # camera or the instances change.
+        arrays = sorted((self.model_index[name], instances) for name, instances in modelinstances.items()
+                        if len(instances) > 0 and name in self.model_index)
+        key = ([(i, id(instances), instances.version) for i, instances in arrays],
+               None if culler is None else culler.key)
+        if key == self._instances_key:
+            return
+        self._instances_key = key
+
+        self.draws = []
+        if not arrays:
+            return
+
+        matrices = numpy.concatenate([instances.matrices[:len(instances)] for i, instances in arrays])
+        instance_models = numpy.repeat([i for i, instances in arrays], [len(instances) for i, instances in arrays])
+        if culler is not None:
+            visible = culler.visible_matrices(matrices, self.centers[instance_models], self.radii[instance_models])
+            matrices = matrices[visible]
+            instance_models = instance_models[visible]
+
+        counts = numpy.bincount(instance_models, minlength=len(self.model_index))
+        bases = numpy.cumsum(counts) - counts
+        instancecounts = counts[self.mesh_models]
+        drawn = instancecounts > 0
+        # DrawArraysIndirectCommand: count, instance count, first vertex, base instance
+        commands = numpy.stack([self.mesh_counts[drawn],
+                                instancecounts[drawn],
+                                self.mesh_firsts[drawn],
+                                bases[self.mesh_models[drawn]]], axis=1).astype(numpy.uint32)
+        if len(commands) == 0:
+            return
+
+        self.mtxbuffer.bind()
+        self.mtxbuffer.load_data(matrices)
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, self.commandbuffer)
+        glBufferData(GL_DRAW_INDIRECT_BUFFER, commands, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, 0)
+
+        drawcounts = numpy.bincount(self.mesh_arrays[drawn], minlength=len(self.texture_arrays))
+        starts = numpy.cumsum(drawcounts) - drawcounts
+        self.draws = [(self.texture_arrays[array], int(starts[array]), int(drawcounts[array]))
+                      for array in range(len(drawcounts)) if drawcounts[array] > 0]
+
+    def render(self, modelinstances, culler=None):
+        if not self.program.compiled():
+            self.program.compile()
+
+        if self.vao is None:
+            self.upload()
+
+        glBindVertexArray(self.vao)
+        self.update_instances(modelinstances, culler)
+        if not self.draws:
+            glBindVertexArray(0)
+            return
+
+        self.program.bind()
+        glUniform1i(self.program.getuniformlocation("tex"), 0)
+        glActiveTexture(GL_TEXTURE0)
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, self.commandbuffer)
+        for ID, start, drawcount in self.draws:
+            glBindTexture(GL_TEXTURE_2D_ARRAY, ID)
+            glMultiDrawArraysIndirect(GL_TRIANGLES, ctypes.c_void_p(start*16), drawcount, 0)
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, 0)
+        glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+
+        glUseProgram(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindVertexArray(0)
+
+
 class LineDrawing(object):
     def __init__(self):
         self.vertexshader = Shader.create("""
@@ -45,6 +45,49 @@ class QueryDepthTooDeepError(Exception):
     pass
 
 
+_MISSING = object()
+
+# Upper bound for the number of (types, fields) alternatives a query is split into for pruning,
+# queries with more alternatives are evaluated on every object instead.
+MAX_ALTERNATIVES = 64
+
+NO_CONSTRAINT = [(None, frozenset())]
+
+
+class Constant(object):
+    # Compiled unit whose result doesn't depend on the object, e.g. self.type = cTroop for a known type
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, obj):
+        return self.value
+
+
+class TypeOnly(object):
+    def __init__(self, objtype):
+        self.type = objtype
+
+
+def combine_constraints(a, b):
+    # Each alternative is (set of types or None for any type, fields that have to exist)
+    result = []
+    for types_a, fields_a in a:
+        for types_b, fields_b in b:
+            if types_a is None:
+                types = types_b
+            elif types_b is None:
+                types = types_a
+            else:
+                types = types_a & types_b
+                if not types:
+                    continue
+            result.append((types, fields_a | fields_b))
+
+    if len(result) > MAX_ALTERNATIVES:
+        return NO_CONSTRAINT
+    return result
+
+
 class Field(List):
     grammar = Keyword("self"), optional(".", word, maybe_some(".", word))
 
@@ -66,6 +109,59 @@ class Field(List):
         else:
             return "self."+".".join(self)
 
+    def compile(self, objtype=None):
+        # Returns a function that does the same as evaluate()
+        path = tuple(str(name) for name in self)
+        description = str(self)
+        if len(path) == 0:
+            return lambda obj: [obj]
+        elif len(path) == 1:
+            name = path[0]
+
+            def resolve_single(obj):
+                curr = getattr(obj, name, _MISSING)
+                if curr is _MISSING:
+                    return []
+                elif isinstance(curr, list):
+                    if len(curr) > 1000:
+                        raise QueryDepthTooDeepError("Search term causes too many fields to be expanded! {1}: {0} > 1000".format(len(curr), description))
+                    return curr
+                else:
+                    return [curr]
+
+            return resolve_single
+
+        last = len(path) - 1
+
+        def resolve(obj, i):
+            curr = getattr(obj, path[i], _MISSING)
+            if curr is _MISSING:
+                return []
+
+            if i == last:
+                values = curr if isinstance(curr, list) else [curr]
+            elif isinstance(curr, list):
+                values = []
+                for val in curr:
+                    values.extend(resolve(val, i+1))
+            else:
+                values = resolve(curr, i+1)
+
+            if len(values) > 1000:
+                raise QueryDepthTooDeepError("Search term causes too many fields to be expanded! {1}: {0} > 1000".format(len(values), description))
+            return values
+
+        return lambda obj: resolve(obj, 0)
+
+    def compile_values(self):
+        return self.compile()
+
+    def constraints(self, strict):
+        # A field is only truthy on its own if the object has the field
+        if strict and len(self) > 0:
+            return [(None, frozenset([str(self[0])]))]
+        return NO_CONSTRAINT
+
     def _evaluate_recursive(self, obj, remainingfields):
         values = []
 
@@ -251,6 +347,34 @@ class StringContentCheck(List):
 
             return result
 
+    def compile(self):
+        get_values = self[0].compile()
+        check = self[1].action
+        text = self[2]
+
+        def evaluate(obj):
+            for val in get_values(obj):
+                try:
+                    if isinstance(val, str):
+                        tmpresult = check(val, text)
+                    else:
+                        tmpresult = False
+                except ValueError:
+                    tmpresult = False
+
+                if tmpresult:
+                    return True
+            return False
+
+        return evaluate
+
+    def compile_values(self):
+        return self[0].compile()
+
+    def constraints(self, strict):
+        # No values means the comparison is False
+        return self[0].constraints(True)
+
     def get_values(self, obj):
         return self[0].evaluate(obj)
 
@@ -287,6 +411,49 @@ class Equal(List):
 
             return result
 
+    def compile(self):
+        get_values = self[0].compile()
+        op = self[1].action
+        value = self[2]
+        compare_none = value.lower() in ("none", "0")
+        # Conversions that fail make the comparison False for values of that type
+        bool_value = convert_or_missing(getattr(value, "convert_bool", None))
+        int_value = convert_or_missing(value.convert)
+        float_value = convert_or_missing(lambda: float(value))
+
+        def evaluate(obj):
+            for val in get_values(obj):
+                try:
+                    if val.__class__ is str:
+                        tmpresult = op(val, value)
+                    elif val is None and compare_none:
+                        tmpresult = op(val, None)
+                    elif isinstance(val, bool):
+                        tmpresult = bool_value is not _MISSING and op(val, bool_value)
+                    elif isinstance(val, int):
+                        tmpresult = int_value is not _MISSING and op(val, int_value)
+                    elif isinstance(val, (float, float32)):
+                        tmpresult = float_value is not _MISSING and op(val, float_value)
+                    else:
+                        tmpresult = op(val, value)
+                except ValueError:
+                    tmpresult = False
+
+                if tmpresult:
+                    return True
+            return False
+
+        return evaluate
+
+    def compile_values(self):
+        return self[0].compile()
+
+    def constraints(self, strict):
+        if (len(self[0]) == 1 and self[0][0] == "type" and isinstance(self[1], EqualOperator)
+                and self[2].lower() not in ("none", "0")):
+            return [(frozenset([str(self[2])]), frozenset())]
+        return self[0].constraints(True)
+
     def get_values(self, obj):
         return self[0].evaluate(obj)
 
@@ -322,6 +489,40 @@ class NumberCompare(List):
 
             return result
 
+    def compile(self):
+        get_values = self[0].compile()
+        op = self[1].action
+        number = self[2].convert()
+        float_number = float(self[2])
+
+        def evaluate(obj):
+            for val in get_values(obj):
+                try:
+                    if isinstance(val, str) and val.isdigit():
+                        val = int(val)
+                    if isinstance(val, int):
+                        tmpresult = op(val, number)
+                    elif isinstance(val, (float, float32)):
+                        tmpresult = op(val, float_number)
+                    else:
+                        tmpresult = False
+                except ValueError as err:
+                    print(err)
+                    tmpresult = False
+
+                if tmpresult:
+                    return True
+            return False
+
+        return evaluate
+
+    def compile_values(self):
+        return self[0].compile()
+
+    def constraints(self, strict):
+        # No values means the comparison is False
+        return self[0].constraints(True)
+
     def get_values(self, obj):
         return self[0].evaluate(obj)
 
@@ -335,6 +536,18 @@ class Comparison(List):
     def get_values(self, obj):
         return self[0].get_values(obj)
 
+    def compile(self, objtype=None):
+        # If the object type is known comparisons on the type are only evaluated once
+        if objtype is not None and list(self[0][0]) == ["type"]:
+            return Constant(self[0].evaluate(TypeOnly(objtype)))
+        return self[0].compile()
+
+    def compile_values(self):
+        return self[0].compile_values()
+
+    def constraints(self, strict):
+        return self[0].constraints(strict)
+
 
 class AndOrUnit(List):
     grammar = [Comparison, Field], maybe_some(maybe_some(whitespace), [And, Or], maybe_some(whitespace), [Comparison, Field])
@@ -376,6 +589,75 @@ class AndOrUnit(List):
 
         return values
 
+    def split_and_units(self):
+        andunits = []
+        currunit = []
+
+        for unit in self:
+            if isinstance(unit, Or):
+                andunits.append(currunit)
+                currunit = []
+            elif not isinstance(unit, And):
+                currunit.append(unit)
+        andunits.append(currunit)
+
+        return andunits
+
+    def compile(self, objtype=None):
+        if len(self) == 1:
+            return self[0].compile(objtype)
+
+        andunits = []
+        for andunit in self.split_and_units():
+            units = []
+            for unit in andunit:
+                compiled = unit.compile(objtype)
+                if isinstance(compiled, Constant):
+                    if compiled.value is False:
+                        break
+                else:
+                    units.append(compiled)
+            else:
+                if len(units) == 0:
+                    return Constant(True)
+                andunits.append(units)
+
+        if len(andunits) == 0:
+            return Constant(False)
+        elif len(andunits) == 1 and len(andunits[0]) == 1:
+            unit = andunits[0][0]
+            return lambda obj: unit(obj) is not False
+
+        def evaluate(obj):
+            for andunit in andunits:
+                for unit in andunit:
+                    if unit(obj) is False:
+                        break
+                else:
+                    return True
+            return False
+
+        return evaluate
+
+    def compile_values(self):
+        return compile_values_of(self)
+
+    def constraints(self, strict):
+        if len(self) == 1:
+            return self[0].constraints(strict)
+
+        result = []
+        for andunit in self.split_and_units():
+            alternatives = NO_CONSTRAINT
+            for unit in andunit:
+                # Units are only checked for being False here, not for being truthy
+                alternatives = combine_constraints(alternatives, unit.constraints(False))
+            result.extend(alternatives)
+
+        if len(result) > MAX_ALTERNATIVES:
+            return NO_CONSTRAINT
+        return result
+
 
 class BracketedUnit(List):
     grammar = "(", AndOrUnit, ")"
@@ -383,6 +665,15 @@ class BracketedUnit(List):
     def evaluate(self, obj):
         return self[0].evaluate(obj)
 
+    def compile(self, objtype=None):
+        return self[0].compile(objtype)
+
+    def compile_values(self):
+        return compile_values_of(self)
+
+    def constraints(self, strict):
+        return self[0].constraints(strict)
+
     def get_values(self, obj):
         values = []
         for unit in self:
@@ -396,6 +687,108 @@ class QueryGrammar(AndOrUnit):
     grammar = [BracketedUnit, AndOrUnit], maybe_some(maybe_some(whitespace), [And, Or], maybe_some(whitespace), [BracketedUnit, AndOrUnit])
 
 
+def convert_or_missing(convert):
+    if convert is None:
+        return _MISSING
+    try:
+        return convert()
+    except ValueError:
+        return _MISSING
+
+
+def compile_values_of(units):
+    value_getters = [unit.compile_values() for unit in units if hasattr(unit, "get_values")]
+
+    def get_values(obj):
+        values = []
+        for getter in value_getters:
+            values.extend(getter(obj))
+        return values
+
+    return get_values
+
+
+class TypeFieldIndex(object):
+    # Lazily built lists of the objects of a type that can have a field, for one search over a level file.
+    # Objects of a type usually share their fields so only types where the first object lacks the field are scanned.
+    def __init__(self, categories):
+        self.categories = categories
+        self._objects = {}
+        self._with_field = {}
+
+    def objects(self, objtype):
+        if objtype not in self._objects:
+            self._objects[objtype] = list(self.categories[objtype].values())
+        return self._objects[objtype]
+
+    def objects_with_field(self, objtype, field):
+        key = (objtype, field)
+        if key not in self._with_field:
+            objects = self.objects(objtype)
+            if len(objects) == 0 or hasattr(objects[0], field):
+                self._with_field[key] = objects
+            else:
+                self._with_field[key] = [obj for obj in objects if hasattr(obj, field)]
+        return self._with_field[key]
+
+    def candidates(self, objtype, alternatives):
+        # Objects of the type that can match at least one of the alternatives
+        objects = self.objects(objtype)
+        matching = []
+        for fields in alternatives:
+            if not fields:
+                return objects
+            smallest = min((self.objects_with_field(objtype, field) for field in fields), key=len)
+            if len(smallest) == len(objects):
+                return objects
+            matching.append(smallest)
+
+        if len(matching) == 1:
+            return matching[0]
+        else:
+            ids = set()
+            for candidates in matching:
+                ids.update(id(obj) for obj in candidates)
+            return [obj for obj in objects if id(obj) in ids]
+
+
+class CompiledQuery(object):
+    def __init__(self, query):
+        self.query = query
+        self.evaluate = query.compile()
+        self.get_values = query.compile_values()
+        self.alternatives = query.constraints(True)
+        self._type_evaluators = {}
+
+    def type_evaluator(self, objtype):
+        if objtype not in self._type_evaluators:
+            self._type_evaluators[objtype] = self.query.compile(objtype)
+        return self._type_evaluators[objtype]
+
+    def search(self, level_file):
+        # Returns (object, values) for every matching object, grouped by object type
+        results = []
+        index = TypeFieldIndex(level_file.category)
+        get_values = self.get_values
+
+        for objtype in level_file.category:
+            alternatives = [fields for types, fields in self.alternatives if types is None or objtype in types]
+            if not alternatives:
+                continue
+
+            evaluate = self.type_evaluator(objtype)
+            if isinstance(evaluate, Constant):
+                if evaluate.value:
+                    results.extend((obj, get_values(obj)) for obj in index.candidates(objtype, alternatives))
+                continue
+
+            for obj in index.candidates(objtype, alternatives):
+                if evaluate(obj):
+                    results.append((obj, get_values(obj)))
+
+        return results
+
+
 
 
 
@@ -422,6 +815,10 @@ def create_query(querytext):
     return parse(querytext, QueryGrammar)
 
 
+def compile_query(querytext):
+    return CompiledQuery(create_query(querytext))
+
+
 # Levenshtein distance implemented according to https://en.wikipedia.org/wiki/Levenshtein_distance
 def tail(a):
     if len(a) == 1:
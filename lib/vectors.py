@@ -1,5 +1,6 @@
 from math import sqrt, inf
 from io import StringIO
+import numpy
 from numpy import array
 
 
@@ -467,3 +468,38 @@ class Matrix4x4(object):
         out.write("\n}")
 
         return out.getvalue()
+
+
+def frustum_planes(mvp):
+    # Extracts the six clip planes (left, right, bottom, top, near, far) from a
+    # projection*modelview matrix as rows of (a, b, c, d) with ax + by + cz + d >= 0
+    # for points inside the frustum.
+    mvp = numpy.asarray(mvp, dtype=numpy.float64)
+    planes = numpy.array([
+        mvp[3] + mvp[0],
+        mvp[3] - mvp[0],
+        mvp[3] + mvp[1],
+        mvp[3] - mvp[1],
+        mvp[3] + mvp[2],
+        mvp[3] - mvp[2]
+    ])
+    lengths = numpy.linalg.norm(planes[:, :3], axis=1)
+    lengths[lengths == 0] = 1.0
+    return planes / lengths[:, None]
+
+
+def aabbs_in_frustum(planes, mins, maxs):
+    # Returns a bool array marking which of the boxes given as (n, 3) arrays
+    # of min and max corners are at least partially inside the frustum.
+    normals = planes[:, :3]
+    # The corner of each box that lies furthest along each plane normal
+    corners = numpy.where(normals[None, :, :] >= 0, maxs[:, None, :], mins[:, None, :])
+    distances = numpy.einsum("npk,pk->np", corners, normals) + planes[:, 3]
+    return numpy.all(distances >= 0, axis=1)
+
+
+def spheres_in_frustum(planes, centers, radii):
+    # Returns a bool array marking which of the spheres given as an (n, 3) array
+    # of centers and an (n,) array of radii are at least partially inside the frustum.
+    distances = numpy.dot(centers, planes[:, :3].T) + planes[:, 3]
+    return numpy.all(distances >= -radii[:, None], axis=1)
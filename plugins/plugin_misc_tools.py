@@ -327,6 +327,7 @@ class Plugin(object):
                     newid = random.randint(1, 800000)
 
                 obj._node.attrib["id"] = str(newid)
+                obj.touch()
                 assert newid not in newids
                 newids[newid] = True
 
@@ -991,6 +991,7 @@ class Plugin(object):
                 else:
                     if "isroot" in obj._node.attrib:
                         del obj._node.attrib["isroot"]
+                obj.touch()
 
                 if not include_passenger:
                     if hasattr(obj, "mPassenger"):
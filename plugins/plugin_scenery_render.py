@@ -4,7 +4,7 @@ import PyQt6.QtWidgets as QtWidgets
 import random
 from dataclasses import dataclass
 from collections import namedtuple
-from math import pi, sin, cos
+from math import pi, sin, cos, isnan
 from typing import TYPE_CHECKING
 from OpenGL.GL import *
 from lib.bw_types import BWMatrix, decompose
@@ -151,6 +151,8 @@ class SceneryComponent(object):
         self.y = y
         self.mtx = mtx
         self.modeltype = modeltype
+        # Copy of mtx placed on the terrain
+        self.rendermtx = None
 
 
 def get_angles(a_mtx):
@@ -177,10 +179,13 @@ def get_angles(a_mtx):
 
 class SceneryHandler(object):
     def __init__(self):
-        self.components: list[tuple[BattalionObject, list[SceneryComponent]]] = []
+        self.components: list[SceneryComponent] = []
+        # Cluster -> (key, components), the components are reused until the key of the cluster changes
+        self.cluster_components: dict[SceneryCluster, tuple[tuple, list[SceneryComponent]]] = {}
         self.rng = Random()
         self.rng2 = Random()
         self.cluster_dirty = []
+        self.terrain = None
 
         self.do_rebuild = True
 
@@ -188,7 +193,25 @@ class SceneryHandler(object):
         if obj not in self.cluster_dirty:
             self.cluster_dirty.append(obj)
 
-    def set_scenery(self, level: "BattalionLevelFile", is_visible, is_bw2):
+    def cluster_key(self, is_bw2, obj: "SceneryCluster"):
+        # Everything the generated components depend on: the cluster's fields (seed, matrix, base),
+        # the fields of the base and the models of its elements
+        base = obj.mBase
+        if base is None:
+            return is_bw2, obj.state_key(), None, None
+        return (is_bw2, obj.state_key(), base.state_key(),
+                [element.mName if element is not None else None for element in base.Element])
+
+    def set_scenery(self, level: "BattalionLevelFile", is_visible, is_bw2, bwterrain=None):
+        # Components are only generated again for clusters that changed since they were last generated
+        if self.do_rebuild or bwterrain is not self.terrain:
+            self.cluster_components = {}
+            self.terrain = bwterrain
+        for obj in self.cluster_dirty:
+            self.cluster_components.pop(obj, None)
+            for cluster in [cluster for cluster in self.cluster_components if cluster.mBase is obj]:
+                del self.cluster_components[cluster]
+
         self.components = []
 
         if isinstance(level, list):
@@ -199,20 +222,46 @@ class SceneryHandler(object):
             else:
                 scenery = []
 
+        cluster_components = {}
+        generated = []
         for obj in scenery:
             obj: SceneryCluster
 
-            if True: #self.do_rebuild or obj in self.cluster_dirty or obj.mBase in self.cluster_dirty:
-                if is_visible(obj.type, obj):
+            if is_visible(obj.type, obj):
+                key = self.cluster_key(is_bw2, obj)
+                cached = self.cluster_components.get(obj)
+                if cached is None or cached[0] != key:
                     components = self.generate_components(
                         is_bw2,
                         obj
                     )
-                    #obj._components = components
-                    self.components.extend(components)
+                    generated.extend(components)
+                    cached = (key, components)
+                cluster_components[obj] = cached
+                self.components.extend(cached[1])
+
+        self.place_on_terrain(generated)
+
+        # With the whole level, clusters that were deleted or hidden are dropped
+        if isinstance(level, list):
+            self.cluster_components.update(cluster_components)
+        else:
+            self.cluster_components = cluster_components
         self.do_rebuild = False
         self.cluster_dirty = []
 
+    def place_on_terrain(self, components: list[SceneryComponent]):
+        # The terrain height is looked up once for every generated component
+        for component in components:
+            component.rendermtx = component.mtx.mtx.copy()
+
+        if self.terrain is not None and len(components) > 0:
+            heights = self.terrain.check_heights([component.rendermtx[12] for component in components],
+                                                 [component.rendermtx[14] for component in components])
+            for component, height in zip(components, heights.tolist()):
+                if not isnan(height):
+                    component.rendermtx[13] = height
+
     def generate_components(self, is_bw2, bw_object: "SceneryCluster"):
         base: BattalionObject = bw_object.mBase
         pos: BWMatrix = bw_object.getmatrix()
@@ -7,7 +7,7 @@ from cx_Freeze import setup, Executable
 
 
 # To avoid importing the module, simply parse the file to find the version variable in it.
-with open('bw_editor.py', 'r', encoding='utf-8') as f:
+with open('level_editor.py', 'r', encoding='utf-8') as f:
     data = f.read()
 for line in data.splitlines():
     if '__version__' in line:
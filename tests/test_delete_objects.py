@@ -0,0 +1,88 @@
+import io
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # The XML library loads its resources relative to the editor folder
+
+from lib.BattalionXMLLib import BattalionLevelFile, BattalionObject
+
+
+LEVEL = """<?xml version="1.0" encoding="utf-8"?>
+<Instances>
+<Object type="sTestBase" id="10"><Attribute name="mName" type="cFxString8" elements="1"><Item>base</Item></Attribute></Object>
+<Object type="sTestBase" id="11"><Attribute name="mName" type="cFxString8" elements="1"><Item>other</Item></Attribute></Object>
+<Object type="cTestObject" id="20"><Pointer name="mBase" type="sTestBase" elements="1"><Item>11</Item></Pointer><Pointer name="mTargets" type="sTestBase" elements="2"><Item>0</Item><Item>0</Item></Pointer></Object>
+<Object type="cWaypoint" id="30"><Pointer name="NextWP" type="cWaypoint" elements="1"><Item>0</Item></Pointer></Object>
+<Object type="cWaypoint" id="31"><Pointer name="NextWP" type="cWaypoint" elements="1"><Item>0</Item></Pointer></Object>
+</Instances>
+"""
+
+
+def load(data):
+    level = BattalionLevelFile(io.BytesIO(data))
+    level.resolve_pointers(BattalionLevelFile())
+    return level
+
+
+def save_and_reload(level):
+    f = io.BytesIO()
+    level.write(f)
+    return load(f.getvalue())
+
+
+def test_delete_target_of_assigned_pointer():
+    # Like an object spawned from a base in the add object window
+    level = load(LEVEL.encode("utf-8"))
+    base = level.objects["10"]
+    troop = level.objects["20"]
+    clone = troop.clone_object(level, BattalionLevelFile())
+    clone.mBase = base
+    clone.update_xml()
+    level.add_object_new(clone)
+
+    level.delete_objects([base])
+
+    assert clone.mBase is None
+    reloaded = save_and_reload(level)
+    assert reloaded.objects[clone.id].mBase is None
+
+
+def test_delete_target_of_assigned_waypoint_link():
+    # Like waypoints placed one after another in the add object window
+    level = load(LEVEL.encode("utf-8"))
+    first = level.objects["30"]
+    second = level.objects["31"]
+    first.NextWP = second
+    first.update_xml()
+
+    level.delete_objects([second])
+
+    assert first.NextWP is None
+    reloaded = save_and_reload(level)
+    assert reloaded.objects["30"].NextWP is None
+
+
+def test_delete_target_of_assigned_pointer_list_element():
+    # Like a setter of a pointer list element in the PFD editor
+    level = load(LEVEL.encode("utf-8"))
+    troop = level.objects["20"]
+    target = level.objects["10"]
+    setattr(troop, "mBase", target)
+    troop.mTargets[1] = target
+    troop.update_xml()
+
+    level.delete_objects([target])
+
+    assert troop.mBase is None
+    assert troop.mTargets == [None, None]
+    reloaded = save_and_reload(level)
+    assert reloaded.objects["20"].mTargets == [None, None]
+
+
+def test_pointer_lists_stay_lists():
+    level = load(LEVEL.encode("utf-8"))
+    troop = level.objects["20"]
+    assert isinstance(troop.mTargets, list)
+    assert isinstance(troop.mBase, BattalionObject)
@@ -0,0 +1,113 @@
+import io
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # The XML library loads its resources relative to the editor folder
+
+from lib.BattalionXMLLib import BattalionLevelFile
+
+
+MATRIX = "1.0,0.0,0.0,0.0, 0.0,1.0,0.0,0.0, 0.0,0.0,1.0,0.0, 10.0,20.0,30.0,1.0"
+
+LEVEL = """<?xml version="1.0" encoding="utf-8"?>
+<Instances>
+<Object type="sTestBase" id="10"><Attribute name="mName" type="cFxString8" elements="1"><Item>base</Item></Attribute></Object>
+<Object type="cTestObject" id="20"><Attribute name="Mat" type="cMatrix4x4" elements="1"><Item>{0}</Item></Attribute><Attribute name="mColour" type="cU8Color" elements="1"><Item>1,2,3,4</Item></Attribute><Attribute name="mValues" type="sInt32" elements="2"><Item>5</Item><Item>6</Item></Attribute><Attribute name="mSpeed" type="sFloat" elements="1"><Item>1.500000</Item></Attribute><Pointer name="mBase" type="sTestBase" elements="1"><Item>10</Item></Pointer></Object>
+</Instances>
+""".format(MATRIX)
+
+
+def load():
+    level = BattalionLevelFile(io.BytesIO(LEVEL.encode("utf-8")))
+    level.resolve_pointers(BattalionLevelFile())
+    return level
+
+
+def cached_write(level):
+    f = io.BytesIO()
+    level.write(f)
+    return f.getvalue()
+
+
+def full_write(level):
+    # What the level file looked like when every object was serialized on each save
+    for obj in level.objects.values():
+        obj.update_xml()
+    f = io.BytesIO()
+    f.write(b"<?xml version=\"1.0\" encoding=\"utf-8\"?>\n")
+    level._tree.write(f, encoding="utf-8", short_empty_elements=False)
+    return f.getvalue()
+
+
+def test_unchanged_objects_are_not_serialized_again():
+    level = load()
+    level.warm_text_cache()
+    obj = level.objects["20"]
+    text = obj.cached_text()
+    assert text is not None
+    cached_write(level)
+    assert obj.cached_text() is text
+
+
+def test_in_place_edits_are_saved():
+    level = load()
+    obj = level.objects["20"]
+    cached_write(level)
+
+    obj.getmatrix().mtx[12] += 5
+    assert cached_write(level) == full_write(level)
+    obj.mColour.x = 200
+    assert cached_write(level) == full_write(level)
+    obj.mValues[1] = 7
+    assert cached_write(level) == full_write(level)
+
+
+def test_assigned_fields_and_attributes_are_saved():
+    level = load()
+    obj = level.objects["20"]
+    cached_write(level)
+
+    obj.mSpeed = 2.5
+    assert cached_write(level) == full_write(level)
+    obj.set_custom_name("renamed")
+    assert cached_write(level) == full_write(level)
+
+
+def test_pointer_to_renumbered_object_is_saved():
+    level = load()
+    cached_write(level)
+
+    # The object's own id is taken so it gets a new one, like a pasted object
+    base = level.objects["10"]
+    base.choose_unique_id(level, BattalionLevelFile())
+    assert base.id == "17"
+    assert b'<Item>17</Item>' in cached_write(level)
+
+
+def test_snapshot_serializes_changed_objects_when_written():
+    level = load()
+    cached_write(level)
+    obj = level.objects["20"]
+    obj.mSpeed = 3.0
+
+    snapshot = level.snapshot()
+    assert obj in snapshot.texts
+    f = io.BytesIO()
+    snapshot.write(f)
+    assert f.getvalue() == full_write(level)
+
+
+def test_text_index_follows_changes():
+    level = load()
+    obj = level.objects["20"]
+    assert level.text_index.search("1.500000")[0][0] is obj
+
+    obj.mSpeed = 9.25
+    assert level.text_index.search("9.250000")[0][0] is obj
+    obj.getmatrix().mtx[12] = 77.0
+    level.mark_changed()
+    assert level.text_index.search("77.0")[0][0] is obj
+    level.delete_objects([obj])
+    assert level.text_index.search("9.250000") == []
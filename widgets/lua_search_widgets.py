@@ -1,4 +1,4 @@
-import os
+import re
 import PyQt6.QtWidgets as QtWidgets
 import PyQt6.QtGui as QtGui
 import PyQt6.QtCore as QtCore
@@ -14,10 +14,17 @@ class LuaSearchBar(SearchBar):
         self.case_sensitive_text = QtWidgets.QLabel("Case Sensitive", self)
         self.l.addWidget(self.case_sensitive)
         self.l.addWidget(self.case_sensitive_text)
+        self.regex = QtWidgets.QCheckBox(self)
+        self.regex_text = QtWidgets.QLabel("Regex", self)
+        self.l.addWidget(self.regex)
+        self.l.addWidget(self.regex_text)
 
     def is_case_sensitive(self):
         return self.case_sensitive.isChecked()
 
+    def is_regex(self):
+        return self.regex.isChecked()
+
 
 class LuaSearchResultItem(QtWidgets.QTreeWidgetItem):
     def __init__(self, parent, script, line, text):
@@ -60,22 +67,13 @@ class LuaFindWindow(QtWidgets.QMdiSubWindow):
         root.takeChildren()
 
         if text:
-            if not self.searchbar.is_case_sensitive():
-                text = text.lower()
-                case_sensitive = False
-            else:
-                case_sensitive = True
-
-            results = []
-            for script_path in self.luaworkbench.get_lua_script_paths():
-                with open(script_path, "r") as f:
-                    for i, line in enumerate(f):
-                        if case_sensitive:
-                            if text in line:
-                                results.append((os.path.basename(script_path), i+1, line))
-                        else:
-                            if text in line.lower():
-                                results.append((os.path.basename(script_path), i + 1, line))
+            try:
+                results = self.luaworkbench.search_scripts(text,
+                                                           self.searchbar.is_case_sensitive(),
+                                                           self.searchbar.is_regex())
+            except re.error as err:
+                open_message_dialog(f"Invalid regular expression: {err}")
+                return
 
             for script, line, text in results:
                 item = LuaSearchResultItem(self.results,
@@ -2,6 +2,7 @@ import os
 import struct
 import numpy
 import shutil
+import threading
 from PIL import Image, ImageDraw, ImageOps
 import sys
 import traceback
@@ -22,15 +23,17 @@ from lib.lua.bwarchivelib import BattalionArchive
 from lib.bw.vectors import Vector3
 import time
 import gzip
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 from PyQt6.QtCore import QSize, pyqtSignal, QPoint, QRect, QObject
 from io import BytesIO
 from lib.lua.luaworkshop import LuaWorkbench
+from lib.bw_terrain import BWTerrainV2
 from configuration import save_cfg
 from typing import TYPE_CHECKING
 from widgets.menu.menu import Menu
 if TYPE_CHECKING:
     import bw_editor
-    from lib.bw_terrain import BWTerrainV2
 
 
 class LoadingBar(QtWidgets.QDialog):
@@ -58,9 +61,16 @@ class LoadingBar(QtWidgets.QDialog):
         self.last_time = None
         self.force = False
 
+        self.stage_timings = []
+
     def update_progress(self, progress):
         self.progress = progress
 
+    def add_stage_timing(self, stage, seconds):
+        self.stage_timings.append((stage, seconds))
+        print(f"{stage} took {seconds:.2f}s")
+        self.update()
+
     def closeEvent(self, closeevent):
         self.timer.stop()
         if not self.force:
@@ -97,6 +107,15 @@ class LoadingBar(QtWidgets.QDialog):
                          self.loadingbar_height,
                          0x00FF00)
 
+        if self.stage_timings:
+            stage, seconds = self.stage_timings[-1]
+            painter.drawText(self.horizontal_distance,
+                             self.vertical_distance,
+                             self.loadingbar_width,
+                             self.loadingbar_height,
+                             Qt.AlignmentFlag.AlignCenter,
+                             f"{stage}: {seconds:.2f}s")
+
         # This highlight animation is cool but it doesn't update when
         # editor is inside a computation loop
         """highlightcolor = Vector3(0xCF, 0xFF, 0xCF)
@@ -139,6 +158,144 @@ class LoadingProgress(QObject):
         self.loadingbar.progress = int(self.curr) / 100.0
         QApplication.processEvents()
 
+    def set_background(self, progress):
+        # For progress of work on another thread, the UI thread doesn't need to process events
+        self.curr = progress
+        self.progressupdate.emit(self.text, int(self.curr))
+        self.loadingbar.progress = int(self.curr) / 100.0
+
+
+def open_maybe_gzipped(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    else:
+        return open(path, "rb")
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def read_level_file(path, callback=None):
+    with open_maybe_gzipped(path) as f:
+        return BattalionLevelFile(f, callback)
+
+
+def read_resource_archive(path):
+    # Section data stays in the mapped or decompressed file until it's used
+    return BattalionArchive.from_path(path)
+
+
+def read_terrain(path):
+    with open_maybe_gzipped(path) as f:
+        bwterrain = BWTerrainV2(f)
+    return bwterrain, bwterrain.build_render_meshes()
+
+
+class LoadStages(object):
+    # Runs the independent parts of loading a level on worker threads. The UI thread
+    # waits for the results it needs next while keeping the loading bar updated.
+    def __init__(self, loadingbar: LoadingBar, progressbar: LoadingProgress):
+        self.loadingbar = loadingbar
+        self.progressbar = progressbar
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.futures = {}
+        self.fractions = {}
+
+    def submit(self, stage, func, *args):
+        self.futures[stage] = self.executor.submit(timed, func, *args)
+
+    def submit_with_progress(self, stage, func, *args):
+        # func gets a callback(size, i) as its last argument. It is called on the worker thread
+        # so it only stores the fraction and the UI thread shows it while waiting.
+        self.fractions[stage] = 0.0
+        self.submit(stage, func, *args, partial(self.set_fraction, stage))
+
+    def set_fraction(self, stage, size, i):
+        self.fractions[stage] = i/max(size, 1)
+
+    def result(self, stage, progress=None):
+        future = self.futures.pop(stage)
+        start = self.progressbar.curr
+        waited = 0
+        while not future.done():
+            futures.wait([future], timeout=1/30)
+            if progress is not None:
+                waited += 1/30
+                if stage in self.fractions:
+                    fraction = self.fractions[stage]
+                else:
+                    # We don't know how long a stage takes so the bar slowly approaches the target
+                    fraction = 1 - 1/(1 + waited)
+                self.progressbar.callback(progress - start, 1, fraction)
+            else:
+                QApplication.processEvents()
+
+        self.fractions.pop(stage, None)
+        result, seconds = future.result()
+        self.loadingbar.add_stage_timing(stage, seconds)
+        if progress is not None:
+            self.progressbar.set(progress)
+        return result
+
+    def time_stage(self, stage, func, *args):
+        # Runs a stage on the UI thread
+        result, seconds = timed(func, *args)
+        self.loadingbar.add_stage_timing(stage, seconds)
+        return result
+
+    def shutdown(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+
+def convert_terrain(pathold, pathnew):
+    # Compresses or decompresses the terrain file depending on the new path
+    with open_maybe_gzipped(pathold) as f:
+        data = f.read()
+
+    if pathnew.endswith(".gz"):
+        with gzip.open(pathnew, "wb") as f:
+            f.write(data)
+    else:
+        with open(pathnew, "wb") as f:
+            f.write(data)
+
+
+def write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+class SaveJob(object):
+    # Steps that write snapshots of the level files, run one after another on the save
+    # worker thread. The UI thread only takes the snapshots and polls the job for progress.
+    def __init__(self):
+        self.steps = []
+        self.progress = 0.0
+        self.results = {}
+        self.stage_timings = []
+        self.future = None
+
+    def add_step(self, stage, func, *args, callback=False):
+        # With callback the step gets a callback(size, position) for progress within the step
+        if callback:
+            args += (partial(self.step_callback, len(self.steps)), )
+        self.steps.append((stage, func, args))
+
+    def step_callback(self, i, size, position):
+        self.progress = (i + position/max(size, 1))/len(self.steps)
+
+    def run(self):
+        for i, (stage, func, args) in enumerate(self.steps):
+            self.progress = i/len(self.steps)
+            self.results[stage], seconds = timed(func, *args)
+            self.stage_timings.append((stage, seconds))
+        self.progress = 1.0
+
 
 class EditorFileMenu(QMenu):
     def __init__(self, editor):
@@ -175,6 +332,19 @@ class EditorFileMenu(QMenu):
         #self.addAction(self.save_file_copy_as_action)
         self.is_loading = False
 
+        # Level files are written on a single worker so saves happen in order
+        self.save_executor = ThreadPoolExecutor(max_workers=1)
+        self.save_jobs = []
+        # Set to stop serializing the objects of the previous level in the background
+        self.warmup_stop = threading.Event()
+
+        # Autosaves write the level and preload XML next to the level files, interval is in minutes
+        self.autosave_timer = QtCore.QTimer(self)
+        self.autosave_timer.timeout.connect(self.autosave)
+        autosave_interval = self.editor.configuration["editor"].getfloat("autosave_interval", fallback=0)
+        if autosave_interval > 0:
+            self.autosave_timer.setInterval(int(autosave_interval*60*1000))
+            self.autosave_timer.start()
 
         self.MAX_RECENT_FILES = 10
 
@@ -263,6 +433,8 @@ class EditorFileMenu(QMenu):
 
         if filepath:
             self.last_chosen_type = chosentype
+            self.warmup_stop.set()
+            self.wait_for_save_jobs()
             print("Resetting editor")
             self.editor.reset()
             print("Reset done")
@@ -277,6 +449,7 @@ class EditorFileMenu(QMenu):
             self.editor.plugin_handler.execute_event("before_load", self.editor)
 
             with func_open(filepath, "rb") as f:
+                stages = None
                 try:
                     self.editor.level_view.stop_redrawing()
                     self.is_loading = True
@@ -292,32 +465,21 @@ class EditorFileMenu(QMenu):
                     progressbar = LoadingProgress("Loading", loadingbar)
                     QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
                     progressbar.progressupdate.connect(self.updatestatus)
-                    if levelpaths.objectpath.endswith(".gz"):
-                        with gzip.open(os.path.join(base, levelpaths.objectpath), "rb") as g:
-                            level_data = BattalionLevelFile(g, partial(progressbar.callback, 10))
-                    else:
-                        with open(os.path.join(base, levelpaths.objectpath), "rb") as g:
-                            level_data = BattalionLevelFile(g, partial(progressbar.callback, 10))
 
-                    progressbar.set(10)
-                    if levelpaths.preloadpath.endswith(".gz"):
-                        with gzip.open(os.path.join(base, levelpaths.preloadpath), "rb") as g:
-                            preload_data = BattalionLevelFile(g, partial(progressbar.callback, 10))
-                    else:
-                        with open(os.path.join(base, levelpaths.preloadpath), "rb") as g:
-                            preload_data = BattalionLevelFile(g, partial(progressbar.callback, 10))
+                    # The level files, the resource archive and the terrain don't depend on each other
+                    # so they are read at the same time
+                    stages = LoadStages(loadingbar, progressbar)
+                    stages.submit_with_progress("Level", read_level_file, os.path.join(base, levelpaths.objectpath))
+                    stages.submit_with_progress("Preload", read_level_file, os.path.join(base, levelpaths.preloadpath))
+                    stages.submit("Resources", read_resource_archive, os.path.join(base, levelpaths.resourcepath))
+                    stages.submit("Terrain", read_terrain, os.path.join(base, levelpaths.terrainpath))
 
-                    progressbar.set(20)
-                    level_data.resolve_pointers(preload_data)
-                    preload_data.resolve_pointers(level_data)
+                    level_data = stages.result("Level", 10)
+                    preload_data = stages.result("Preload", 20)
+                    stages.time_stage("Pointers", level_data.resolve_pointers, preload_data)
+                    stages.time_stage("Pointers (Preload)", preload_data.resolve_pointers, level_data)
 
-                    if levelpaths.resourcepath.endswith(".gz"):
-                        with gzip.open(os.path.join(base, levelpaths.resourcepath), "rb") as g:
-                            resource_archive = BattalionArchive.from_file(g)
-
-                    else:
-                        with open(os.path.join(base, levelpaths.resourcepath), "rb") as g:
-                            resource_archive = BattalionArchive.from_file(g)
+                    resource_archive = stages.result("Resources", 25)
 
                     del self.editor.lua_workbench
                     self.editor.lua_workbench = LuaWorkbench(filepath+"_lua")
@@ -346,16 +508,17 @@ class EditorFileMenu(QMenu):
 
 
                     print("Reloading models...")
-                    self.editor.level_view.reloadModels(resource_archive, partial(progressbar.callback, 30))
+                    stages.time_stage("Models",
+                                      self.editor.level_view.reloadModels,
+                                      resource_archive, partial(progressbar.callback, 30))
                     progressbar.set(60)
 
                     print("Reloading terrain...")
-                    if levelpaths.terrainpath.endswith(".gz"):
-                        with gzip.open(os.path.join(base, levelpaths.terrainpath), "rb") as g:
-                            self.editor.level_view.reloadTerrain(g, partial(progressbar.callback, 30))
-                    else:
-                        with open(os.path.join(base, levelpaths.terrainpath), "rb") as g:
-                            self.editor.level_view.reloadTerrain(g, partial(progressbar.callback, 30))
+                    bwterrain, render_meshes = stages.result("Terrain")
+                    stages.time_stage("Terrain upload",
+                                      self.editor.level_view.setTerrain,
+                                      bwterrain, render_meshes, partial(progressbar.callback, 40))
+                    stages.shutdown()
 
                     progressbar.set(100)
                     print("Done")
@@ -366,6 +529,12 @@ class EditorFileMenu(QMenu):
                     self.editor.setup_level_file(level_data, preload_data, filepath)
                     self.current_gen_path = filepath
 
+                    # Objects are serialized on the save worker in the meantime so that the first
+                    # save and search don't have to serialize the whole level
+                    self.warmup_stop = threading.Event()
+                    self.save_executor.submit(level_data.warm_text_cache, self.warmup_stop)
+                    self.save_executor.submit(preload_data.warm_text_cache, self.warmup_stop)
+
                     # In testing the cursor didn't want to change back unless you moved the cursor
                     # off the window and back so we'll do this
                     self.is_loading = False
@@ -393,6 +562,8 @@ class EditorFileMenu(QMenu):
                     loadingbar.force_close()
 
                 except Exception as error:
+                    if stages is not None:
+                        stages.shutdown()
                     QApplication.restoreOverrideCursor()
                     QApplication.processEvents()
                     self.editor.level_view.start_redrawing()
@@ -424,14 +595,16 @@ class EditorFileMenu(QMenu):
                 self.editor.leveldatatreeview.updatenames()
 
                 progressbar.set(5)
-                for object in self.level_data.objects.values():
-                    object.update_xml()
                 self.editor.level_view.selected_positions = []
                 for obj in self.editor.level_view.selected:
                     if obj.getmatrix() is not None:
                         self.editor.level_view.selected_positions.append(obj.getmatrix())
                 progressbar.set(10)
 
+                # Everything that reads the editor's state happens here, the files are written
+                # from snapshots on the save worker so editing can continue in the meantime.
+                job = SaveJob()
+
                 if self.editor.editorconfig.getboolean("regenerate_pf2", fallback=False):
                     regenerate_waypoints = self.editor.editorconfig.getboolean("regenerate_waypoints", fallback=False)
                     try:
@@ -445,7 +618,7 @@ class EditorFileMenu(QMenu):
                                             self.editor.level_view.bwterrain,
                                             self.editor.level_view.waterheight,
                                             regenerate_waypoints)
-                        pf2.save(pf2path)
+                        job.add_step("PF2", pf2.save, pf2path)
                 else:
                     print("Skipping PF2..")
 
@@ -453,22 +626,11 @@ class EditorFileMenu(QMenu):
                 if self.level_paths.dirty:
                     if levelpaths.terrainpath.endswith(".gz"):
                         oldpath = levelpaths.terrainpath.removesuffix(".gz")
-                        pathold = os.path.join(base, oldpath)
-                        pathnew = os.path.join(base, levelpaths.terrainpath)
-
-                        with open(pathold, "rb") as f:
-                            data = f.read()
-                        with gzip.open(pathnew, "wb") as f:
-                            f.write(data)
                     else:
                         oldpath = levelpaths.terrainpath + ".gz"
-                        pathold = os.path.join(base, oldpath)
-                        pathnew = os.path.join(base, levelpaths.terrainpath)
-
-                        with gzip.open(pathold, "rb") as f:
-                            data = f.read()
-                        with open(pathnew, "wb") as f:
-                            f.write(data)
+                    job.add_step("Terrain", convert_terrain,
+                                 os.path.join(base, oldpath),
+                                 os.path.join(base, levelpaths.terrainpath))
 
 
                 if (self.editor.editorconfig.getboolean("recompile_lua", fallback=True)
@@ -496,97 +658,43 @@ class EditorFileMenu(QMenu):
                             loadingbar.force_close()
                             return
 
-                progressbar.set(25)
-                for object in self.preload_data.objects.values():
-                    object.update_xml()
                 progressbar.set(30)
 
 
                 print("Sorting XML nodes...")
                 self.level_data.sort_nodes()
 
-                tmp = BytesIO()
-                print("Writing level data to temp file...")
-                self.level_data.write(tmp)
-                progressbar.set(70)
-                tmp2 = BytesIO()
-
-                print("Writing preload data to temp file...")
-                self.preload_data.write(tmp2)
-
-                if levelpaths.objectpath.endswith(".gz"):
-                    with gzip.open(os.path.join(base, levelpaths.objectpath), "wb") as g:
-                        g.write(tmp.getvalue())
-                else:
-                    with open(os.path.join(base, levelpaths.objectpath), "wb") as g:
-                        g.write(tmp.getvalue())
-                        if self.level_paths.objectfilepadding is not None:
-                            if g.tell() < self.level_paths.objectfilepadding:
-                                g.write(b" "*(self.level_paths.objectfilepadding - g.tell()))
-
-                            else:
-                                open_error_dialog(
-                                    f"Level XML has exceeded Padding! "
-                                    f"({g.tell()} vs {self.level_paths.objectfilepadding})\n"
-                                    "If you need padding, you have to update the padding to a higher value.\n"
-                                    "If you are using save states, you have to restart the game normally and set a new savestate.",
-                                    self
-                                )
-
-                progressbar.set(90)
-
-                if levelpaths.preloadpath.endswith(".gz"):
-                    with gzip.open(os.path.join(base, levelpaths.preloadpath), "wb") as g:
-                        g.write(tmp2.getvalue())
-                else:
-                    with open(os.path.join(base, levelpaths.preloadpath), "wb") as g:
-                        g.write(tmp2.getvalue())
-                        if self.level_paths.preloadpadding is not None:
-                            if g.tell() < self.level_paths.preloadpadding:
-                                g.write(b" "*(self.level_paths.preloadpadding - g.tell()))
-                            else:
-                                open_error_dialog(
-                                    f"Preload XML has exceeded Padding! "
-                                    f"({g.tell()} vs {self.level_paths.objectfilepadding})\n"
-                                    "If you need padding, you have to update the padding to a higher value.\n"
-                                    "If you are using save states, you have to restart the game and set a new savestate.",
-                                    self)
-
-                if levelpaths.resourcepath.endswith(".gz"):
-                    self.resource_archive.set_additional_padding(0)
-                    out = BytesIO()
-                    self.resource_archive.write(out)
-
-                    with gzip.open(os.path.join(base, levelpaths.resourcepath), "wb") as f:
-                        f.write(out.getvalue())
-                else:
-                    self.resource_archive.set_additional_padding(0)
-                    if levelpaths.respadding is not None:
-                        tmp = BytesIO()
-                        self.resource_archive.write(tmp)
-                        padding = levelpaths.respadding-len(tmp.getvalue())
-                        if padding > 0:
-                            self.resource_archive.set_additional_padding(padding)
-
-                    out = BytesIO()
-                    self.resource_archive.write(out)
-
-                    with open(os.path.join(base, levelpaths.resourcepath), "wb") as f:
-                        f.write(out.getvalue())
-
+                objectpadding = None
+                if not levelpaths.objectpath.endswith(".gz"):
+                    objectpadding = self.level_paths.objectfilepadding
+                preloadpadding = None
+                if not levelpaths.preloadpath.endswith(".gz"):
+                    preloadpadding = self.level_paths.preloadpadding
+
+                self.resource_archive.set_additional_padding(0)
+                if not levelpaths.resourcepath.endswith(".gz") and levelpaths.respadding is not None:
+                    padding = levelpaths.respadding-self.resource_archive.packed_size()
+                    if padding > 0:
+                        self.resource_archive.set_additional_padding(padding)
+
+                # Only objects that changed since the last save are serialized again
+                print("Taking snapshot...")
+                job.add_step("Level", self.level_data.snapshot().save,
+                             os.path.join(base, levelpaths.objectpath), objectpadding, callback=True)
+                job.add_step("Preload", self.preload_data.snapshot().save,
+                             os.path.join(base, levelpaths.preloadpath), preloadpadding, callback=True)
+                job.add_step("Resources", self.resource_archive.snapshot().save,
+                             os.path.join(base, levelpaths.resourcepath))
 
                 tmp = BytesIO()
                 self.level_paths.write(tmp)
-
-                with open(self.current_path, "wb") as f:
-                    f.write(tmp.getvalue())
-
-                print("Done!")
-                progressbar.set(100)
+                job.add_step("Level paths", write_file, self.current_path, tmp.getvalue())
+                progressbar.set(40)
 
                 self.editor.level_view.start_redrawing()
                 self.editor.set_has_unsaved_changes(False)
-                loadingbar.force_close()
+                self.start_save_job(job, progressbar,
+                                    partial(self.save_finished, job, loadingbar, objectpadding, preloadpadding))
             #else:
             #    self.button_save_level_as()
         except Exception as err:
@@ -595,6 +703,91 @@ class EditorFileMenu(QMenu):
                 loadingbar.force_close()
             raise
 
+    def start_save_job(self, job: SaveJob, progressbar: LoadingProgress, on_finished):
+        job.future = self.save_executor.submit(job.run)
+        self.save_jobs.append(job)
+
+        start = progressbar.curr if progressbar is not None else 0
+        timer = QtCore.QTimer(self)
+        timer.setInterval(1000//30)
+        timer.timeout.connect(partial(self.poll_save_job, job, timer, progressbar, start, on_finished))
+        timer.start()
+
+    def wait_for_save_jobs(self):
+        # Saves write objects that are still part of the level, so they have to finish before it is reset
+        if self.save_jobs:
+            print("Waiting for the level to be saved...")
+        while self.save_jobs:
+            futures.wait([job.future for job in self.save_jobs], timeout=1/30)
+            QApplication.processEvents()
+
+    def poll_save_job(self, job: SaveJob, timer, progressbar: LoadingProgress, start, on_finished):
+        if progressbar is not None:
+            progressbar.set_background(start + (100 - start)*job.progress)
+
+        if job.future.done():
+            timer.stop()
+            timer.deleteLater()
+            self.save_jobs.remove(job)
+            on_finished()
+
+    def save_finished(self, job: SaveJob, loadingbar: LoadingBar, objectpadding, preloadpadding):
+        for stage, seconds in job.stage_timings:
+            loadingbar.add_stage_timing(stage, seconds)
+        loadingbar.force_close()
+
+        error = job.future.exception()
+        if error is not None:
+            traceback.print_exception(type(error), error, error.__traceback__)
+            self.editor.set_has_unsaved_changes(True)
+            open_error_dialog("An error appeared while saving, the level might not have been saved!\n\n"+str(error),
+                              self)
+            return
+
+        size = job.results["Level"]
+        if objectpadding is not None and size >= objectpadding:
+            open_error_dialog(
+                f"Level XML has exceeded Padding! "
+                f"({size} vs {objectpadding})\n"
+                "If you need padding, you have to update the padding to a higher value.\n"
+                "If you are using save states, you have to restart the game normally and set a new savestate.",
+                self
+            )
+
+        size = job.results["Preload"]
+        if preloadpadding is not None and size >= preloadpadding:
+            open_error_dialog(
+                f"Preload XML has exceeded Padding! "
+                f"({size} vs {preloadpadding})\n"
+                "If you need padding, you have to update the padding to a higher value.\n"
+                "If you are using save states, you have to restart the game and set a new savestate.",
+                self)
+
+        print("Done!")
+
+    def autosave(self):
+        # Skipped while another save is still being written
+        if (self.level_paths is None or self.is_loading or self.save_jobs
+                or not self.editor._user_made_change):
+            return
+
+        base = os.path.dirname(self.current_gen_path)
+        job = SaveJob()
+        for stage, level_file, path in (("Level", self.level_data, self.level_paths.objectpath),
+                                        ("Preload", self.preload_data, self.level_paths.preloadpath)):
+            autosavepath = os.path.join(base, path.removesuffix(".gz") + ".autosave")
+            job.add_step(stage, level_file.snapshot().save, autosavepath)
+
+        self.start_save_job(job, None, partial(self.autosave_finished, job))
+
+    def autosave_finished(self, job: SaveJob):
+        error = job.future.exception()
+        if error is not None:
+            print("Autosave failed:", error)
+            traceback.print_exception(type(error), error, error.__traceback__)
+        else:
+            print("Autosaved in {0:.2f}s".format(sum(seconds for stage, seconds in job.stage_timings)))
+
     def button_save_level_as(self, *args, **kwargs):
         self._button_save_level_as(True, *args, **kwargs)
 
@@ -1,4 +1,3 @@
-import os
 import PyQt6.QtGui as QtGui
 import PyQt6.QtWidgets as QtWidgets
 from PyQt6.QtCore import QSize, pyqtSignal, QPoint, QRect
@@ -12,7 +11,7 @@ if TYPE_CHECKING:
 from widgets.editor_widgets import open_error_dialog
 from widgets.tree_view import LevelDataTreeView, ObjectGroup, NamedItem
 from widgets.menu.menubar import Menu
-from lib.searchquery import create_query, find_best_fit, autocompletefull, QueryDepthTooDeepError
+from lib.searchquery import create_query, compile_query, find_best_fit, autocompletefull, QueryDepthTooDeepError
 from lib.BattalionXMLLib import BattalionObject
 from widgets.lua_search_widgets import LuaSearchResultItem
 import typing
@@ -593,13 +592,7 @@ class SearchWidget(QtWidgets.QMainWindow):
         if self.luamodebutton.checked():
             self.treeview.set_lua_mode()
             searchtext = self.queryinput.toPlainText()
-            results = []
-
-            for script_path in self.editor.lua_workbench.get_lua_script_paths():
-                with open(script_path, "r") as f:
-                    for i, line in enumerate(f):
-                        if searchtext in line:
-                            results.append((os.path.basename(script_path), i + 1, line))
+            results = self.editor.lua_workbench.search_scripts(searchtext)
 
             self.treeview.set_lua_scripts(results)
         else:
@@ -607,48 +600,31 @@ class SearchWidget(QtWidgets.QMainWindow):
             objects = []
             if self.textmodebutton.checked():
                 searchtext = self.queryinput.toPlainText().strip()
-                searchtextlower = searchtext.lower()
                 if not searchtext:
                     return
 
-                for object in self.editor.level_file.objects.values():
-                    orig = object.tostring()
-                    resultlower = orig.lower()
-                    if searchtextlower in resultlower:
-                        pos = resultlower.find(searchtextlower)
-                        origtext = orig[pos:pos+len(searchtext)]
-                        if len(origtext) > 100:
-                            origtext = origtext[:100]+"..."
-                        objects.append((object, [origtext]))
+                for object, origtext in self.editor.level_file.text_index.search(searchtext):
+                    if len(origtext) > 100:
+                        origtext = origtext[:100]+"..."
+                    objects.append((object, [origtext]))
                 print("searched all level file objects")
-                for object in self.editor.preload_file.objects.values():
-                    orig = object.tostring()
-                    resultlower = orig.lower()
-                    if searchtextlower in resultlower:
-                        pos = resultlower.find(searchtextlower)
-                        origtext = orig[pos:pos + len(searchtext)]
-                        if len(origtext) > 100:
-                            origtext = origtext[:100] + "..."
-                        objects.append((object, [origtext]))
+                for object, origtext in self.editor.preload_file.text_index.search(searchtext):
+                    if len(origtext) > 100:
+                        origtext = origtext[:100] + "..."
+                    objects.append((object, [origtext]))
                 print("searched all preload objects")
             else:
                 searchquery = self.queryinput.toPlainText().replace("\n", "")
                 try:
-                    query = create_query(searchquery)
+                    query = compile_query(searchquery)
                 except Exception as err:
                     open_error_dialog("Cannot save: Search query has syntax errors.", self)
                     return
 
                 try:
-                    for object in self.editor.level_file.objects.values():
-                        if query.evaluate(object):
-                            values = query.get_values(object)
-                            objects.append((object, values))
+                    objects.extend(query.search(self.editor.level_file))
                     print("searched all level file objects")
-                    for object in self.editor.preload_file.objects.values():
-                        if query.evaluate(object):
-                            values = query.get_values(object)
-                            objects.append((object, values))
+                    objects.extend(query.search(self.editor.preload_file))
                     print("searched all preload objects")
                 except QueryDepthTooDeepError as err:
                     open_error_dialog(str(err), self)